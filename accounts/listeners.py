@@ -1,3 +1,21 @@
+from django.conf import settings
+from django.db import transaction
+
+
 def profile_changed(sender, instance, **kwargs):
     from accounts.services import UserService
-    UserService.invalidate_profile(instance.user_id)
\ No newline at end of file
+    from newsfeeds.services import NewsFeedService
+    if settings.CACHE_WRITE_THROUGH:
+        user_id = instance.user_id
+        transaction.on_commit(lambda: UserService.write_through_profile(user_id))
+    else:
+        UserService.invalidate_profile(instance.user_id)
+    NewsFeedService.invalidate_first_pages_showing_user(instance.user_id)
+
+
+def user_changed(sender, instance, **kwargs):
+    if kwargs.get('created'):
+        return
+
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.invalidate_first_pages_showing_user(instance.id)
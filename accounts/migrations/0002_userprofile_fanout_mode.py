@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='fanout_mode',
+            field=models.IntegerField(choices=[(0, 'Push'), (1, 'Pull')], default=0, null=True),
+        ),
+    ]
@@ -1,8 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import User
-from accounts.listeners import profile_changed
+from accounts.listeners import profile_changed, user_changed
 from utils.listeners import invalidate_object_cache
 from django.db.models.signals import post_save, pre_delete
+from newsfeeds.constants import FanoutMode, FANOUT_MODE_CHOICES
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.SET_NULL, null=True)
@@ -11,6 +12,14 @@ class UserProfile(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # how tweets of this user reach followers' newsfeeds, switched by
+    # follower count when the user tweets
+    fanout_mode = models.IntegerField(
+        default=FanoutMode.PUSH,
+        choices=FANOUT_MODE_CHOICES,
+        null=True,
+    )
+
     def __str__(self):
         return '{} {}'.format(self.user, self.nickname)
 
@@ -30,6 +39,8 @@ User.profile = property(get_profile)
 # hook up with listeners to invalidate cache
 pre_delete.connect(invalidate_object_cache, sender=User)
 post_save.connect(invalidate_object_cache, sender=User)
+pre_delete.connect(user_changed, sender=User)
+post_save.connect(user_changed, sender=User)
 
 pre_delete.connect(profile_changed, sender=UserProfile)
 post_save.connect(profile_changed, sender=UserProfile)
\ No newline at end of file
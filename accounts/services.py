@@ -1,7 +1,10 @@
 from accounts.models import UserProfile
+from accounts.tasks import refresh_cached_profile_task
 from django.conf import settings
 from django.core.cache import caches
 from twitter.cache import USER_PROFILE_PATTERN
+from utils.memcached_helper import MemcachedHelper, Tombstone
+import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -11,18 +14,41 @@ class UserService:
     def get_profile_through_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
 
-        profile = cache.get(key)
+        # stale profiles are served while refreshed in background
+        profile = MemcachedHelper.get_entry_value(
+            key,
+            cache.get(key),
+            lambda: refresh_cached_profile_task.delay(user_id),
+        )
+        # a tombstone is left by a deleted profile, it is created again and
+        # replaces the tombstone, an add would fail while the tombstone lives
+        if isinstance(profile, Tombstone):
+            return cls.refresh_profile(user_id)
         if profile is not None:
             return profile
 
+        started_at = time.time()
         profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
-        cache.set(key, profile)
+        MemcachedHelper.add_entry(key, profile, time.time() - started_at)
 
         return profile
 
+    @classmethod
+    def refresh_profile(cls, user_id):
+        return MemcachedHelper.refresh_entry(
+            USER_PROFILE_PATTERN.format(user_id=user_id),
+            lambda: UserProfile.objects.get_or_create(user_id=user_id)[0],
+        )
+
+    @classmethod
+    def write_through_profile(cls, user_id):
+        # a deleted profile is not created again here, unlike on refresh
+        return MemcachedHelper.write_through(
+            USER_PROFILE_PATTERN.format(user_id=user_id),
+            lambda: UserProfile.objects.filter(user_id=user_id).first(),
+        )
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
         cache.delete(key)
-
-
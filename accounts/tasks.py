@@ -0,0 +1,9 @@
+from celery import shared_task
+
+
+@shared_task(routing_key='default', time_limit=60)
+def refresh_cached_profile_task(user_id):
+    from accounts.services import UserService
+
+    UserService.refresh_profile(user_id)
+    return 'profile of user {} refreshed'.format(user_id)
@@ -1,5 +1,8 @@
 from accounts.models import UserProfile
-from testing.testcases import TestCase
+from accounts.services import UserService
+from testing.testcases import TestCase, TransactionTestCase
+from twitter.cache import USER_PROFILE_PATTERN
+from utils.memcached_helper import MemcachedHelper, Tombstone, cache
 
 
 class UserProfileTests(TestCase):
@@ -9,4 +12,35 @@ class UserProfileTests(TestCase):
         self.assertEqual(UserProfile.objects.count(), 0)
         p = kim.profile
         self.assertEqual(isinstance(p, UserProfile), True)
-        self.assertEqual(UserProfile.objects.count(), 1)
\ No newline at end of file
+        self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_profile_tombstone_replaced(self):
+        self.clear_cache()
+        kim = self.create_user('kim')
+        key = USER_PROFILE_PATTERN.format(user_id=kim.id)
+        MemcachedHelper.add_entry(key, Tombstone(), 0)
+
+        profile = UserService.get_profile_through_cache(kim.id)
+        self.assertEqual(profile.user_id, kim.id)
+        # the created profile is cached in place of the tombstone
+        self.assertEqual(cache.get(key).value.id, profile.id)
+        with self.assertNumQueries(0):
+            UserService.get_profile_through_cache(kim.id)
+
+
+class UserProfileWriteThroughTests(TransactionTestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def test_profile_written_through_on_commit(self):
+        kim = self.create_user('kim')
+        with self.settings(CACHE_WRITE_THROUGH=True):
+            profile = UserService.get_profile_through_cache(kim.id)
+            profile.nickname = 'kimmy'
+            profile.save()
+            # replaced rather than deleted once the save is committed
+            entry = cache.get(USER_PROFILE_PATTERN.format(user_id=kim.id))
+            self.assertEqual(entry.value.nickname, 'kimmy')
+            self.assertEqual(entry.version > 0, True)
+            self.assertEqual(UserService.get_profile_through_cache(kim.id).nickname, 'kimmy')
\ No newline at end of file
@@ -1,9 +1,12 @@
 from accounts.api.serializers import UserSerializer
 from comments.models import Comment
+from django.contrib.auth.models import User
 from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 class CommentSerializer(serializers.ModelSerializer):
     # without this line, user will appear as user_id
@@ -22,6 +25,11 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch(cls, comments):
+        MemcachedHelper.prefetch_objects(comments, User, 'user_id', '_cached_user')
 
     def get_likes_count(self, obj):
         return obj.like_set.count()
@@ -40,7 +40,8 @@ class CommentViewSet(viewsets.GenericViewSet):
         # get all comments for a tweet
         # from django_filter
         queryset = self.get_queryset()
-        comments = self.filter_queryset(queryset).prefetch_related('user').order_by('created_at')
+        # users are prefetched through memcached by CommentSerializer
+        comments = self.filter_queryset(queryset).order_by('created_at')
         serializer = CommentSerializer(
             comments,
             context={'request': request},
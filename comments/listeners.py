@@ -1,22 +1,33 @@
+from django.conf import settings
 from utils.listeners import invalidate_object_cache
 from utils.redis_helper import RedisHelper
 
 def incr_comments_count(sender, instance, created, **kwargs):
     from tweets.models import Tweet
+    from newsfeeds.services import NewsFeedService
     from django.db.models import F
 
     if not created:
         return
 
     # handle new comment
-    Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') + 1)
-    RedisHelper.incr_count(instance.tweet, 'comments_count')
+    if settings.TWEET_COUNTS_WRITE_BEHIND:
+        RedisHelper.add_count_behind(Tweet, instance.tweet_id, 'comments_count', 1)
+    else:
+        Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') + 1)
+        RedisHelper.incr_count(instance.tweet, 'comments_count')
+    NewsFeedService.invalidate_first_pages_showing_tweet(instance.tweet_id)
 
 
 def decr_comments_count(sender, instance, **kwargs):
     from tweets.models import Tweet
+    from newsfeeds.services import NewsFeedService
     from django.db.models import F
 
     # handle comment deletion
-    Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') - 1)
-    RedisHelper.decr_count(instance.tweet, 'comments_count')
\ No newline at end of file
+    if settings.TWEET_COUNTS_WRITE_BEHIND:
+        RedisHelper.add_count_behind(Tweet, instance.tweet_id, 'comments_count', -1)
+    else:
+        Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') - 1)
+        RedisHelper.decr_count(instance.tweet, 'comments_count')
+    NewsFeedService.invalidate_first_pages_showing_tweet(instance.tweet_id)
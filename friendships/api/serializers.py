@@ -1,25 +1,32 @@
 # serializer converts objects into data type that is understandable by front end
 from accounts.api.serializers import UserSerializerForFriendship
+from django.contrib.auth.models import User
 from friendships.models import Friendship
 from friendships.services import FriendshipService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 
-class FollowingUserIdSetMixin:
+class FollowedUserIdsMixin:
 
-    @property
-    def following_user_id_set(self: serializers.ModelSerializer):
+    def _get_followed_user_ids(self: serializers.ModelSerializer, user_ids):
         if self.context['request'].user.is_anonymous:
-            return {}
-        # object level cache in memory
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
+            return set()
+        return FriendshipService.get_followed_user_ids(
             self.context['request'].user.id,
+            user_ids,
         )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        return user_id_set
+
+    def prefetch_followed_user_ids(self, user_ids):
+        # object level cache in memory, only users on the page are checked
+        setattr(self, '_cached_followed_user_ids', self._get_followed_user_ids(user_ids))
+
+    def has_followed(self, user_id):
+        if hasattr(self, '_cached_followed_user_ids'):
+            return user_id in self._cached_followed_user_ids
+        return user_id in self._get_followed_user_ids([user_id])
 
 class FriendshipSerializerForCreate(serializers.ModelSerializer):
     from_user_id = serializers.IntegerField()
@@ -47,7 +54,7 @@ class FriendshipSerializerForCreate(serializers.ModelSerializer):
 
 
 # use source to visited model instance's methods
-class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
+class FollowerSerializer(serializers.ModelSerializer, FollowedUserIdsMixin):
     user = UserSerializerForFriendship(source='cached_from_user')
     created_at = serializers.DateTimeField()
     has_followed = serializers.SerializerMethodField()
@@ -55,15 +62,28 @@ class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, friendships):
+        MemcachedHelper.prefetch_objects(
+            friendships,
+            User,
+            'from_user_id',
+            '_cached_from_user',
+        )
+        self.prefetch_followed_user_ids([
+            friendship.from_user_id
+            for friendship in friendships
+        ])
 
     def get_has_followed(self, obj):
         # if self.context['request'].user.is_anonymous:
         #     return False
         # # this implementation has n+1 query problem
         # return FriendshipService.has_followed(self.context['request'].user, obj.from_user)
-        return obj.from_user_id in self.following_user_id_set
+        return self.has_followed(obj.from_user_id)
 
-class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
+class FollowingSerializer(serializers.ModelSerializer, FollowedUserIdsMixin):
     user = UserSerializerForFriendship(source='cached_to_user')
     created_at = serializers.DateTimeField()
     has_followed = serializers.SerializerMethodField()
@@ -71,6 +91,19 @@ class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, friendships):
+        MemcachedHelper.prefetch_objects(
+            friendships,
+            User,
+            'to_user_id',
+            '_cached_to_user',
+        )
+        self.prefetch_followed_user_ids([
+            friendship.to_user_id
+            for friendship in friendships
+        ])
 
     def get_has_followed(self, obj):
-        return obj.to_user_id in self.following_user_id_set
\ No newline at end of file
+        return self.has_followed(obj.to_user_id)
\ No newline at end of file
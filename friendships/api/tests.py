@@ -2,6 +2,9 @@ from friendships.models import Friendship
 from utils.paginations import FriendshipPagination
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.time_helpers import utc_now
+import base64
+import json
 
 
 FOLLOW_URL = '/api/friendships/{}/follow/'
@@ -183,6 +186,47 @@ class FriendshipApiTests(TestCase):
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], True)
 
+    def test_cursor_pagination(self):
+        page_size = FriendshipPagination.page_size
+        for i in range(page_size * 2 + 1):
+            follower = self.create_user('kim_follower{}'.format(i))
+            Friendship.objects.create(from_user=follower, to_user=self.kim)
+
+        url = FOLLOWERS_URL.format(self.kim.id)
+        follower_ids = []
+        response = self.anonymous_client.get(url, {'paginate': 'cursor'})
+        self.assertEqual(response.status_code, 200)
+        for _ in range(3):
+            self.assertEqual(response.data['total_results'], page_size * 2 + 1)
+            follower_ids += [result['user']['id'] for result in response.data['results']]
+            if not response.data['has_next_page']:
+                break
+            response = self.anonymous_client.get(url, {'cursor': response.data['next_cursor']})
+        self.assertEqual(response.data['next_cursor'], None)
+        # newest first, no follower left out or repeated
+        self.assertEqual(len(follower_ids), page_size * 2 + 1)
+        self.assertEqual(follower_ids, sorted(follower_ids, reverse=True))
+
+        response = self.anonymous_client.get(FOLLOWINGS_URL.format(self.david.id), {
+            'paginate': 'cursor',
+            'size': 2,
+        })
+        self.assertEqual(response.data['total_results'], 3)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['has_next_page'], True)
+
+        # pages by number unless asked for cursors
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['page_number'], 1)
+
+        response = self.anonymous_client.get(url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 404)
+        cursor = base64.urlsafe_b64encode(json.dumps(
+            [utc_now().isoformat(), 1, 'many'],
+        ).encode()).decode()
+        response = self.anonymous_client.get(url, {'cursor': cursor})
+        self.assertEqual(response.status_code, 404)
+
     def _test_friendship_pagination(self, url, page_size, max_page_size):
         response = self.anonymous_client.get(url, {'page': 1})
         self.assertEqual(response.status_code, 200)
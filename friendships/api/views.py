@@ -9,6 +9,7 @@ from friendships.api.serializers import (
     FollowerSerializer,
 )
 from friendships.services import FriendshipService
+from newsfeeds.services import NewsFeedService
 from django.contrib.auth.models import User
 from utils.paginations import FriendshipPagination
 from ratelimit.decorators import ratelimit
@@ -21,10 +22,16 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     queryset = User.objects.all()
     pagination_class = FriendshipPagination
 
+    def get_total_results(self):
+        # read by FriendshipPagination on the first page of a cursor
+        if self.action == 'followers':
+            return FriendshipService.get_follower_count(self.kwargs['pk'])
+        return FriendshipService.get_following_count(self.kwargs['pk'])
+
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     @method_decorator(ratelimit(key='user_or_ip', rate='1/s', method='GET', block=True))
     def followers(self, request, pk):
-        friendships = Friendship.objects.filter(to_user_id=pk).order_by('-created_at')
+        friendships = Friendship.objects.filter(to_user_id=pk).order_by('-created_at', '-id')
         page = self.paginate_queryset(friendships)
         serializer = FollowerSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
@@ -32,7 +39,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     @method_decorator(ratelimit(key='user_or_ip', rate='1/s', method='GET', block=True))
     def followings(self, request, pk):
-        friendships = Friendship.objects.filter(from_user_id = pk).order_by('-created_at')
+        friendships = Friendship.objects.filter(from_user_id=pk).order_by('-created_at', '-id')
         page = self.paginate_queryset(friendships)
         serializer = FollowingSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
@@ -57,6 +64,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
                 'errors': serializer.errors,
             }, status = status.HTTP_400_BAD_REQUEST)
         serializer.save()
+        NewsFeedService.backfill_followed_user_tweets(request.user.id, int(pk))
         return Response({'success': True},
                         status = status.HTTP_201_CREATED)
 
@@ -72,6 +80,8 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             from_user=request.user,
             to_user=pk,
         ).delete()
+        if deleted:
+            NewsFeedService.purge_unfollowed_user_tweets(request.user.id, int(pk))
         return Response({'success': True,
                          'deleted': deleted})
 
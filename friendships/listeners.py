@@ -1,3 +1,27 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+
+
 def friendship_changed(sender, instance, **kwargs):
     from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
+    from_user_id, to_user_id = instance.from_user_id, instance.to_user_id
+    if not settings.CACHE_WRITE_THROUGH:
+        FriendshipService.invalidate_cached_id_sets(from_user_id, to_user_id)
+        return
+
+    # followed on create, unfollowed on delete, other saves change no ids
+    is_followed = kwargs['signal'] is post_save
+    if is_followed and not kwargs['created']:
+        return
+    # the sets stay warm, they are updated once readers can see the change in
+    # db unless they changed meanwhile
+    changes = FriendshipService.get_cached_id_set_changes(from_user_id, to_user_id)
+    transaction.on_commit(
+        lambda: FriendshipService.update_cached_id_sets(
+            from_user_id,
+            to_user_id,
+            changes,
+            is_followed,
+        ),
+    )
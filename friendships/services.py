@@ -1,8 +1,11 @@
 # service is interacting with data model
 from django.core.cache import caches
 from django.conf import settings
+from django.db.models import Q
+from dateutil import parser
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import FOLLOWERS_SET_PATTERN, FOLLOWINGS_SET_PATTERN
+from utils.redis_helper import RedisHelper
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -21,34 +24,144 @@ class FriendshipService(object):
 
     @classmethod
     def get_follower_ids(cls, to_user_id):
-        friendships = Friendship.objects.filter(to_user_id=to_user_id)
-        return [friendship.from_user_id for friendship in friendships]
+        return list(RedisHelper.get_id_set(
+            FOLLOWERS_SET_PATTERN.format(user_id=to_user_id),
+            Friendship.objects.filter(
+                to_user_id=to_user_id,
+            ).values_list('from_user_id', flat=True),
+        ))
+
+    @classmethod
+    def _get_followers_after(cls, to_user_id, cursor):
+        # seek on the (to_user_id, created_at) index, id breaks the ties
+        queryset = Friendship.objects.filter(to_user_id=to_user_id)
+        if cursor is not None:
+            created_at, friendship_id = parser.isoparse(cursor[0]), cursor[1]
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) |
+                Q(created_at=created_at, id__gt=friendship_id)
+            )
+        return queryset.order_by('created_at', 'id')
+
+    @classmethod
+    def iter_follower_cursor_ranges(cls, to_user_id, batch_size):
+        """
+        yield (start, end] cursor ranges covering batch_size followers each,
+        a cursor is a json friendly (created_at, id) pair and None stands for
+        an open end. Only the last row of each batch is read, so memory stays
+        flat whatever the follower count.
+        """
+        start = None
+        while True:
+            boundary = cls._get_followers_after(to_user_id, start).values_list(
+                'created_at',
+                'id',
+            )[batch_size - 1: batch_size]
+            boundary = list(boundary)
+            if not boundary:
+                break
+            end = (boundary[0][0].isoformat(), boundary[0][1])
+            yield start, end
+            start = end
+
+        # the last batch is open ended and may be partial
+        if cls._get_followers_after(to_user_id, start).exists():
+            yield start, None
+
+    @classmethod
+    def get_follower_ids_in_range(cls, to_user_id, start, end):
+        # fanouts of most users are one open ended batch, read from cache
+        if start is None and end is None:
+            return cls.get_follower_ids(to_user_id)
+        queryset = cls._get_followers_after(to_user_id, start)
+        if end is not None:
+            created_at, friendship_id = parser.isoparse(end[0]), end[1]
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lte=friendship_id)
+            )
+        return list(queryset.values_list('from_user_id', flat=True))
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        count = RedisHelper.get_id_set_size(
+            FOLLOWERS_SET_PATTERN.format(user_id=to_user_id),
+        )
+        if count is not None:
+            return count
+        # counting on the (to_user_id, created_at) index
+        return Friendship.objects.filter(to_user_id=to_user_id).count()
+
+    @classmethod
+    def get_following_count(cls, from_user_id):
+        count = RedisHelper.get_id_set_size(
+            FOLLOWINGS_SET_PATTERN.format(user_id=from_user_id),
+        )
+        if count is not None:
+            return count
+        return Friendship.objects.filter(from_user_id=from_user_id).count()
 
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
-        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        # check if key is in cache
-        user_id_set = cache.get(key)
-        if user_id_set is not None:
-            return user_id_set
-        # retrieve from db if key is not in cache
-        friendships = Friendship.objects.filter(from_user_id=from_user_id)
-        user_id_set = set([
-            fs.to_user_id
-            for fs in friendships
-        ])
-        cache.set(key, user_id_set)
-        return user_id_set
+        # the same cached set answers has_followed, there is no other copy
+        # of followings to keep in sync
+        return RedisHelper.get_id_set(
+            FOLLOWINGS_SET_PATTERN.format(user_id=from_user_id),
+            Friendship.objects.filter(
+                from_user_id=from_user_id,
+            ).values_list('to_user_id', flat=True),
+        )
+
+    @classmethod
+    def get_followed_user_ids(cls, from_user_id, user_ids):
+        """
+        the ones of user_ids followed by from_user_id, e.g. users on a page
+        """
+        return RedisHelper.get_id_set_members(
+            FOLLOWINGS_SET_PATTERN.format(user_id=from_user_id),
+            user_ids,
+            Friendship.objects.filter(
+                from_user_id=from_user_id,
+            ).values_list('to_user_id', flat=True),
+        )
 
     @classmethod
     def has_followed(cls, from_user, to_user):
-        return Friendship.objects.filter(
-            from_user=from_user,
-            to_user=to_user,
-        ).exists()
+        return to_user.id in cls.get_followed_user_ids(from_user.id, [to_user.id])
+
+    @classmethod
+    def _get_cached_id_set_keys(cls, from_user_id, to_user_id):
+        return [
+            FOLLOWERS_SET_PATTERN.format(user_id=to_user_id),
+            FOLLOWINGS_SET_PATTERN.format(user_id=from_user_id),
+        ]
+
+    @classmethod
+    def get_cached_id_set_changes(cls, from_user_id, to_user_id):
+        return RedisHelper.get_id_set_changes(
+            cls._get_cached_id_set_keys(from_user_id, to_user_id),
+        )
+
+    @classmethod
+    def update_cached_id_sets(cls, from_user_id, to_user_id, changes, is_followed):
+        """
+        :param changes: read by get_cached_id_set_changes before the change
+        """
+        return RedisHelper.update_id_sets(
+            cls._get_cached_id_set_keys(from_user_id, to_user_id),
+            [from_user_id, to_user_id],
+            changes,
+            is_followed,
+        )
+
+    @classmethod
+    def invalidate_cached_id_sets(cls, from_user_id, to_user_id):
+        RedisHelper.invalidate_id_sets(
+            cls._get_cached_id_set_keys(from_user_id, to_user_id),
+        )
 
-    # less likely to have race condition
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
-        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
\ No newline at end of file
+        RedisHelper.invalidate_id_sets([
+            FOLLOWINGS_SET_PATTERN.format(user_id=from_user_id),
+        ])
\ No newline at end of file
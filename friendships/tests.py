@@ -1,6 +1,8 @@
 from friendships.models import Friendship
 from friendships.services import FriendshipService
-from testing.testcases import TestCase
+from testing.testcases import TestCase, TransactionTestCase
+from twitter.cache import FOLLOWERS_SET_PATTERN
+from utils.redis_helper import RedisHelper
 
 
 class FriendshipServiceTests(TestCase):
@@ -25,3 +27,139 @@ class FriendshipServiceTests(TestCase):
         FriendshipService.invalidate_following_cache(self.kim.id)
         user_id_set = FriendshipService.get_following_user_id_set(self.kim.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
+
+    def test_follower_cursor_ranges(self):
+        follower_ids = []
+        for i in range(5):
+            follower = self.create_user('follower{}'.format(i))
+            Friendship.objects.create(from_user=follower, to_user=self.kim)
+            follower_ids.append(follower.id)
+
+        cursor_ranges = list(FriendshipService.iter_follower_cursor_ranges(self.kim.id, 2))
+        self.assertEqual(len(cursor_ranges), 3)
+        self.assertEqual(cursor_ranges[0][0], None)
+        self.assertEqual(cursor_ranges[-1][1], None)
+
+        batches = [
+            FriendshipService.get_follower_ids_in_range(self.kim.id, start, end)
+            for start, end in cursor_ranges
+        ]
+        self.assertEqual(batches, [follower_ids[0:2], follower_ids[2:4], follower_ids[4:]])
+
+        # no open ended batch when followers fill up the batches exactly
+        cursor_ranges = list(FriendshipService.iter_follower_cursor_ranges(self.kim.id, 5))
+        self.assertEqual(len(cursor_ranges), 1)
+        self.assertEqual(list(FriendshipService.iter_follower_cursor_ranges(self.david.id, 2)), [])
+
+    def test_cached_id_sets(self):
+        user1 = self.create_user('user1')
+        Friendship.objects.create(from_user=self.kim, to_user=user1)
+        # loaded from db on first read
+        self.assertEqual(
+            FriendshipService.get_followed_user_ids(self.kim.id, [user1.id, self.david.id]),
+            {user1.id},
+        )
+        self.assertEqual(FriendshipService.get_follower_ids(user1.id), [self.kim.id])
+        self.assertEqual(FriendshipService.get_follower_ids(self.david.id), [])
+        self.assertEqual(FriendshipService.get_follower_count(self.david.id), 0)
+
+        # dropped by the listener on change, loaded again on next read
+        Friendship.objects.create(from_user=self.kim, to_user=self.david)
+        Friendship.objects.create(from_user=user1, to_user=self.david)
+        self.assertEqual(FriendshipService.get_follower_count(self.david.id), 2)
+        self.assertEqual(
+            set(FriendshipService.get_follower_ids(self.david.id)),
+            {self.kim.id, user1.id},
+        )
+        self.assertEqual(
+            FriendshipService.get_followed_user_ids(self.kim.id, [user1.id, self.david.id]),
+            {user1.id, self.david.id},
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                FriendshipService.get_followed_user_ids(self.kim.id, [user1.id, self.david.id]),
+                {user1.id, self.david.id},
+            )
+            self.assertEqual(
+                set(FriendshipService.get_follower_ids(self.david.id)),
+                {self.kim.id, user1.id},
+            )
+            self.assertEqual(FriendshipService.get_follower_count(self.david.id), 2)
+
+        Friendship.objects.filter(from_user=self.kim, to_user=user1).delete()
+        self.assertEqual(FriendshipService.has_followed(self.kim, user1), False)
+        self.assertEqual(FriendshipService.has_followed(self.kim, self.david), True)
+        self.assertEqual(FriendshipService.get_follower_ids(user1.id), [])
+
+    def test_cached_id_set_changed_while_loading(self):
+        user1 = self.create_user('user1')
+        key = FOLLOWERS_SET_PATTERN.format(user_id=self.david.id)
+
+        def read_follower_ids():
+            yield self.kim.id
+            # user1 follows david after kim's follow is read from db
+            FriendshipService.invalidate_cached_id_sets(user1.id, self.david.id)
+
+        # the read is served but not cached
+        self.assertEqual(RedisHelper.get_id_set(key, read_follower_ids()), {self.kim.id})
+        self.assertIsNone(RedisHelper.get_id_set_size(key))
+        self.assertEqual(RedisHelper.get_id_set(key, [self.kim.id, user1.id]), {self.kim.id, user1.id})
+        self.assertEqual(RedisHelper.get_id_set_size(key), 2)
+
+
+class FriendshipCacheUpdateTests(TransactionTestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.kim = self.create_user('kim')
+        self.david = self.create_user('david')
+
+    def test_cached_id_sets_updated_on_commit(self):
+        user1 = self.create_user('user1')
+        with self.settings(CACHE_WRITE_THROUGH=True):
+            self.assertEqual(FriendshipService.get_follower_ids(self.david.id), [])
+            self.assertEqual(
+                FriendshipService.get_followed_user_ids(self.kim.id, [self.david.id]),
+                set(),
+            )
+
+            # kept in cache, the follow is added rather than the sets dropped
+            Friendship.objects.create(from_user=self.kim, to_user=self.david)
+            Friendship.objects.create(from_user=user1, to_user=self.david)
+            with self.assertNumQueries(0):
+                self.assertEqual(FriendshipService.get_follower_count(self.david.id), 2)
+                self.assertEqual(
+                    set(FriendshipService.get_follower_ids(self.david.id)),
+                    {self.kim.id, user1.id},
+                )
+                self.assertEqual(
+                    FriendshipService.get_followed_user_ids(self.kim.id, [self.david.id]),
+                    {self.david.id},
+                )
+
+            Friendship.objects.filter(from_user=self.kim, to_user=self.david).delete()
+            with self.assertNumQueries(0):
+                self.assertEqual(FriendshipService.get_follower_ids(self.david.id), [user1.id])
+                self.assertEqual(FriendshipService.has_followed(self.kim, self.david), False)
+
+    def test_cached_id_set_changed_before_commit(self):
+        user1 = self.create_user('user1')
+        key = FOLLOWERS_SET_PATTERN.format(user_id=self.david.id)
+        self.assertEqual(FriendshipService.get_follower_ids(self.david.id), [])
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.kim.id), set())
+        # read in the save signals of two follows of david committed together
+        changes = FriendshipService.get_cached_id_set_changes(self.kim.id, self.david.id)
+        user1_changes = FriendshipService.get_cached_id_set_changes(user1.id, self.david.id)
+
+        # the first one applied is added, david's followers are dropped on the
+        # other as they may be updated out of order, kim's followings are not
+        self.assertEqual(
+            FriendshipService.update_cached_id_sets(user1.id, self.david.id, user1_changes, True),
+            0,
+        )
+        self.assertEqual(
+            FriendshipService.update_cached_id_sets(self.kim.id, self.david.id, changes, True),
+            1,
+        )
+        self.assertIsNone(RedisHelper.get_id_set_size(key))
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.kim.id), {self.david.id})
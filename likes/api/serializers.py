@@ -1,10 +1,13 @@
 from accounts.api.serializers import UserSerializer
 from comments.models import Comment
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from likes.models import Like
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class LikeSerializer(serializers.ModelSerializer):
@@ -13,6 +16,11 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch(cls, likes):
+        MemcachedHelper.prefetch_objects(likes, User, 'user_id', '_cached_user')
 
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
@@ -1,8 +1,10 @@
+from django.conf import settings
 from utils.redis_helper import RedisHelper
 
 
 def incr_likes_count(sender, instance, created, **kwargs):
     from tweets.models import Tweet
+    from newsfeeds.services import NewsFeedService
     from django.db.models import F
 
     if not created:
@@ -12,20 +14,30 @@ def incr_likes_count(sender, instance, created, **kwargs):
     if model_class != Tweet:
         return
 
-    # update is atomic, do not use save to update values
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
-    tweet = instance.content_object
-    RedisHelper.incr_count(tweet, 'likes_count')
+    if settings.TWEET_COUNTS_WRITE_BEHIND:
+        # no row lock on hot tweets, db is written by flush_tweet_counts_task
+        RedisHelper.add_count_behind(Tweet, instance.object_id, 'likes_count', 1)
+    else:
+        # update is atomic, do not use save to update values
+        Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
+        tweet = instance.content_object
+        RedisHelper.incr_count(tweet, 'likes_count')
+    NewsFeedService.invalidate_first_pages_showing_tweet(instance.object_id)
 
 
 def decr_likes_count(sender, instance, **kwargs):
     from tweets.models import Tweet
+    from newsfeeds.services import NewsFeedService
     from django.db.models import F
 
     model_class = instance.content_type.model_class()
     if model_class != Tweet:
         return
 
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
-    tweet = instance.content_object
-    RedisHelper.decr_count(tweet, 'likes_count')
\ No newline at end of file
+    if settings.TWEET_COUNTS_WRITE_BEHIND:
+        RedisHelper.add_count_behind(Tweet, instance.object_id, 'likes_count', -1)
+    else:
+        Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
+        tweet = instance.content_object
+        RedisHelper.decr_count(tweet, 'likes_count')
+    NewsFeedService.invalidate_first_pages_showing_tweet(instance.object_id)
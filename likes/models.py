@@ -32,6 +32,9 @@ class Like(models.Model):
         )
     @property
     def cached_user(self):
+        # prefetched for a whole list by MemcachedHelper.prefetch_objects
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 pre_delete.connect(decr_likes_count, sender=Like)
@@ -1,8 +1,23 @@
 from django.contrib import admin
-from newsfeeds.models import NewsFeed
+from newsfeeds.models import NewsFeed, FanoutJob
 
 
 @admin.register(NewsFeed)
 class NewsFeedAdmin(admin.ModelAdmin):
     list_display = ('user', 'tweet', 'created_at')
-    date_hierarchy = 'created_at'
\ No newline at end of file
+    date_hierarchy = 'created_at'
+
+
+@admin.register(FanoutJob)
+class FanoutJobAdmin(admin.ModelAdmin):
+    list_display = (
+        'tweet',
+        'status',
+        'followers_count',
+        'finished_batches_count',
+        'batches_count',
+        'delivery_seconds',
+        'created_at',
+    )
+    list_filter = ('status', 'is_backfill')
+    date_hierarchy = 'created_at'
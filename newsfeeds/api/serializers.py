@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from newsfeeds.models import NewsFeed
 from tweets.api.serializers import TweetSerializer
+from utils.serializers import PrefetchListSerializer
 
 
 class NewsFeedSerializer(serializers.ModelSerializer):
@@ -8,5 +9,17 @@ class NewsFeedSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = NewsFeed
-        # data we want to put in view
-        fields = ('id', 'created_at', 'tweet')
\ No newline at end of file
+        # data we want to put in view, id is None for tweets of pull mode
+        # authors, they are merged on read and never saved as newsfeeds, so
+        # pages are keyed by created_at rather than id
+        fields = ('id', 'created_at', 'tweet')
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch(cls, newsfeeds):
+        # authors of the tweets, tweets are hydrated by NewsFeedService
+        TweetSerializer.prefetch([
+            newsfeed.cached_tweet()
+            for newsfeed in newsfeeds
+            if newsfeed.cached_tweet() is not None
+        ])
\ No newline at end of file
@@ -5,11 +5,14 @@ from testing.testcases import TestCase
 from utils.paginations import EndlessPagination
 from newsfeeds.services import NewsFeedService
 from django.conf import settings
+import gzip
+import json
 
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEETS_URL = '/api/tweets/'
 FOLLOW_URL = '/api/friendships/{}/follow/'
+UNFOLLOW_URL = '/api/friendships/{}/unfollow/'
 
 class NewsFeedApiTests(TestCase):
 
@@ -209,3 +212,114 @@ class NewsFeedApiTests(TestCase):
         # cache expired
         self.clear_cache()
         _test_newsfeeds_after_new_feed_pushed()
+
+    def test_pagination_with_sorted_sets(self):
+        with self.settings(REDIS_USE_SORTED_SETS=True):
+            self.test_pagination()
+
+    def test_redis_sorted_set_limit(self):
+        with self.settings(REDIS_USE_SORTED_SETS=True):
+            self.test_redis_list_limit()
+
+    def test_follow_and_unfollow(self):
+        followed_user = self.create_user('followed')
+        tweets = [self.create_tweet(followed_user) for i in range(3)]
+        tweets = tweets[::-1]
+        kim_tweet = self.create_tweet(self.kim)
+        self.create_newsfeed(self.kim, kim_tweet)
+
+        # cache kim's newsfeeds
+        response = self.kim_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['results']), 1)
+
+        # recent tweets of followed user are merged into newsfeeds
+        self.kim_client.post(FOLLOW_URL.format(followed_user.id))
+        self.assertEqual(
+            NewsFeed.objects.filter(user=self.kim, tweet__user=followed_user).count(),
+            3,
+        )
+        response = self.kim_client.get(NEWSFEEDS_URL)
+        results = response.data['results']
+        self.assertEqual(
+            [newsfeed['tweet']['id'] for newsfeed in results],
+            [kim_tweet.id] + [tweet.id for tweet in tweets],
+        )
+
+        # and removed after unfollowing
+        self.kim_client.post(UNFOLLOW_URL.format(followed_user.id))
+        self.assertEqual(
+            NewsFeed.objects.filter(user=self.kim, tweet__user=followed_user).count(),
+            0,
+        )
+        response = self.kim_client.get(NEWSFEEDS_URL)
+        results = response.data['results']
+        self.assertEqual([newsfeed['tweet']['id'] for newsfeed in results], [kim_tweet.id])
+
+    def test_first_page_cache(self):
+        def get_first_page(**extra):
+            response = self.kim_client.get(NEWSFEEDS_URL, **extra)
+            if hasattr(response, 'data'):
+                return response, response.data['results']
+            content = response.content
+            if response.get('Content-Encoding') == 'gzip':
+                content = gzip.decompress(content)
+            return response, json.loads(content)['results']
+
+        self.kim_client.post(FOLLOW_URL.format(self.david.id))
+        tweet = self.create_tweet(self.david)
+        with self.settings(NEWSFEED_FIRST_PAGE_CACHE_ENABLE=True):
+            # rendered on first read, then served as it is
+            response, results = get_first_page()
+            self.assertEqual(hasattr(response, 'data'), True)
+            self.assertEqual(results[0]['tweet']['id'], tweet.id)
+            response, cached_results = get_first_page()
+            self.assertEqual(hasattr(response, 'data'), False)
+            self.assertEqual(cached_results, json.loads(json.dumps(results)))
+            response, cached_results = get_first_page(HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(cached_results[0]['tweet']['id'], tweet.id)
+
+            # counters of a visible tweet change
+            self.create_like(self.david, tweet)
+            _, results = get_first_page()
+            self.assertEqual(results[0]['tweet']['likes_count'], 1)
+            self.create_comment(self.kim, tweet)
+            _, results = get_first_page()
+            self.assertEqual(results[0]['tweet']['comments_count'], 1)
+
+            # author of a visible tweet changes
+            profile = self.david.profile
+            profile.nickname = 'david2'
+            profile.save()
+            _, results = get_first_page()
+            self.assertEqual(results[0]['tweet']['user']['nickname'], 'david2')
+
+            # new newsfeed pushed
+            new_tweet = self.create_tweet(self.david)
+            _, results = get_first_page()
+            self.assertEqual(
+                [newsfeed['tweet']['id'] for newsfeed in results],
+                [new_tweet.id, tweet.id],
+            )
+
+            # later pages are not cached
+            response = self.kim_client.get(NEWSFEEDS_URL, {
+                'created_at__lt': results[0]['created_at'],
+            })
+            self.assertEqual(response.data['results'][0]['tweet']['id'], tweet.id)
+
+        # a page invalidated while it is rendered is not cached
+        NewsFeedService.invalidate_first_pages([self.kim.id])
+        version = NewsFeedService.register_first_page_readers(
+            self.kim.id,
+            tweet_ids=[tweet.id],
+        )
+        self.create_like(self.kim, tweet)
+        self.assertEqual(NewsFeedService.cache_first_page(self.kim.id, b'{}', version), False)
+        self.assertEqual(NewsFeedService.get_cached_first_page(self.kim.id), None)
+        version = NewsFeedService.register_first_page_readers(
+            self.kim.id,
+            tweet_ids=[tweet.id],
+        )
+        self.assertEqual(NewsFeedService.cache_first_page(self.kim.id, b'{}', version), True)
+        self.assertEqual(gzip.decompress(NewsFeedService.get_cached_first_page(self.kim.id)), b'{}')
@@ -4,8 +4,14 @@ from newsfeeds.models import NewsFeed
 from newsfeeds.api.serializers import NewsFeedSerializer
 from utils.paginations import EndlessPagination
 from newsfeeds.services import NewsFeedService
+from tweets.services import TweetService
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from dateutil import parser
+import gzip
 
 class NewsFeedViewSet(viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
@@ -13,14 +19,122 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='1/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        NewsFeedService.mark_newsfeeds_read(request.user.id)
+        use_first_page_cache = settings.NEWSFEED_FIRST_PAGE_CACHE_ENABLE and not (
+            'created_at__gt' in request.query_params
+            or 'created_at__lt' in request.query_params
+        )
+        if use_first_page_cache:
+            content = NewsFeedService.get_cached_first_page(request.user.id)
+            if content is not None:
+                return self._get_first_page_response(request, content)
+
+        # read once for all merges of pulled tweets into this page
+        pull_mode_user_ids = NewsFeedService.get_followed_pull_mode_user_ids(
+            request.user.id,
+        )
+        if use_first_page_cache:
+            # a new tweet of a pull mode author goes to the first page on read
+            first_page_version = NewsFeedService.register_first_page_readers(
+                request.user.id,
+                author_ids=pull_mode_user_ids,
+            )
+        if settings.REDIS_USE_SORTED_SETS:
+            page = self.paginator.paginate_cached_sorted_set(
+                lambda *args: NewsFeedService.get_merged_newsfeeds_in_range(
+                    request.user.id,
+                    *args,
+                    pull_mode_user_ids=pull_mode_user_ids,
+                ),
+                request,
+            )
+        else:
+            page = self._paginate_cached_list(request, pull_mode_user_ids)
         if page is None:
             queryset = NewsFeed.objects.filter(user=request.user)
-            page = self.paginate_queryset(queryset)
+            page = self._merge_pull_mode_tweets_from_db(
+                request,
+                self.paginate_queryset(queryset),
+                pull_mode_user_ids,
+            )
+        if use_first_page_cache:
+            NewsFeedService.register_first_page_readers(
+                request.user.id,
+                tweet_ids=[newsfeed.tweet_id for newsfeed in page],
+            )
+        page = NewsFeedService.hydrate_newsfeeds(page)
+        tweets = [
+            newsfeed.cached_tweet()
+            for newsfeed in page
+            if newsfeed.cached_tweet() is not None
+        ]
+        if use_first_page_cache:
+            NewsFeedService.register_first_page_readers(
+                request.user.id,
+                author_ids=[tweet.user_id for tweet in tweets],
+            )
+        TweetService.prefetch_counts(tweets)
         serializer = NewsFeedSerializer(
             page,
             context={'request':request},
             many=True,
         )
-        return self.get_paginated_response(serializer.data)
\ No newline at end of file
+        response = self.get_paginated_response(serializer.data)
+        if use_first_page_cache:
+            NewsFeedService.cache_first_page(
+                request.user.id,
+                JSONRenderer().render(response.data),
+                first_page_version,
+            )
+        return response
+
+    def _get_first_page_response(self, request, content):
+        # the page is rendered already, skip serializers and renderers
+        if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+            response = HttpResponse(content, content_type='application/json')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(
+                gzip.decompress(content),
+                content_type='application/json',
+            )
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
+    def _merge_pull_mode_tweets_from_db(self, request, page, pull_mode_user_ids):
+        # same range as EndlessPagination.paginate_queryset
+        max_created_at, min_created_at = None, None
+        count = self.paginator.page_size
+        if 'created_at__gt' in request.query_params:
+            min_created_at = parser.isoparse(request.query_params['created_at__gt'])
+            count = None
+        elif 'created_at__lt' in request.query_params:
+            max_created_at = parser.isoparse(request.query_params['created_at__lt'])
+        page, has_more = NewsFeedService.merge_pull_mode_tweets_from_db(
+            request.user.id,
+            page,
+            max_created_at,
+            min_created_at,
+            count,
+            pull_mode_user_ids,
+        )
+        self.paginator.has_next_page = self.paginator.has_next_page or has_more
+        return page
+
+    def _paginate_cached_list(self, request, pull_mode_user_ids):
+        # one more newsfeed tells if there is a next page
+        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds_lazily(
+            request.user.id,
+            self.paginator.page_size + 1,
+        )
+        # tweets of pull mode authors are not fanned out, merge them on read
+        newsfeeds = NewsFeedService.merge_pull_mode_tweets(
+            request.user.id,
+            cached_newsfeeds,
+            pull_mode_user_ids=pull_mode_user_ids,
+        )
+        return self.paginator.paginate_cached_list(
+            newsfeeds,
+            request,
+            cached_list_length=len(cached_newsfeeds),
+        )
\ No newline at end of file
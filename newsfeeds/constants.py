@@ -1,3 +1,51 @@
 from django.conf import settings
+from utils.time_constants import ONE_DAY
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+
+class FanoutMode:
+    # fanout on write, every follower gets a newsfeed
+    PUSH = 0
+    # fanout on read, followers pull tweets when reading newsfeeds
+    PULL = 1
+
+
+FANOUT_MODE_CHOICES = (
+    (FanoutMode.PUSH, 'Push'),
+    (FanoutMode.PULL, 'Pull'),
+)
+
+PULL_MODE_FOLLOWERS_THRESHOLD = settings.NEWSFEED_PULL_MODE_FOLLOWERS_THRESHOLD
+# only switch back to push mode when followers drop well below the threshold,
+# so that authors around the threshold do not flip modes on every tweet
+PUSH_MODE_FOLLOWERS_THRESHOLD = PULL_MODE_FOLLOWERS_THRESHOLD // 2
+# the cached ids of pull mode authors are deleted on every mode switch, a
+# reader racing with the switch may write back the former ids, which last
+# this long at most
+PULL_MODE_USER_IDS_TIMEOUT = 60
+
+class FanoutStatus:
+    PENDING = 0
+    DONE = 1
+
+
+FANOUT_STATUS_CHOICES = (
+    (FanoutStatus.PENDING, 'Pending'),
+    (FanoutStatus.DONE, 'Done'),
+)
+
+# in flight fanouts older than this are reported as lagging
+FANOUT_LAG_THRESHOLD = 5 * 60
+
+# followers who read their newsfeeds within this window get new newsfeeds
+# pushed to cache right away, dormant ones rebuild the cache on next read
+ACTIVE_READER_WINDOW = 3 * ONE_DAY
+
+# number of recent tweets written into followers' newsfeeds when an author
+# switches from pull mode back to push mode
+NEWSFEED_BACKFILL_LIMIT = 50 if not settings.TESTING else 5
+
+# rendered first pages also expire on their own, which bounds staleness of a
+# page rendered while an invalidation of it goes on
+NEWSFEED_FIRST_PAGE_TIMEOUT = 5 * 60
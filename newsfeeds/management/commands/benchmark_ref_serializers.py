@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedRefSerializer
+from tweets.models import Tweet
+from tweets.services import TweetRefSerializer
+from utils.redis_serializers import DjangoModelSerializer
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare size and deserialization time of cached lists of tweets and '
+        'newsfeeds, json documents against packed refs'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=200,
+            help='number of the newest objects in a list',
+        )
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:>10} {:>24} {:>8} {:>10} {:>10}'.format(
+            'model', 'serializer', 'entries', 'bytes', 'read(ms)',
+        ))
+        for model_class, ref_serializer in [
+            (Tweet, TweetRefSerializer),
+            (NewsFeed, NewsFeedRefSerializer),
+        ]:
+            objects = list(model_class.objects.order_by('-created_at')[:options['size']])
+            if not objects:
+                self.stdout.write('No {} in db.'.format(model_class.__name__))
+                continue
+
+            for serializer in [DjangoModelSerializer, ref_serializer]:
+                # redis returns bytes
+                serialized_list = [
+                    serializer.serialize(obj) for obj in objects
+                ]
+                serialized_list = [
+                    data.encode() if isinstance(data, str) else data
+                    for data in serialized_list
+                ]
+                started_at = time.perf_counter()
+                for _ in range(options['repeat']):
+                    for data in serialized_list:
+                        serializer.deserialize(data)
+                elapsed = (time.perf_counter() - started_at) / options['repeat']
+                self.stdout.write('{:>10} {:>24} {:>8} {:>10} {:>10.2f}'.format(
+                    model_class.__name__,
+                    serializer.__name__,
+                    len(serialized_list),
+                    sum(len(data) for data in serialized_list),
+                    elapsed * 1000,
+                ))
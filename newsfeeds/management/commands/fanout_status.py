@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.constants import FANOUT_LAG_THRESHOLD
+from newsfeeds.services import FanoutJobService
+from utils.time_helpers import utc_now
+
+
+class Command(BaseCommand):
+    help = 'Show in flight newsfeed fanouts, the most lagging first'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lag',
+            type=int,
+            default=FANOUT_LAG_THRESHOLD,
+            help='seconds after tweet creation to report a fanout as lagging',
+        )
+        parser.add_argument('--limit', type=int, default=50)
+
+    def handle(self, *args, **options):
+        now = utc_now()
+        jobs = FanoutJobService.get_in_flight_jobs(options['limit'])
+        if not jobs:
+            self.stdout.write('No fanout in flight.')
+            return
+
+        self.stdout.write('{:>8} {:>10} {:>10} {:>12} {:>8} {:>8}'.format(
+            'job', 'tweet', 'followers', 'batches', 'retried', 'age(s)',
+        ))
+        for job in jobs:
+            age = (now - job.tweet_created_at).total_seconds()
+            line = '{:>8} {:>10} {:>10} {:>12} {:>8} {:>8.0f}'.format(
+                job.id,
+                job.tweet_id or '-',
+                job.followers_count,
+                '{}/{}'.format(
+                    job.finished_batches_count,
+                    '?' if job.batches_count is None else job.batches_count,
+                ),
+                job.retried_batches_count,
+                age,
+            )
+            if age > options['lag']:
+                line = self.style.WARNING(line + ' LAGGING')
+            self.stdout.write(line)
@@ -0,0 +1,53 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tweets', '0004_auto_20221102_0106'),
+        ('newsfeeds', '0002_auto_20221013_0047'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FanoutJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tweet_created_at', models.DateTimeField()),
+                ('is_backfill', models.BooleanField(default=False)),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Done')], default=0)),
+                ('followers_count', models.IntegerField(default=0)),
+                ('batches_count', models.IntegerField(null=True)),
+                ('finished_batches_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('delivery_seconds', models.FloatField(null=True)),
+                ('tweet', models.OneToOneField(null=True, on_delete=django.db.models.deletion.SET_NULL, to='tweets.tweet')),
+                ('tweet_user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'index_together': {('status', 'created_at')},
+            },
+        ),
+        migrations.CreateModel(
+            name='FanoutBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_cursor', models.JSONField(null=True)),
+                ('end_cursor', models.JSONField(null=True)),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Done')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='newsfeeds.fanoutjob')),
+            ],
+            options={
+                'index_together': {('job', 'status')},
+            },
+        ),
+    ]
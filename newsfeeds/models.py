@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from tweets.models import Tweet
+from newsfeeds.constants import FanoutStatus, FANOUT_STATUS_CHOICES
 from newsfeeds.listeners import push_newsfeed_to_cache
 from django.db.models.signals import post_save
 from utils.memcached_helper import MemcachedHelper
@@ -22,6 +23,65 @@ class NewsFeed(models.Model):
         return f'{self.created_at} inbox of {self.user}: {self.tweet}'
 
     def cached_tweet(self):
+        # prefetched for a whole page by NewsFeedService.hydrate_newsfeeds
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
-post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
\ No newline at end of file
+
+class FanoutJob(models.Model):
+    """
+    One fanout of a tweet to the newsfeeds of all followers, split into
+    batches.
+    """
+    tweet = models.OneToOneField(Tweet, on_delete=models.SET_NULL, null=True)
+    tweet_user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
+    # copied from tweet to measure delivery time
+    tweet_created_at = models.DateTimeField()
+    # backfill recent tweets of the user rather than fanning out the tweet
+    is_backfill = models.BooleanField(default=False)
+    status = models.IntegerField(
+        default=FanoutStatus.PENDING,
+        choices=FANOUT_STATUS_CHOICES,
+    )
+    followers_count = models.IntegerField(default=0)
+    # unknown until all batches are dispatched
+    batches_count = models.IntegerField(null=True)
+    finished_batches_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+    # from tweet creation to the last batch finished
+    delivery_seconds = models.FloatField(null=True)
+
+    class Meta:
+        index_together = (('status', 'created_at'),)
+
+    def __str__(self):
+        return 'fanout of tweet {}: {}/{} batches'.format(
+            self.tweet_id,
+            self.finished_batches_count,
+            self.batches_count,
+        )
+
+
+class FanoutBatch(models.Model):
+    job = models.ForeignKey(FanoutJob, on_delete=models.CASCADE)
+    # (created_at, id) cursors of followers, see FriendshipService
+    start_cursor = models.JSONField(null=True)
+    end_cursor = models.JSONField(null=True)
+    status = models.IntegerField(
+        default=FanoutStatus.PENDING,
+        choices=FANOUT_STATUS_CHOICES,
+    )
+    # more than one attempt means the batch has been retried
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (('job', 'status'),)
+
+    def __str__(self):
+        return 'batch {} of fanout job {}'.format(self.id, self.job_id)
+
+post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
@@ -1,7 +1,52 @@
-from newsfeeds.models import NewsFeed
-from twitter.cache import USER_NEWSFEEDS_PATTERN
-from utils.redis_helper import RedisHelper
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from accounts.models import UserProfile
+from accounts.services import UserService
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Case, Count, DateTimeField, F, Q, Value, When
+from friendships.services import FriendshipService
+from newsfeeds.constants import (
+    ACTIVE_READER_WINDOW,
+    FanoutMode,
+    FanoutStatus,
+    NEWSFEED_BACKFILL_LIMIT,
+    NEWSFEED_FIRST_PAGE_TIMEOUT,
+    PULL_MODE_FOLLOWERS_THRESHOLD,
+    PULL_MODE_USER_IDS_TIMEOUT,
+    PUSH_MODE_FOLLOWERS_THRESHOLD,
+)
+from newsfeeds.models import NewsFeed, FanoutJob, FanoutBatch
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import (
+    FIRST_PAGE_READERS_BY_TWEET_PATTERN,
+    FIRST_PAGE_READERS_BY_USER_PATTERN,
+    NEWSFEEDS_FIRST_PAGE_PATTERN,
+    NEWSFEEDS_FIRST_PAGE_VERSION_PATTERN,
+    NEWSFEEDS_LAST_READ_PATTERN,
+    PULL_MODE_USER_IDS_KEY,
+    USER_NEWSFEEDS_PATTERN,
+    USER_NEWSFEEDS_SORTED_SET_PATTERN,
+)
+from utils.time_helpers import utc_now
+from redis.exceptions import WatchError
+import gzip
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_helper import LazyCachedList, RedisHelper
+from utils.redis_serializers import CompactModelSerializer
+from newsfeeds.tasks import (
+    backfill_followed_user_tweets_task,
+    fanout_newsfeeds_main_task,
+    purge_unfollowed_user_tweets_task,
+)
+
+cache = caches['testing'] if settings.TESTING else caches['default']
+
+
+class NewsFeedRefSerializer(CompactModelSerializer):
+    model_class = NewsFeed
+    field_names = ('id', 'user_id', 'tweet_id', 'created_at')
+
 
 class NewsFeedService(object):
     # service usually has class method
@@ -13,12 +58,656 @@ class NewsFeedService(object):
 
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
+        if settings.REDIS_USE_SORTED_SETS:
+            newsfeeds, _ = cls.get_cached_newsfeeds_in_range(user_id)
+            return newsfeeds
+
         queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        return RedisHelper.load_objects(key, queryset, NewsFeedRefSerializer)
+
+    @classmethod
+    def get_cached_newsfeeds_lazily(cls, user_id, chunk_size):
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_objects_lazily(key, queryset, NewsFeedRefSerializer, chunk_size)
+
+    @classmethod
+    def get_cached_newsfeeds_in_range(
+        cls,
+        user_id,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+    ):
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_sorted_objects(
+            key,
+            queryset,
+            NewsFeedRefSerializer,
+            max_created_at,
+            min_created_at,
+            count,
+        )
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
         queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, queryset)
\ No newline at end of file
+        if settings.REDIS_USE_SORTED_SETS:
+            key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=newsfeed.user_id)
+            RedisHelper.push_sorted_object(key, newsfeed, queryset, NewsFeedRefSerializer)
+        else:
+            key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
+            RedisHelper.push_object(key, newsfeed, queryset, NewsFeedRefSerializer)
+        cls.invalidate_first_pages([newsfeed.user_id])
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        cls.invalidate_first_pages([newsfeed.user_id for newsfeed in newsfeeds])
+        if settings.REDIS_USE_SORTED_SETS:
+            keys = [
+                USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=newsfeed.user_id)
+                for newsfeed in newsfeeds
+            ]
+            return RedisHelper.push_sorted_objects(keys, newsfeeds, NewsFeedRefSerializer)
+
+        keys = [
+            USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
+            for newsfeed in newsfeeds
+        ]
+        return RedisHelper.push_objects(keys, newsfeeds, NewsFeedRefSerializer)
+
+    @classmethod
+    def hydrate_newsfeeds(cls, newsfeeds):
+        """
+        prefetch tweets of newsfeeds with one memcached get_many and at most
+        one query for misses, instead of one memcached get per newsfeed
+        """
+        newsfeeds = list(newsfeeds)
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        tweets_by_id = {tweet.id: tweet for tweet in tweets}
+        for newsfeed in newsfeeds:
+            # instance level cache
+            setattr(newsfeed, '_cached_tweet', tweets_by_id.get(newsfeed.tweet_id))
+        return newsfeeds
+
+    @classmethod
+    def invalidate_cached_newsfeeds(cls, user_ids):
+        if not user_ids:
+            return
+        # both storages are dropped so that neither is left stale
+        RedisHelper.delete_objects([
+            pattern.format(user_id=user_id)
+            for user_id in user_ids
+            for pattern in [
+                USER_NEWSFEEDS_PATTERN,
+                USER_NEWSFEEDS_SORTED_SET_PATTERN,
+            ]
+        ])
+        cls.invalidate_first_pages(user_ids)
+
+    @classmethod
+    def get_cached_first_page(cls, user_id):
+        """
+        :return: gzipped json of the rendered first page of newsfeeds, None
+        if it is not cached
+        """
+        conn = RedisClient.get_connection()
+        return conn.get(NEWSFEEDS_FIRST_PAGE_PATTERN.format(user_id=user_id))
+
+    @classmethod
+    def register_first_page_readers(cls, user_id, tweet_ids=(), author_ids=()):
+        """
+        index the first page of the user by the tweets and the authors it
+        shows, whose changes invalidate it. Readers are registered before the
+        page is read, so that no change of it goes unnoticed while rendering.
+        :return: version of the first page, see cache_first_page
+        """
+        readers_keys = [
+            FIRST_PAGE_READERS_BY_TWEET_PATTERN.format(tweet_id=tweet_id)
+            for tweet_id in set(tweet_ids)
+        ] + [
+            FIRST_PAGE_READERS_BY_USER_PATTERN.format(user_id=author_id)
+            for author_id in set(author_ids)
+        ]
+
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for readers_key in readers_keys:
+            pipe.sadd(readers_key, user_id)
+            # outlive the page rendered after them
+            pipe.expire(readers_key, NEWSFEED_FIRST_PAGE_TIMEOUT * 2)
+        pipe.get(NEWSFEEDS_FIRST_PAGE_VERSION_PATTERN.format(user_id=user_id))
+        return pipe.execute()[-1]
+
+    @classmethod
+    def cache_first_page(cls, user_id, content, version):
+        """
+        cache the rendered first page of newsfeeds gzipped, unless it is
+        invalidated since version was read by the first
+        register_first_page_readers for it
+        """
+        conn = RedisClient.get_connection()
+        version_key = NEWSFEEDS_FIRST_PAGE_VERSION_PATTERN.format(user_id=user_id)
+        with conn.pipeline() as pipe:
+            try:
+                pipe.watch(version_key)
+                if pipe.get(version_key) != version:
+                    return False
+                pipe.multi()
+                pipe.set(
+                    NEWSFEEDS_FIRST_PAGE_PATTERN.format(user_id=user_id),
+                    gzip.compress(content),
+                    ex=NEWSFEED_FIRST_PAGE_TIMEOUT,
+                )
+                pipe.execute()
+                return True
+            except WatchError:
+                # invalidated right before
+                return False
+
+    @classmethod
+    def invalidate_first_pages(cls, user_ids):
+        if not user_ids:
+            return
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for user_id in set(user_ids):
+            pipe.delete(NEWSFEEDS_FIRST_PAGE_PATTERN.format(user_id=user_id))
+            # pages being rendered meanwhile are not cached
+            version_key = NEWSFEEDS_FIRST_PAGE_VERSION_PATTERN.format(user_id=user_id)
+            pipe.incr(version_key)
+            pipe.expire(version_key, NEWSFEED_FIRST_PAGE_TIMEOUT * 2)
+        pipe.execute()
+
+    @classmethod
+    def _invalidate_first_pages_of_readers(cls, readers_key):
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        pipe.smembers(readers_key)
+        pipe.delete(readers_key)
+        reader_ids, _ = pipe.execute()
+        cls.invalidate_first_pages([int(reader_id) for reader_id in reader_ids])
+
+    @classmethod
+    def invalidate_first_pages_showing_tweet(cls, tweet_id):
+        # e.g. counters of the tweet change
+        cls._invalidate_first_pages_of_readers(
+            FIRST_PAGE_READERS_BY_TWEET_PATTERN.format(tweet_id=tweet_id),
+        )
+
+    @classmethod
+    def invalidate_first_pages_showing_user(cls, user_id):
+        # e.g. the user changes nickname, or tweets in pull mode
+        cls._invalidate_first_pages_of_readers(
+            FIRST_PAGE_READERS_BY_USER_PATTERN.format(user_id=user_id),
+        )
+
+    @classmethod
+    def mark_newsfeeds_read(cls, user_id):
+        # the key expires when the user becomes dormant
+        conn = RedisClient.get_connection()
+        key = NEWSFEEDS_LAST_READ_PATTERN.format(user_id=user_id)
+        conn.set(key, int(utc_now().timestamp()), ex=ACTIVE_READER_WINDOW)
+
+    @classmethod
+    def get_active_reader_ids(cls, user_ids):
+        if not user_ids:
+            return set()
+        conn = RedisClient.get_connection()
+        last_read_list = conn.mget([
+            NEWSFEEDS_LAST_READ_PATTERN.format(user_id=user_id)
+            for user_id in user_ids
+        ])
+        return set(
+            user_id
+            for user_id, last_read in zip(user_ids, last_read_list)
+            if last_read is not None
+        )
+
+    @classmethod
+    def get_pull_mode_user_ids(cls):
+        user_id_set = cache.get(PULL_MODE_USER_IDS_KEY)
+        if user_id_set is not None:
+            return user_id_set
+
+        user_id_set = set(UserProfile.objects.filter(
+            fanout_mode=FanoutMode.PULL,
+        ).values_list('user_id', flat=True))
+        cache.set(PULL_MODE_USER_IDS_KEY, user_id_set, timeout=PULL_MODE_USER_IDS_TIMEOUT)
+        return user_id_set
+
+    @classmethod
+    def get_followed_pull_mode_user_ids(cls, user_id):
+        """
+        pull mode authors followed by the user, computed once per read of
+        newsfeeds and passed along to the merges of pulled tweets
+        """
+        pull_mode_user_ids = cls.get_pull_mode_user_ids()
+        if not pull_mode_user_ids:
+            return set()
+        # the pull mode authors are few, check them against the followings
+        # set instead of reading all of it
+        return FriendshipService.get_followed_user_ids(user_id, pull_mode_user_ids)
+
+    @classmethod
+    def update_fanout_mode(cls, user_id, followers_count):
+        """
+        decide the fanout mode of an author by follower count and persist it
+        when it changes
+        :return: (mode, whether mode has changed)
+        """
+        profile = UserService.get_profile_through_cache(user_id)
+        mode = profile.fanout_mode or FanoutMode.PUSH
+
+        if mode == FanoutMode.PUSH and followers_count >= PULL_MODE_FOLLOWERS_THRESHOLD:
+            new_mode = FanoutMode.PULL
+        elif mode == FanoutMode.PULL and followers_count < PUSH_MODE_FOLLOWERS_THRESHOLD:
+            new_mode = FanoutMode.PUSH
+        else:
+            return mode, False
+
+        # update does not send post_save, invalidate caches by ourselves
+        UserProfile.objects.filter(user_id=user_id).update(fanout_mode=new_mode)
+        UserService.invalidate_profile(user_id)
+        cache.delete(PULL_MODE_USER_IDS_KEY)
+        return new_mode, True
+
+    @classmethod
+    def _create_backfilled_newsfeeds(cls, user_ids, tweets):
+        """
+        write existing tweets into newsfeeds of users, newsfeeds take the
+        created_at of the tweets so they are ordered as if they had been
+        fanned out when the tweets were posted
+        """
+        newsfeeds = [
+            NewsFeed(user_id=user_id, tweet_id=tweet.id)
+            for user_id in user_ids
+            for tweet in tweets
+        ]
+        # ids are auto incremented, the ones inserted below are greater
+        last_id = NewsFeed.objects.order_by('-id').values_list('id', flat=True).first()
+        # some newsfeeds may exist already, e.g. tweets fanned out in push mode,
+        # they are skipped and keep their created_at
+        NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
+        # created_at is auto_now_add, it can only be overwritten by update
+        NewsFeed.objects.filter(
+            id__gt=last_id or 0,
+            user_id__in=user_ids,
+            tweet_id__in=[tweet.id for tweet in tweets],
+        ).update(created_at=Case(
+            *[
+                When(tweet_id=tweet.id, then=Value(tweet.created_at))
+                for tweet in tweets
+            ],
+            output_field=DateTimeField(),
+        ))
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_ids, tweets):
+        cls._create_backfilled_newsfeeds(user_ids, tweets)
+        # deleting a tweet only nulls the tweet of newsfeeds already there,
+        # drop the ones written for tweets deleted meanwhile, like fanouts of
+        # deleted tweets are dropped
+        tweet_ids = set(tweet.id for tweet in tweets)
+        deleted_tweet_ids = tweet_ids - set(
+            Tweet.objects.filter(id__in=tweet_ids).values_list('id', flat=True)
+        )
+        if deleted_tweet_ids:
+            NewsFeed.objects.filter(
+                user_id__in=user_ids,
+                tweet_id__in=deleted_tweet_ids,
+            ).delete()
+        # backfilled newsfeeds are not at the head of the cached lists,
+        # let the lists be rebuilt from db on next read
+        cls.invalidate_cached_newsfeeds(user_ids)
+
+    @classmethod
+    def get_recent_tweets(cls, user_id):
+        return list(
+            Tweet.objects.filter(user_id=user_id)
+            .order_by('-created_at')[:NEWSFEED_BACKFILL_LIMIT]
+        )
+
+    @classmethod
+    def backfill_followed_user_tweets(cls, from_user_id, to_user_id):
+        # tweets of pull mode users show up on read right away
+        cls.invalidate_first_pages([from_user_id])
+        # use celery for async tasks
+        backfill_followed_user_tweets_task.delay(from_user_id, to_user_id)
+
+    @classmethod
+    def purge_unfollowed_user_tweets(cls, from_user_id, to_user_id):
+        cls.invalidate_first_pages([from_user_id])
+        purge_unfollowed_user_tweets_task.delay(from_user_id, to_user_id)
+
+    @classmethod
+    def merge_followed_user_tweets(cls, from_user_id, to_user_id):
+        """
+        merge recent tweets of a newly followed user into newsfeeds of the
+        follower, both in db and in cache
+        :return: number of tweets merged
+        """
+        if to_user_id in cls.get_pull_mode_user_ids():
+            # tweets of pull mode users are merged on read
+            return 0
+
+        tweets = cls.get_recent_tweets(to_user_id)
+        if not tweets:
+            return 0
+        cls._create_backfilled_newsfeeds([from_user_id], tweets)
+        newsfeeds = list(NewsFeed.objects.filter(
+            user_id=from_user_id,
+            tweet_id__in=[tweet.id for tweet in tweets],
+        ))
+
+        # a newsfeed may be cached already, e.g. when following back a user
+        # unfollowed before its newsfeeds are purged
+        tweet_ids = set(newsfeed.tweet_id for newsfeed in newsfeeds)
+
+        def is_merged(newsfeed):
+            return newsfeed.tweet_id in tweet_ids
+
+        if settings.REDIS_USE_SORTED_SETS:
+            key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=from_user_id)
+            RedisHelper.remove_sorted_objects(key, NewsFeedRefSerializer, is_merged)
+            RedisHelper.merge_sorted_objects(key, newsfeeds, NewsFeedRefSerializer)
+            return len(newsfeeds)
+
+        def merge(cached_newsfeeds):
+            cached_newsfeeds = [
+                newsfeed
+                for newsfeed in cached_newsfeeds
+                if not is_merged(newsfeed)
+            ]
+            return sorted(
+                cached_newsfeeds + newsfeeds,
+                key=lambda newsfeed: newsfeed.created_at,
+                reverse=True,
+            )
+
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=from_user_id)
+        RedisHelper.rewrite_objects(key, NewsFeedRefSerializer, merge)
+        return len(newsfeeds)
+
+    @classmethod
+    def remove_unfollowed_user_tweets(cls, from_user_id, to_user_id):
+        """
+        remove tweets of an unfollowed user from newsfeeds of the former
+        follower, both in db and in cache
+        :return: number of newsfeeds deleted from db
+        """
+        deleted, _ = NewsFeed.objects.filter(
+            user_id=from_user_id,
+            tweet__user_id=to_user_id,
+        ).delete()
+
+        if settings.REDIS_USE_SORTED_SETS:
+            key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=from_user_id)
+        else:
+            key = USER_NEWSFEEDS_PATTERN.format(user_id=from_user_id)
+        # newsfeeds not in cache are loaded from db, which has none left of
+        # the unfollowed user, rather than loaded to be purged
+        if not RedisClient.get_connection(key).exists(key):
+            return deleted
+
+        # newsfeeds only know tweet ids, find out the ones of the unfollowed
+        # user among cached newsfeeds in one query
+        cached_newsfeeds = cls.get_cached_newsfeeds(from_user_id)
+        unfollowed_tweet_ids = set(Tweet.objects.filter(
+            id__in=[newsfeed.tweet_id for newsfeed in cached_newsfeeds],
+            user_id=to_user_id,
+        ).values_list('id', flat=True))
+        if not unfollowed_tweet_ids:
+            return deleted
+
+        def should_remove(newsfeed):
+            return newsfeed.tweet_id in unfollowed_tweet_ids
+
+        if settings.REDIS_USE_SORTED_SETS:
+            RedisHelper.remove_sorted_objects(key, NewsFeedRefSerializer, should_remove)
+        else:
+            RedisHelper.remove_objects(key, NewsFeedRefSerializer, should_remove)
+        return deleted
+
+    @classmethod
+    def merge_pull_mode_tweets(
+        cls,
+        user_id,
+        newsfeeds,
+        cached_count=None,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+        pull_mode_user_ids=None,
+    ):
+        """
+        merge recent tweets of followed pull mode authors into cached
+        newsfeeds, pulled tweets are wrapped as unsaved newsfeeds, with no id.
+        :param newsfeeds: cached newsfeeds in (min_created_at, max_created_at),
+            at most count of them
+        :param cached_count: number of newsfeeds in cache, len(newsfeeds) by
+            default
+        :param pull_mode_user_ids: see get_followed_pull_mode_user_ids, read
+            if not given
+        """
+        if cached_count is None:
+            cached_count = len(newsfeeds)
+
+        if pull_mode_user_ids is None:
+            pull_mode_user_ids = cls.get_followed_pull_mode_user_ids(user_id)
+        if not pull_mode_user_ids:
+            return newsfeeds
+
+        # all cached newsfeeds are merged, the rest of a lazy list is read in
+        # one round trip rather than chunk by chunk
+        if isinstance(newsfeeds, LazyCachedList):
+            newsfeeds = newsfeeds.to_list()
+        newsfeeds = list(newsfeeds)
+        # tweets fanned out before the author switched to pull mode are
+        # already in newsfeeds
+        pushed_tweet_ids = set(newsfeed.tweet_id for newsfeed in newsfeeds)
+        tweets_by_author = TweetService.get_cached_tweets_of_users(
+            pull_mode_user_ids,
+            max_created_at,
+            min_created_at,
+            count,
+        )
+        pulled_newsfeeds = [
+            NewsFeed(user_id=user_id, tweet_id=tweet.id, created_at=tweet.created_at)
+            for tweets in tweets_by_author.values()
+            for tweet in tweets
+            if tweet.id not in pushed_tweet_ids
+        ]
+
+        # newsfeeds beyond a full cache are paginated from db, which has no
+        # pulled tweets, keep pulled tweets within the cached window only
+        reaches_end_of_cache = count is None or len(newsfeeds) < count
+        if cached_count >= settings.REDIS_LIST_LENGTH_LIMIT and reaches_end_of_cache:
+            if not newsfeeds:
+                return newsfeeds
+            oldest_created_at = newsfeeds[-1].created_at
+            pulled_newsfeeds = [
+                newsfeed
+                for newsfeed in pulled_newsfeeds
+                if newsfeed.created_at >= oldest_created_at
+            ]
+
+        merged_newsfeeds = sorted(
+            newsfeeds + pulled_newsfeeds,
+            key=lambda newsfeed: newsfeed.created_at,
+            reverse=True,
+        )
+        return merged_newsfeeds[:count]
+
+    @classmethod
+    def merge_pull_mode_tweets_from_db(
+        cls,
+        user_id,
+        newsfeeds,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+        pull_mode_user_ids=None,
+    ):
+        """
+        same as merge_pull_mode_tweets for newsfeeds paginated from db, past
+        the cached window, tweets to pull are read from db in the same range
+        :return: (merged newsfeeds, whether some are left out past count)
+        """
+        if pull_mode_user_ids is None:
+            pull_mode_user_ids = cls.get_followed_pull_mode_user_ids(user_id)
+        if not pull_mode_user_ids:
+            return newsfeeds, False
+
+        # tweets fanned out before the author switched to pull mode are
+        # already in newsfeeds
+        queryset = Tweet.objects.filter(user_id__in=pull_mode_user_ids).exclude(
+            id__in=NewsFeed.objects.filter(user_id=user_id).values('tweet_id'),
+        )
+        if max_created_at is not None:
+            queryset = queryset.filter(created_at__lt=max_created_at)
+        if min_created_at is not None:
+            queryset = queryset.filter(created_at__gt=min_created_at)
+        queryset = queryset.order_by('-created_at').values_list('id', 'created_at')
+        if count is not None:
+            queryset = queryset[:count]
+        pulled_newsfeeds = [
+            NewsFeed(user_id=user_id, tweet_id=tweet_id, created_at=created_at)
+            for tweet_id, created_at in queryset
+        ]
+
+        merged_newsfeeds = sorted(
+            list(newsfeeds) + pulled_newsfeeds,
+            key=lambda newsfeed: newsfeed.created_at,
+            reverse=True,
+        )
+        if count is None:
+            return merged_newsfeeds, False
+        return merged_newsfeeds[:count], len(merged_newsfeeds) > count
+
+    @classmethod
+    def get_merged_newsfeeds_in_range(
+        cls,
+        user_id,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+        pull_mode_user_ids=None,
+    ):
+        newsfeeds, cached_count = cls.get_cached_newsfeeds_in_range(
+            user_id,
+            max_created_at,
+            min_created_at,
+            count,
+        )
+        newsfeeds = cls.merge_pull_mode_tweets(
+            user_id,
+            newsfeeds,
+            cached_count,
+            max_created_at,
+            min_created_at,
+            count,
+            pull_mode_user_ids,
+        )
+        return newsfeeds, cached_count
+
+
+class FanoutJobService(object):
+
+    @classmethod
+    def get_or_create_job(cls, tweet_id, is_backfill, followers_count):
+        """
+        :return: (job, created), (None, False) if the tweet is deleted
+        """
+        tweet = Tweet.objects.filter(id=tweet_id).first()
+        if tweet is None:
+            return None, False
+        return FanoutJob.objects.get_or_create(tweet_id=tweet_id, defaults={
+            'tweet_user_id': tweet.user_id,
+            'tweet_created_at': tweet.created_at,
+            'is_backfill': is_backfill,
+            'followers_count': followers_count,
+        })
+
+    @classmethod
+    def reset_job(cls, job):
+        # a job interrupted while dispatching is dispatched again from
+        # scratch, batches already done are redone harmlessly
+        FanoutBatch.objects.filter(job=job).delete()
+        FanoutJob.objects.filter(id=job.id).update(finished_batches_count=0)
+
+    @classmethod
+    def create_batch(cls, job, start_cursor, end_cursor):
+        return FanoutBatch.objects.create(
+            job=job,
+            start_cursor=start_cursor,
+            end_cursor=end_cursor,
+        )
+
+    @classmethod
+    def start_batch(cls, batch_id):
+        """
+        :return: the batch to work on, None if it is done or gone
+        """
+        batch = FanoutBatch.objects.select_related('job').filter(id=batch_id).first()
+        if batch is None or batch.status == FanoutStatus.DONE:
+            return None
+        FanoutBatch.objects.filter(id=batch_id).update(attempts=F('attempts') + 1)
+        return batch
+
+    @classmethod
+    def finish_batch(cls, batch):
+        # only the first attempt to finish the batch counts
+        updated = FanoutBatch.objects.filter(
+            id=batch.id,
+            status=FanoutStatus.PENDING,
+        ).update(status=FanoutStatus.DONE, finished_at=utc_now())
+        if not updated:
+            return
+        FanoutJob.objects.filter(id=batch.job_id).update(
+            finished_batches_count=F('finished_batches_count') + 1,
+        )
+        cls.try_finish_job(batch.job_id)
+
+    @classmethod
+    def set_batches_count(cls, job, batches_count):
+        FanoutJob.objects.filter(id=job.id).update(batches_count=batches_count)
+        cls.try_finish_job(job.id)
+
+    @classmethod
+    def try_finish_job(cls, job_id):
+        """
+        completion callback, called whenever a batch finishes. The job is done
+        when all batches are dispatched and finished.
+        """
+        job = FanoutJob.objects.get(id=job_id)
+        if job.batches_count is None or job.finished_batches_count < job.batches_count:
+            return False
+
+        now = utc_now()
+        # conditional update, only one caller finishes the job
+        updated = FanoutJob.objects.filter(
+            id=job_id,
+            status=FanoutStatus.PENDING,
+            finished_batches_count=F('batches_count'),
+        ).update(
+            status=FanoutStatus.DONE,
+            finished_at=now,
+            delivery_seconds=(now - job.tweet_created_at).total_seconds(),
+        )
+        return updated == 1
+
+    @classmethod
+    def get_in_flight_jobs(cls, limit):
+        # oldest first, they are the most lagging ones
+        return FanoutJob.objects.filter(
+            status=FanoutStatus.PENDING,
+        ).order_by('created_at').annotate(
+            retried_batches_count=Count('fanoutbatch', filter=Q(fanoutbatch__attempts__gt=1)),
+        )[:limit]
+
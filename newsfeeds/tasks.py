@@ -3,37 +3,156 @@ from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
 from tweets.models import Tweet
 from utils.time_constants import ONE_HOUR
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.constants import (
+    FANOUT_BATCH_SIZE,
+    FanoutMode,
+)
 
+# fanout tasks are idempotent, they can be retried safely. A retried main task
+# dispatches the batches of its job again from scratch, see reset_job
+FANOUT_TASK_RETRY_OPTIONS = {
+    'autoretry_for': (Exception,),
+    'max_retries': 3,
+    'retry_backoff': True,
+}
 
-@shared_task(time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
-    from newsfeeds.services import NewsFeedService
 
+@shared_task(time_limit=ONE_HOUR, **FANOUT_TASK_RETRY_OPTIONS)
+def fanout_newsfeeds_batch_task(batch_id):
+    from newsfeeds.services import NewsFeedService, FanoutJobService
+
+    batch = FanoutJobService.start_batch(batch_id)
+    if batch is None:
+        return 'batch {} is done already'.format(batch_id)
+    if batch.job.tweet_id is None:
+        # the tweet is deleted meanwhile, there is nothing left to fan out
+        FanoutJobService.finish_batch(batch)
+        return 'tweet of batch {} is deleted'.format(batch_id)
+
+    follower_ids = FriendshipService.get_follower_ids_in_range(
+        batch.job.tweet_user_id,
+        batch.start_cursor,
+        batch.end_cursor,
+    )
     newsfeeds = [
-        NewsFeed(user_id=follower_id, tweet_id=tweet_id)
+        NewsFeed(user_id=follower_id, tweet_id=batch.job.tweet_id)
         for follower_id in follower_ids
     ]
-    NewsFeed.objects.bulk_create(newsfeeds)
+    # newsfeeds inserted by a failed attempt are left as they are
+    NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
 
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+    if batch.attempts:
+        # a failed attempt may have pushed some newsfeeds to cache already,
+        # pushing them again would duplicate them in cached lists
+        NewsFeedService.invalidate_cached_newsfeeds(follower_ids)
+        FanoutJobService.finish_batch(batch)
+        return "{} newsfeeds created".format(len(newsfeeds))
+
+    # active followers get the newsfeed in cache right away, dormant ones
+    # rebuild their cached newsfeeds from db on next read
+    active_reader_ids = NewsFeedService.get_active_reader_ids(follower_ids)
+    NewsFeedService.push_newsfeeds_to_cache([
+        newsfeed
+        for newsfeed in newsfeeds
+        if newsfeed.user_id in active_reader_ids
+    ])
+    NewsFeedService.invalidate_cached_newsfeeds([
+        follower_id
+        for follower_id in follower_ids
+        if follower_id not in active_reader_ids
+    ])
 
+    FanoutJobService.finish_batch(batch)
     return "{} newsfeeds created".format(len(newsfeeds))
 
-@shared_task(routing_key='default', time_limit=ONE_HOUR)
+@shared_task(routing_key='default', time_limit=ONE_HOUR, **FANOUT_TASK_RETRY_OPTIONS)
 def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
-    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
+    from newsfeeds.services import NewsFeedService, FanoutJobService
 
-    # batch task for newsfeed tasks based on follower id
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    if not Tweet.objects.filter(id=tweet_id).exists():
+        return 'tweet {} is deleted, no fanout.'.format(tweet_id)
+    NewsFeed.objects.get_or_create(user_id=tweet_user_id, tweet_id=tweet_id)
+
+    followers_count = FriendshipService.get_follower_count(tweet_user_id)
+    mode, mode_changed = NewsFeedService.update_fanout_mode(
+        tweet_user_id,
+        followers_count,
+    )
+    if mode == FanoutMode.PULL:
+        # followers pull the tweet when reading their newsfeeds
+        NewsFeedService.invalidate_first_pages_showing_user(tweet_user_id)
+        return 'pull mode, no newsfeeds going to fanout.'
+
+    # tweets posted in pull mode are in nobody's newsfeeds, backfill recent
+    # ones together with this tweet
+    job, created = FanoutJobService.get_or_create_job(
+        tweet_id,
+        mode_changed,
+        followers_count,
+    )
+    if job is None:
+        return 'tweet {} is deleted, no fanout.'.format(tweet_id)
+    if not created:
+        if job.batches_count is not None:
+            return 'fanout of tweet {} is dispatched already.'.format(tweet_id)
+        FanoutJobService.reset_job(job)
+    batch_task = (
+        backfill_newsfeeds_batch_task
+        if job.is_backfill
+        else fanout_newsfeeds_batch_task
+    )
+
+    # batch tasks get a cursor range of followers rather than their ids,
+    # followers are read in index order by the batch tasks themselves
+    batches_count = 0
+    cursor_ranges = FriendshipService.iter_follower_cursor_ranges(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+    )
+    for start_cursor, end_cursor in cursor_ranges:
+        batch = FanoutJobService.create_batch(job, start_cursor, end_cursor)
+        batch_task.delay(batch.id)
+        batches_count += 1
+    FanoutJobService.set_batches_count(job, batches_count)
 
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
-    )
\ No newline at end of file
+        followers_count,
+        batches_count,
+    )
+
+@shared_task(time_limit=ONE_HOUR, **FANOUT_TASK_RETRY_OPTIONS)
+def backfill_newsfeeds_batch_task(batch_id):
+    from newsfeeds.services import NewsFeedService, FanoutJobService
+
+    batch = FanoutJobService.start_batch(batch_id)
+    if batch is None:
+        return 'batch {} is done already'.format(batch_id)
+
+    follower_ids = FriendshipService.get_follower_ids_in_range(
+        batch.job.tweet_user_id,
+        batch.start_cursor,
+        batch.end_cursor,
+    )
+    # read when the batch runs, tweets deleted since the job was created are
+    # not backfilled
+    tweets = NewsFeedService.get_recent_tweets(batch.job.tweet_user_id)
+    NewsFeedService.backfill_newsfeeds(follower_ids, tweets)
+
+    FanoutJobService.finish_batch(batch)
+    return '{} newsfeeds backfilled'.format(len(follower_ids) * len(tweets))
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def backfill_followed_user_tweets_task(from_user_id, to_user_id):
+    from newsfeeds.services import NewsFeedService
+
+    merged = NewsFeedService.merge_followed_user_tweets(from_user_id, to_user_id)
+    NewsFeedService.invalidate_first_pages([from_user_id])
+    return '{} tweets merged into newsfeeds'.format(merged)
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def purge_unfollowed_user_tweets_task(from_user_id, to_user_id):
+    from newsfeeds.services import NewsFeedService
+
+    deleted = NewsFeedService.remove_unfollowed_user_tweets(from_user_id, to_user_id)
+    NewsFeedService.invalidate_first_pages([from_user_id])
+    return '{} newsfeeds deleted'.format(deleted)
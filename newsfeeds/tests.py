@@ -1,9 +1,23 @@
-from newsfeeds.services import NewsFeedService
+from datetime import timedelta
+from django.core.management import call_command
+from io import StringIO
+from newsfeeds.services import FanoutJobService, NewsFeedService
 from testing.testcases import TestCase
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
-from newsfeeds.tasks import fanout_newsfeeds_main_task
-from newsfeeds.models import NewsFeed
+from newsfeeds.tasks import fanout_newsfeeds_main_task, fanout_newsfeeds_batch_task
+from newsfeeds.models import NewsFeed, FanoutJob, FanoutBatch
+from newsfeeds.constants import (
+    FANOUT_LAG_THRESHOLD,
+    FanoutMode,
+    FanoutStatus,
+    PULL_MODE_FOLLOWERS_THRESHOLD,
+)
+from friendships.models import Friendship
+from accounts.services import UserService
+from tweets.models import Tweet
+from tweets.services import TweetService
+from utils.time_helpers import utc_now
 
 class NewsFeedServiceTests(TestCase):
 
@@ -49,6 +63,72 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.kim.id)
         self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
 
+    def test_hydrate_newsfeeds(self):
+        tweets = [self.create_tweet(self.david) for i in range(3)]
+        for tweet in tweets:
+            self.create_newsfeed(self.kim, tweet)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.kim.id)
+
+        # misses are loaded in one query
+        with self.assertNumQueries(1):
+            newsfeeds = NewsFeedService.hydrate_newsfeeds(newsfeeds)
+        self.assertEqual(
+            [newsfeed.cached_tweet() for newsfeed in newsfeeds],
+            tweets[::-1],
+        )
+
+        # hits cost no query
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.kim.id)
+        with self.assertNumQueries(0):
+            newsfeeds = NewsFeedService.hydrate_newsfeeds(newsfeeds)
+            self.assertEqual(newsfeeds[0].cached_tweet().id, tweets[-1].id)
+
+    def test_backfill_newsfeeds(self):
+        tweets = [self.create_tweet(self.david) for i in range(2)]
+        pushed_newsfeed = self.create_newsfeed(self.kim, tweets[0])
+        NewsFeedService.backfill_newsfeeds([self.kim.id, self.david.id], tweets)
+
+        # backfilled newsfeeds take created_at of their tweets, existing ones
+        # are left as they are
+        newsfeeds = NewsFeed.objects.filter(user=self.kim).order_by('tweet_id')
+        self.assertEqual(newsfeeds[0].id, pushed_newsfeed.id)
+        self.assertEqual(newsfeeds[0].created_at, pushed_newsfeed.created_at)
+        self.assertEqual(newsfeeds[1].created_at, tweets[1].created_at)
+        newsfeeds = NewsFeed.objects.filter(user=self.david).order_by('tweet_id')
+        self.assertEqual([f.created_at for f in newsfeeds], [t.created_at for t in tweets])
+
+        # tweets deleted while backfilling get no newsfeeds
+        deleted_tweet = self.create_tweet(self.david)
+        Tweet.objects.filter(id=deleted_tweet.id).delete()
+        NewsFeedService.backfill_newsfeeds([self.kim.id], [deleted_tweet])
+        self.assertEqual(NewsFeed.objects.filter(tweet_id=deleted_tweet.id).count(), 0)
+        self.assertEqual(NewsFeed.objects.filter(user=self.kim).count(), 2)
+
+        # purging newsfeeds not in cache doesn't load them
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.kim.id)
+        self.assertEqual(NewsFeedService.remove_unfollowed_user_tweets(self.kim.id, self.david.id), 2)
+        self.assertEqual(RedisClient.get_connection(key).exists(key), False)
+
+    def test_push_newsfeeds_to_cache(self):
+        tweet = self.create_tweet(self.kim)
+        self.create_newsfeed(self.kim, tweet)
+        NewsFeedService.get_cached_newsfeeds(self.kim.id)
+
+        conn = RedisClient.get_connection()
+        kim_key = USER_NEWSFEEDS_PATTERN.format(user_id=self.kim.id)
+        david_key = USER_NEWSFEEDS_PATTERN.format(user_id=self.david.id)
+        self.assertEqual(conn.exists(david_key), False)
+
+        tweet = self.create_tweet(self.kim)
+        newsfeeds = [
+            NewsFeed(user_id=self.kim.id, tweet_id=tweet.id),
+            NewsFeed(user_id=self.david.id, tweet_id=tweet.id),
+        ]
+        # only lists in cache are pushed to
+        self.assertEqual(NewsFeedService.push_newsfeeds_to_cache(newsfeeds), 1)
+        self.assertEqual(conn.llen(kim_key), 2)
+        self.assertEqual(conn.exists(david_key), False)
+
 
 class NewsFeedTaskTests(TestCase):
 
@@ -88,3 +168,213 @@ class NewsFeedTaskTests(TestCase):
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.david.id)
         self.assertEqual(len(cached_list), 3)
+
+    def test_fanout_job(self):
+        for i in range(4):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.kim)
+        tweet = self.create_tweet(self.kim)
+        fanout_newsfeeds_main_task(tweet.id, self.kim.id)
+
+        job = FanoutJob.objects.get(tweet=tweet)
+        self.assertEqual(job.status, FanoutStatus.DONE)
+        self.assertEqual(job.batches_count, 2)
+        self.assertEqual(job.finished_batches_count, 2)
+        self.assertIsNotNone(job.delivery_seconds)
+
+        # fanout is not dispatched twice
+        msg = fanout_newsfeeds_main_task(tweet.id, self.kim.id)
+        self.assertEqual(msg, 'fanout of tweet {} is dispatched already.'.format(tweet.id))
+
+        # retrying a finished batch does nothing
+        batch = FanoutBatch.objects.filter(job=job).first()
+        msg = fanout_newsfeeds_batch_task(batch.id)
+        self.assertEqual(msg, 'batch {} is done already'.format(batch.id))
+
+        # retrying an unfinished batch ignores newsfeeds created already
+        FanoutBatch.objects.filter(id=batch.id).update(status=FanoutStatus.PENDING)
+        fanout_newsfeeds_batch_task(batch.id)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 5)
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, FanoutStatus.DONE)
+        self.assertEqual(batch.attempts, 2)
+
+    def test_fanout_batch_retry(self):
+        self.create_friendship(self.david, self.kim)
+        old_tweet = self.create_tweet(self.david)
+        self.create_newsfeed(self.david, old_tweet)
+        NewsFeedService.mark_newsfeeds_read(self.david.id)
+        NewsFeedService.get_cached_newsfeeds(self.david.id)
+        tweet = self.create_tweet(self.kim)
+        fanout_newsfeeds_main_task(tweet.id, self.kim.id)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.david.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id, old_tweet.id])
+
+        # a retry after the newsfeeds are pushed to cache doesn't push again
+        batch = FanoutBatch.objects.get(job__tweet=tweet)
+        FanoutBatch.objects.filter(id=batch.id).update(status=FanoutStatus.PENDING)
+        fanout_newsfeeds_batch_task(batch.id)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.david.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id, old_tweet.id])
+
+    def test_fanout_deleted_tweet(self):
+        self.create_friendship(self.david, self.kim)
+        tweet = self.create_tweet(self.kim)
+        tweet_id = tweet.id
+        tweet.delete()
+        msg = fanout_newsfeeds_main_task(tweet_id, self.kim.id)
+        self.assertEqual(msg, 'tweet {} is deleted, no fanout.'.format(tweet_id))
+        self.assertEqual(FanoutJobService.get_or_create_job(tweet_id, False, 1), (None, False))
+        self.assertEqual(FanoutJob.objects.count(), 0)
+        self.assertEqual(NewsFeed.objects.count(), 0)
+
+    def test_fanout_status_command(self):
+        out = StringIO()
+        call_command('fanout_status', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'No fanout in flight.')
+
+        tweet = self.create_tweet(self.kim)
+        job = FanoutJob.objects.create(
+            tweet=tweet,
+            tweet_user=self.kim,
+            tweet_created_at=utc_now() - timedelta(seconds=FANOUT_LAG_THRESHOLD + 60),
+            followers_count=4,
+        )
+        FanoutBatch.objects.create(job=job, attempts=2)
+        out = StringIO()
+        call_command('fanout_status', stdout=out)
+        lines = out.getvalue().strip().split('\n')
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split()[:5], [str(job.id), str(tweet.id), '4', '0/?', '1'])
+        self.assertEqual('LAGGING' in lines[1], True)
+
+        # fanouts within the lag threshold are not reported as lagging
+        out = StringIO()
+        call_command('fanout_status', lag=FANOUT_LAG_THRESHOLD * 2, stdout=out)
+        self.assertEqual('LAGGING' in out.getvalue(), False)
+
+    def test_benchmark_ref_serializers_command(self):
+        for i in range(3):
+            self.create_newsfeed(self.kim, self.create_tweet(self.david))
+        out = StringIO()
+        call_command('benchmark_ref_serializers', size=2, repeat=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual('TweetRefSerializer' in lines[2], True)
+        self.assertEqual('NewsFeedRefSerializer' in lines[4], True)
+        # entries of a list
+        self.assertEqual(lines[1].split()[2], '2')
+
+    def test_fanout_to_active_readers(self):
+        active_user = self.create_user('active')
+        dormant_user = self.create_user('dormant')
+        for user in [active_user, dormant_user]:
+            self.create_friendship(user, self.kim)
+            self.create_newsfeed(user, self.create_tweet(self.david))
+            NewsFeedService.get_cached_newsfeeds(user.id)
+        NewsFeedService.mark_newsfeeds_read(active_user.id)
+
+        tweet = self.create_tweet(self.kim)
+        fanout_newsfeeds_main_task(tweet.id, self.kim.id)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 3)
+
+        # pushed to active reader's cached newsfeeds
+        conn = RedisClient.get_connection()
+        active_key = USER_NEWSFEEDS_PATTERN.format(user_id=active_user.id)
+        self.assertEqual(conn.llen(active_key), 2)
+
+        # dormant reader's cached newsfeeds are rebuilt on next read
+        dormant_key = USER_NEWSFEEDS_PATTERN.format(user_id=dormant_user.id)
+        self.assertEqual(conn.exists(dormant_key), False)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(dormant_user.id)
+        self.assertEqual(newsfeeds[0].tweet_id, tweet.id)
+
+    def test_fanout_pull_mode(self):
+        self.create_friendship(self.david, self.kim)
+        for i in range(PULL_MODE_FOLLOWERS_THRESHOLD - 1):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.kim)
+
+        # kim switches to pull mode, only kim's own newsfeed is created
+        tweet1 = self.create_tweet(self.kim, 'tweet 1')
+        msg = fanout_newsfeeds_main_task(tweet1.id, self.kim.id)
+        self.assertEqual(msg, 'pull mode, no newsfeeds going to fanout.')
+        self.assertEqual(NewsFeed.objects.count(), 1)
+        profile = UserService.get_profile_through_cache(self.kim.id)
+        self.assertEqual(profile.fanout_mode, FanoutMode.PULL)
+        self.assertEqual(NewsFeedService.get_pull_mode_user_ids(), {self.kim.id})
+
+        # followers pull kim's tweets on read
+        newsfeeds = NewsFeedService.merge_pull_mode_tweets(
+            self.david.id,
+            NewsFeedService.get_cached_newsfeeds(self.david.id),
+        )
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet1.id])
+
+        # kim switches back to push mode, recent tweets are backfilled
+        Friendship.objects.filter(to_user=self.kim).exclude(from_user=self.david).delete()
+        tweet2 = self.create_tweet(self.kim, 'tweet 2')
+        msg = fanout_newsfeeds_main_task(tweet2.id, self.kim.id)
+        self.assertEqual(msg, '1 newsfeeds going to fanout, 1 batches created.')
+        self.assertEqual(NewsFeedService.get_pull_mode_user_ids(), set())
+        newsfeeds = NewsFeedService.merge_pull_mode_tweets(
+            self.david.id,
+            NewsFeedService.get_cached_newsfeeds(self.david.id),
+        )
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet2.id, tweet1.id])
+        self.assertEqual(newsfeeds[1].created_at, tweet1.created_at)
+
+    def test_merge_pull_mode_tweets_from_db(self):
+        lisa = self.create_user('lisa')
+        for user in [self.kim, lisa]:
+            self.create_friendship(self.david, user)
+            NewsFeedService.update_fanout_mode(user.id, PULL_MODE_FOLLOWERS_THRESHOLD)
+        self.assertEqual(NewsFeedService.get_pull_mode_user_ids(), {self.kim.id, lisa.id})
+        self.assertEqual(
+            NewsFeedService.get_followed_pull_mode_user_ids(self.david.id),
+            {self.kim.id, lisa.id},
+        )
+        self.assertEqual(NewsFeedService.get_followed_pull_mode_user_ids(self.kim.id), set())
+        kim_tweets = [self.create_tweet(self.kim) for i in range(2)]
+        lisa_tweets = [self.create_tweet(lisa) for i in range(2)]
+        newsfeed = self.create_newsfeed(self.david, self.create_tweet(self.david))
+
+        # cached tweets of all pull mode authors are read at once
+        tweets_of_users = TweetService.get_cached_tweets_of_users([self.kim.id, lisa.id])
+        self.assertEqual(
+            [t.id for t in tweets_of_users[self.kim.id]],
+            [t.id for t in kim_tweets[::-1]],
+        )
+        self.assertEqual(
+            [t.id for t in tweets_of_users[lisa.id]],
+            [t.id for t in lisa_tweets[::-1]],
+        )
+
+        # newsfeeds paginated from db get pulled tweets of the same range
+        newsfeeds, has_more = NewsFeedService.merge_pull_mode_tweets_from_db(
+            self.david.id,
+            [newsfeed],
+            count=3,
+        )
+        self.assertEqual(
+            [f.tweet_id for f in newsfeeds],
+            [newsfeed.tweet_id, lisa_tweets[1].id, lisa_tweets[0].id],
+        )
+        # pulled tweets are not saved as newsfeeds
+        self.assertEqual([f.id for f in newsfeeds], [newsfeed.id, None, None])
+        self.assertEqual(has_more, True)
+        newsfeeds, has_more = NewsFeedService.merge_pull_mode_tweets_from_db(
+            self.david.id,
+            [],
+            max_created_at=lisa_tweets[0].created_at,
+            count=3,
+        )
+        self.assertEqual(
+            [f.tweet_id for f in newsfeeds],
+            [kim_tweets[1].id, kim_tweets[0].id],
+        )
+        self.assertEqual(has_more, False)
+
+    def test_merge_pull_mode_tweets_from_db_with_sorted_sets(self):
+        with self.settings(REDIS_USE_SORTED_SETS=True):
+            self.test_merge_pull_mode_tweets_from_db()
@@ -1,4 +1,5 @@
 from django.test import TestCase as DjangoTestCase
+from django.test import TransactionTestCase as DjangoTransactionTestCase
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import ContentType
 from django.core.cache import caches
@@ -11,7 +12,7 @@ from utils.redis_client import RedisClient
 from friendships.models import Friendship
 
 
-class TestCase(DjangoTestCase):
+class TestCaseMixin:
     def clear_cache(self):
         # django test will roll back db but not cache
         caches['testing'].clear()
@@ -67,4 +68,14 @@ class TestCase(DjangoTestCase):
 
 
     def create_newsfeed(self, user, tweet):
-        return NewsFeed.objects.create(user=user, tweet=tweet)
\ No newline at end of file
+        return NewsFeed.objects.create(user=user, tweet=tweet)
+
+
+class TestCase(TestCaseMixin, DjangoTestCase):
+    pass
+
+
+class TransactionTestCase(TestCaseMixin, DjangoTransactionTestCase):
+    # on_commit callbacks never run in TestCase, which wraps every test in a
+    # transaction rolled back at the end
+    pass
\ No newline at end of file
@@ -1,5 +1,6 @@
 from accounts.api.serializers import UserSerializerForTweet
 from comments.api.serializers import CommentSerializer
+from django.contrib.auth.models import User
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
 from rest_framework import serializers
@@ -7,7 +8,9 @@ from rest_framework.exceptions import ValidationError
 from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet
 from tweets.services import TweetService
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class TweetSerializer(serializers.ModelSerializer):
@@ -30,13 +33,22 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch(cls, tweets):
+        MemcachedHelper.prefetch_objects(tweets, User, 'user_id', '_cached_user')
 
     def get_likes_count(self, obj):
-        # reverse filter
+        # prefetched for a whole page by TweetService.prefetch_counts
+        if hasattr(obj, '_cached_counts'):
+            return obj._cached_counts['likes_count']
         # N queries with cache is fine
         return RedisHelper.get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
+        if hasattr(obj, '_cached_counts'):
+            return obj._cached_counts['comments_count']
         return RedisHelper.get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj):
@@ -13,6 +13,9 @@ from utils.paginations import EndlessPagination
 from tweets.services import TweetService
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
+from django.conf import settings
+from django.http import Http404
+from utils.memcached_helper import MemcachedHelper
 
 class TweetViewSet(viewsets.GenericViewSet):
 
@@ -29,7 +32,12 @@ class TweetViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user_or_ip', rate='1/s', method='GET', block=True))
     def retrieve(self, request, *args, **kwargs):
-        tweet = self.get_object()
+        # read through cache, a dead id costs one memcached get
+        try:
+            tweet = MemcachedHelper.get_object_through_cache(Tweet, int(kwargs['pk']))
+        except (ValueError, Tweet.DoesNotExist):
+            raise Http404
+        self.check_object_permissions(request, tweet)
         return Response(TweetSerializerForDetail(
             tweet,
             context={'request':request,}
@@ -40,11 +48,25 @@ class TweetViewSet(viewsets.GenericViewSet):
     def list(self, request):
         # we want to create composite index with user_id and created_at
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        if settings.REDIS_USE_SORTED_SETS:
+            page = self.paginator.paginate_cached_sorted_set(
+                lambda *args: TweetService.get_cached_tweets_in_range(user_id, *args),
+                request,
+            )
+        else:
+            # one more tweet tells if there is a next page
+            cached_tweets = TweetService.get_cached_tweets_lazily(
+                user_id,
+                self.paginator.page_size + 1,
+            )
+            page = self.paginator.paginate_cached_list(cached_tweets, request)
         if page is None:
             queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
             page = self.paginate_queryset(queryset)
+        else:
+            # cached timelines only keep tweet references
+            page = TweetService.hydrate_tweets(page)
+        page = TweetService.prefetch_counts(list(page))
         serializer = TweetSerializer(
             page,
             context={'request': request},
@@ -4,4 +4,13 @@ def push_tweet_to_cache(sender, instance, created, **kwargs):
         return
 
     from tweets.services import TweetService
-    TweetService.push_tweet_to_cache(instance)
\ No newline at end of file
+    TweetService.push_tweet_to_cache(instance)
+
+
+def tweet_changed(sender, instance, **kwargs):
+    # a new tweet is on nobody's first page yet
+    if kwargs.get('created'):
+        return
+
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.invalidate_first_pages_showing_tweet(instance.id)
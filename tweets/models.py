@@ -6,7 +6,7 @@ from django.contrib.contenttypes.fields import ContentType
 from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
 from utils.memcached_helper import MemcachedHelper
 from utils.listeners import invalidate_object_cache
-from tweets.listeners import push_tweet_to_cache
+from tweets.listeners import push_tweet_to_cache, tweet_changed
 from django.db.models.signals import post_save, pre_delete
 
 
@@ -47,6 +47,9 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # prefetched for a whole list by MemcachedHelper.prefetch_objects
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
@@ -89,3 +92,5 @@ post_save.connect(invalidate_object_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
 
 post_save.connect(push_tweet_to_cache, sender=Tweet)
+post_save.connect(tweet_changed, sender=Tweet)
+pre_delete.connect(tweet_changed, sender=Tweet)
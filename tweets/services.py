@@ -1,6 +1,15 @@
+from django.conf import settings
 from tweets.models import TweetPhoto, Tweet
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import USER_TWEETS_PATTERN, USER_TWEETS_SORTED_SET_PATTERN
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
+from utils.redis_serializers import CompactModelSerializer
+
+
+class TweetRefSerializer(CompactModelSerializer):
+    # cached timelines only keep references, tweets are hydrated by page
+    model_class = Tweet
+    field_names = ('id', 'user_id', 'created_at')
 
 
 class TweetService(object):
@@ -20,13 +29,105 @@ class TweetService(object):
 
     @classmethod
     def get_cached_tweets(cls, user_id):
+        if settings.REDIS_USE_SORTED_SETS:
+            tweets, _ = cls.get_cached_tweets_in_range(user_id)
+            return tweets
+
         # queryset is lazy loading and not execute yet
         queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        return RedisHelper.load_objects(key, queryset, TweetRefSerializer)
+
+    @classmethod
+    def get_cached_tweets_lazily(cls, user_id, chunk_size):
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_objects_lazily(key, queryset, TweetRefSerializer, chunk_size)
+
+    @classmethod
+    def get_cached_tweets_in_range(
+        cls,
+        user_id,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+    ):
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_sorted_objects(
+            key,
+            queryset,
+            TweetRefSerializer,
+            max_created_at,
+            min_created_at,
+            count,
+        )
+
+    @classmethod
+    def get_cached_tweets_of_users(
+        cls,
+        user_ids,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+    ):
+        """
+        cached tweets of many users in one round trip per redis shard, the
+        range only applies to sorted sets, lists are read whole
+        :return: {user_id: tweets}
+        """
+        user_ids = list(user_ids)
+        querysets = [
+            Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+            for user_id in user_ids
+        ]
+        if settings.REDIS_USE_SORTED_SETS:
+            tweets_list = RedisHelper.load_sorted_objects_of_keys(
+                [USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user_id) for user_id in user_ids],
+                querysets,
+                TweetRefSerializer,
+                max_created_at,
+                min_created_at,
+                count,
+            )
+        else:
+            tweets_list = RedisHelper.load_objects_of_keys(
+                [USER_TWEETS_PATTERN.format(user_id=user_id) for user_id in user_ids],
+                querysets,
+                TweetRefSerializer,
+            )
+        return dict(zip(user_ids, tweets_list))
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
+        if settings.REDIS_USE_SORTED_SETS:
+            key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=tweet.user_id)
+            RedisHelper.push_sorted_object(key, tweet, queryset, TweetRefSerializer)
+            return
+
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, queryset)
\ No newline at end of file
+        RedisHelper.push_object(key, tweet, queryset, TweetRefSerializer)
+
+    @classmethod
+    def prefetch_counts(cls, tweets):
+        """
+        read counts of a page of tweets in one round trip to redis instead of
+        two per tweet, TweetSerializer reads them from the tweets
+        """
+        counts = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        for tweet in tweets:
+            # instance level cache
+            setattr(tweet, '_cached_counts', counts[tweet.id])
+        return tweets
+
+    @classmethod
+    def hydrate_tweets(cls, tweets):
+        """
+        replace tweet references from cached timelines by full tweets, in
+        one round trip to memcached
+        """
+        return MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [tweet.id for tweet in tweets],
+        )
\ No newline at end of file
@@ -0,0 +1,10 @@
+from celery import shared_task
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+
+
+@shared_task(routing_key='default', time_limit=60)
+def flush_tweet_counts_task():
+    # scheduled by CELERY_BEAT_SCHEDULE
+    flushed = RedisHelper.flush_counts(Tweet, ['likes_count', 'comments_count'])
+    return '{} tweets flushed'.format(flushed)
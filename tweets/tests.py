@@ -10,7 +10,12 @@ from utils.time_helpers import utc_now
 from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer
 from twitter.cache import USER_TWEETS_PATTERN
-from tweets.services import TweetService
+from tweets.services import TweetService, TweetRefSerializer
+from tweets.tasks import flush_tweet_counts_task
+from twitter.cache import DIRTY_COUNTS_PATTERN, FLUSHING_COUNTS_PATTERN
+from utils.redis_helper import RedisHelper
+import struct
+import time
 
 
 class TweetTests(TestCase):
@@ -61,6 +66,33 @@ class TweetTests(TestCase):
         cached_tweet = DjangoModelSerializer.deserialize(data)
         self.assertEqual(tweet, cached_tweet)
 
+    def test_tweet_ref_serializer(self):
+        serialized_data = TweetRefSerializer.serialize(self.tweet)
+        self.assertEqual(len(serialized_data), 26)
+        self.assertLess(
+            len(serialized_data),
+            len(DjangoModelSerializer.serialize(self.tweet)) // 5,
+        )
+        cached_tweet = TweetRefSerializer.deserialize(serialized_data)
+        self.assertEqual(cached_tweet.id, self.tweet.id)
+        self.assertEqual(cached_tweet.user_id, self.kim.id)
+        self.assertEqual(cached_tweet.created_at, self.tweet.created_at)
+        # fields not cached are loaded from db on access
+        self.assertEqual(cached_tweet.content, 'Hello world!')
+
+        # lists cached in the old format can still be read
+        serialized_data = DjangoModelSerializer.serialize(self.tweet).encode()
+        self.assertEqual(TweetRefSerializer.deserialize(serialized_data), self.tweet)
+
+        # data packed with another schema is not read into the wrong fields
+        serialized_data = TweetRefSerializer.serialize(self.tweet)
+        stale_data = (
+            struct.pack('>H', TweetRefSerializer.get_schema_version() ^ 1)
+            + serialized_data[2:]
+        )
+        self.assertEqual(TweetRefSerializer.deserialize(stale_data), None)
+        self.assertEqual(TweetRefSerializer.deserialize(serialized_data[2:]), None)
+
 
 class TweetServiceTests(TestCase):
 
@@ -104,3 +136,110 @@ class TweetServiceTests(TestCase):
 
         tweets = TweetService.get_cached_tweets(self.kim.id)
         self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    def test_get_cached_tweets_in_range(self):
+        tweets = [self.create_tweet(self.kim, 'tweet {}'.format(i)) for i in range(5)]
+        tweets = tweets[::-1]
+
+        with self.settings(REDIS_USE_SORTED_SETS=True):
+            RedisClient.clear()
+            # cache miss
+            cached_tweets, cached_count = TweetService.get_cached_tweets_in_range(
+                self.kim.id,
+                count=2,
+            )
+            self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[:2]])
+            self.assertEqual(cached_count, 5)
+
+            # cache hit, exclusive bounds
+            cached_tweets, _ = TweetService.get_cached_tweets_in_range(
+                self.kim.id,
+                max_created_at=tweets[1].created_at,
+                min_created_at=tweets[4].created_at,
+            )
+            self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[2:4]])
+
+            # cache updated
+            new_tweet = self.create_tweet(self.kim, 'new tweet')
+            cached_tweets = TweetService.get_cached_tweets(self.kim.id)
+            self.assertEqual(cached_tweets[0].id, new_tweet.id)
+            self.assertEqual(len(cached_tweets), 6)
+
+    def test_flush_tweet_counts(self):
+        conn = RedisClient.get_connection()
+        david = self.create_user('david')
+        with self.settings(TWEET_COUNTS_WRITE_BEHIND=True):
+            self.create_like(self.kim, self.tweet)
+            self.create_like(david, self.tweet)
+            self.create_comment(david, self.tweet)
+
+        # counts are in cache only
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(self.tweet.comments_count, 0)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'comments_count'), 1)
+
+        flush_tweet_counts_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(conn.exists(DIRTY_COUNTS_PATTERN.format(model='Tweet')), 0)
+
+        # a flush interrupted before it is done is done again
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=0)
+        conn.sadd(FLUSHING_COUNTS_PATTERN.format(model='Tweet'), self.tweet.id)
+        self.assertEqual(flush_tweet_counts_task(), '1 tweets flushed')
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+        self.assertEqual(flush_tweet_counts_task(), '0 tweets flushed')
+
+    def test_flush_expiring_tweet_counts(self):
+        conn = RedisClient.get_connection()
+        david = self.create_user('david')
+        key = RedisHelper.get_count_key(self.tweet, 'likes_count')
+        with self.settings(REDIS_KEY_EXPIRE_TIME=1):
+            # cached with a ttl by a like written to db
+            self.create_like(self.kim, self.tweet)
+            self.assertEqual(conn.ttl(key) > 0, True)
+            # dirty counts outlive their ttl until they are flushed
+            with self.settings(TWEET_COUNTS_WRITE_BEHIND=True):
+                self.create_like(david, self.tweet)
+            self.assertEqual(conn.ttl(key), -1)
+            time.sleep(1.5)
+            self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 2)
+
+            flush_tweet_counts_task()
+            self.tweet.refresh_from_db()
+            self.assertEqual(self.tweet.likes_count, 2)
+            # flushed counts expire again
+            self.assertEqual(conn.ttl(key) > 0, True)
+
+    def test_prefetch_counts(self):
+        tweets = [self.create_tweet(self.kim) for i in range(3)]
+        Tweet.objects.filter(id=tweets[0].id).update(likes_count=2, comments_count=1)
+
+        # counts missing in cache are read in one query
+        with self.assertNumQueries(1):
+            TweetService.prefetch_counts(tweets)
+        self.assertEqual(tweets[0]._cached_counts, {
+            'likes_count': 2,
+            'comments_count': 1,
+        })
+        self.assertEqual(tweets[1]._cached_counts['likes_count'], 0)
+
+        # and then from cache only
+        RedisHelper.incr_count(tweets[0], 'likes_count')
+        with self.assertNumQueries(0):
+            TweetService.prefetch_counts(tweets)
+        self.assertEqual(tweets[0]._cached_counts['likes_count'], 3)
+        self.assertEqual(TweetService.prefetch_counts([]), [])
+
+        # tweets deleted from db meanwhile count nothing
+        Tweet.objects.filter(id=tweets[2].id).delete()
+        RedisClient.clear()
+        TweetService.prefetch_counts(tweets)
+        self.assertEqual(tweets[2]._cached_counts, {
+            'likes_count': 0,
+            'comments_count': 0,
+        })
@@ -1,8 +1,106 @@
+from utils.redis_client import RedisClient
+import time
+
+# generation of each key namespace lives in redis and is kept in process for a
+# short while, a bumped generation reaches every process within this time
+CACHE_GENERATIONS_KEY = 'cache_generations'
+CACHE_GENERATIONS_LOCAL_TTL = 10
+
+# namespace: (generation, monotonic time read)
+_generations = {}
+
+
+def _seed_generation(conn, namespace):
+    # a namespace missing in redis, new or lost along with the hash, starts
+    # from the current time in milliseconds rather than from 1, so it never
+    # goes back to a former generation whose keys may still be in memcached
+    conn.hsetnx(CACHE_GENERATIONS_KEY, namespace, int(time.time() * 1000))
+
+
+def get_generation(namespace):
+    generation, read_at = _generations.get(namespace, (None, None))
+    if generation is not None and time.monotonic() - read_at < CACHE_GENERATIONS_LOCAL_TTL:
+        return generation
+
+    conn = RedisClient.get_connection()
+    generation = conn.hget(CACHE_GENERATIONS_KEY, namespace)
+    if generation is None:
+        _seed_generation(conn, namespace)
+        generation = conn.hget(CACHE_GENERATIONS_KEY, namespace)
+    generation = int(generation)
+    _generations[namespace] = (generation, time.monotonic())
+    return generation
+
+
+def bump_generation(namespace):
+    """
+    move all keys of a namespace, e.g. 'user_tweets', to new keys at once.
+    Keys of former generations are never read again and left to expire,
+    instead of being flushed.
+    """
+    conn = RedisClient.get_connection()
+    _seed_generation(conn, namespace)
+    generation = conn.hincrby(CACHE_GENERATIONS_KEY, namespace, 1)
+    _generations[namespace] = (generation, time.monotonic())
+    return generation
+
+
+def clear_local_generations():
+    # only use for unit test, once redis is flushed
+    _generations.clear()
+
+
+class VersionedKeyPattern(str):
+    """
+    A key pattern whose keys carry the generation of their namespace, the
+    part before the first colon, e.g. 'user_tweets:v3:1'.
+
+    Generations live in redis, so formatting a key, memcached ones included,
+    costs a redis round trip once per namespace every
+    CACHE_GENERATIONS_LOCAL_TTL seconds in each process, and fails while
+    redis is down.
+    """
+
+    def format(self, *args, **kwargs):
+        key = super().format(*args, **kwargs)
+        namespace, _, rest = key.partition(':')
+        return '{}:v{}:{}'.format(namespace, get_generation(namespace), rest)
+
+
 # memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
-USER_PATTERN = 'user:{user_id}'
-USER_PROFILE_PATTERN = 'userprofile:{user_id}'
+MODEL_OBJECT_PATTERN = VersionedKeyPattern('{model}:{object_id}')
+USER_PATTERN = VersionedKeyPattern('user:{user_id}')
+USER_PROFILE_PATTERN = VersionedKeyPattern('userprofile:{user_id}')
+PULL_MODE_USER_IDS_KEY = 'pull_mode_user_ids'
+# held by the one reader refreshing an entry, see MemcachedHelper.get_entry_value
+CACHE_REFRESH_LOCK_PATTERN = 'refresh_lock:{key}'
 
 # redis
-USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
\ No newline at end of file
+# keys of objects dropped from local caches of all processes, see MemcachedHelper
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'local_cache_invalidations'
+USER_TWEETS_PATTERN = VersionedKeyPattern('user_tweets:{user_id}')
+USER_NEWSFEEDS_PATTERN = VersionedKeyPattern('user_newsfeeds:{user_id}')
+USER_TWEETS_SORTED_SET_PATTERN = VersionedKeyPattern('user_tweets_zset:{user_id}')
+USER_NEWSFEEDS_SORTED_SET_PATTERN = VersionedKeyPattern('user_newsfeeds_zset:{user_id}')
+# ids of objects with counts not written to db yet, and the ones being written
+DIRTY_COUNTS_PATTERN = 'dirty_counts:{model}'
+FLUSHING_COUNTS_PATTERN = 'flushing_counts:{model}'
+CACHE_REBUILD_LOCK_PATTERN = 'rebuild_lock:{key}'
+CACHE_REBUILD_STATS_KEY = 'cache_rebuild_stats'
+# versions of entries in memcached and the lock of their writers, see
+# MemcachedHelper.write_through
+CACHE_VERSION_PATTERN = 'cache_version:{key}'
+CACHE_WRITE_LOCK_PATTERN = 'write_lock:{key}'
+NEWSFEEDS_LAST_READ_PATTERN = 'newsfeeds_last_read:{user_id}'
+NEWSFEEDS_FIRST_PAGE_PATTERN = VersionedKeyPattern('newsfeeds_first_page:{user_id}')
+# bumped on every invalidation of the first page of a user, see
+# NewsFeedService.cache_first_page
+NEWSFEEDS_FIRST_PAGE_VERSION_PATTERN = 'newsfeeds_first_page_version:{user_id}'
+# ids of users whose cached first page shows the tweet or the author
+FIRST_PAGE_READERS_BY_TWEET_PATTERN = 'first_page_readers:tweet:{tweet_id}'
+FIRST_PAGE_READERS_BY_USER_PATTERN = 'first_page_readers:user:{user_id}'
+# ids of the followers and the followed users of a user
+FOLLOWERS_SET_PATTERN = VersionedKeyPattern('followers_set:{user_id}')
+FOLLOWINGS_SET_PATTERN = VersionedKeyPattern('followings_set:{user_id}')
+# bumped on every change of a cached id set, see RedisHelper._load_id_set
+ID_SET_CHANGES_PATTERN = 'id_set_changes:{key}'
@@ -186,15 +186,78 @@ CACHES = {
     },
 }
 
+# entries read through MemcachedHelper and UserService expire at a random
+# point in the last CACHE_TIMEOUT_JITTER of CACHE_TIMEOUT, so keys written
+# together don't expire together. Readers refresh an entry early with a
+# probability growing as it gets close to expiry, and an expired entry is
+# still served for CACHE_STALE_TIMEOUT while one worker refreshes it.
+CACHE_TIMEOUT = 86400
+CACHE_TIMEOUT_JITTER = 0.1
+CACHE_STALE_TIMEOUT = 60 * 60
+CACHE_EARLY_REFRESH_BETA = 1.0
+CACHE_REFRESH_LOCK_TIMEOUT = 30
+# ids confirmed missing in db are cached as well, shortly as objects can be
+# created without a post_save dropping them, e.g. through bulk_create
+CACHE_TOMBSTONE_TIMEOUT = 60
+# saved objects and profiles are written to memcached once committed rather
+# than deleted, entries of older versions never replace newer ones. Cached
+# follower and following id sets get the follow added or removed on commit.
+CACHE_WRITE_THROUGH = not TESTING
+CACHE_WRITE_LOCK_TIMEOUT = 1
+
+# objects read through memcached are kept in process as well, invalidations
+# are broadcast to all processes over redis pub/sub. Entries expire anyway,
+# which bounds staleness of an invalidation missed while disconnected.
+LOCAL_CACHE_ENABLE = not TESTING
+LOCAL_CACHE_MAX_SIZE = 10000
+LOCAL_CACHE_TIMEOUT = 60
+
 # Redis
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# cached feeds and timelines are spread over shards by consistent hashing,
+# other keys live in the first shard. Keys moved by adding a shard are
+# rebuilt from db on next read.
+REDIS_SHARDS = [
+    {'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB},
+]
+# per shard and per process
+REDIS_MAX_CONNECTIONS = 100
+REDIS_SOCKET_TIMEOUT = 0.5
+REDIS_SOCKET_CONNECT_TIMEOUT = 0.5
+# a command timing out is retried once
+REDIS_RETRY_ON_TIMEOUT = True
+# idle connections are pinged before use after this many seconds
+REDIS_HEALTH_CHECK_INTERVAL = 30
 REDIS_KEY_EXPIRE_TIME = 7 * 86400
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
+# cache newsfeeds and user tweets in sorted sets scored by created_at instead
+# of lists, so that a page is read by one ZREVRANGEBYSCORE. Sorted sets use
+# their own keys, clear them before switching back to sorted sets within
+# REDIS_KEY_EXPIRE_TIME as they are not updated while lists are used.
+REDIS_USE_SORTED_SETS = False
+# a cached list missing in redis is rebuilt from db by one caller at a time,
+# others wait this long for it before reading db without writing to cache
+REDIS_REBUILD_LOCK_TIMEOUT = 10
+REDIS_REBUILD_WAIT_TIME = 0.2
+
+# Newsfeeds
+# authors with at least this many followers skip fanout on write, their tweets
+# are pulled and merged into followers' newsfeeds on read
+NEWSFEED_PULL_MODE_FOLLOWERS_THRESHOLD = 10000 if not TESTING else 10
+# serve the first page of newsfeeds from a rendered and gzipped copy in redis
+NEWSFEED_FIRST_PAGE_CACHE_ENABLE = not TESTING
+
+# Tweets
+# likes and comments only update counts in redis, counts are written to db
+# every TWEET_COUNTS_FLUSH_INTERVAL seconds by tweets.tasks.flush_tweet_counts_task
+TWEET_COUNTS_WRITE_BEHIND = not TESTING
+TWEET_COUNTS_FLUSH_INTERVAL = 10
 
 # Celery
 # run worker: celery -A twitter worker -l INFO
+# run beat for periodic tasks: celery -A twitter beat -l INFO
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/2' if not TESTING else 'redis://127.0.0.1:6379/0'
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_ALWAYS_EAGER = TESTING
@@ -204,6 +267,12 @@ CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
 )
+CELERY_BEAT_SCHEDULE = {
+    'flush-tweet-counts': {
+        'task': 'tweets.tasks.flush_tweet_counts_task',
+        'schedule': TWEET_COUNTS_FLUSH_INTERVAL,
+    },
+}
 
 # rate limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -1,3 +1,16 @@
+from django.conf import settings
+from django.db import transaction
+
+
 def invalidate_object_cache(sender, instance, **kwargs):
     from utils.memcached_helper import MemcachedHelper
+
+    if settings.CACHE_WRITE_THROUGH:
+        # written once readers can see the change in db, a deleted object
+        # leaves a tombstone
+        object_id = instance.id
+        transaction.on_commit(
+            lambda: MemcachedHelper.write_through_object(sender, object_id),
+        )
+        return
     MemcachedHelper.invalidate_cached_object(sender, instance.id)
\ No newline at end of file
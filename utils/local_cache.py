@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from redis.exceptions import RedisError
+from utils.redis_client import RedisClient
+import logging
+import os
+import pickle
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    A bounded in-process cache, least recently used entries are evicted
+    first and entries expire after timeout seconds. Values are kept pickled
+    so that callers never share instances across requests.
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key: (pickled value, expire at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return pickle.loads(entry[0])
+
+    def set(self, key, value):
+        entry = (pickle.dumps(value), time.monotonic() + self.timeout)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class LocalCacheSubscriber:
+    """
+    Drops entries of a local cache invalidated by any process. Every process
+    runs one daemon thread listening to the invalidation channel, started on
+    first use, also in forked celery children.
+    """
+    POLL_TIMEOUT = 1
+    RECONNECT_INTERVAL = 1
+
+    def __init__(self, local_cache, channel):
+        self.local_cache = local_cache
+        self.channel = channel
+        self.pid = None
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        # entries copied from the parent process missed its invalidations
+        self.local_cache.clear()
+        thread = threading.Thread(target=self._listen, daemon=True)
+        thread.start()
+
+    def publish(self, key):
+        RedisClient.get_connection().publish(self.channel, key)
+
+    def handle_message(self, message):
+        if message and message['type'] == 'message':
+            self.local_cache.delete(message['data'].decode())
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = RedisClient.get_connection().pubsub()
+                pubsub.subscribe(self.channel)
+                while True:
+                    self.handle_message(pubsub.get_message(timeout=self.POLL_TIMEOUT))
+            except RedisError:
+                logger.exception('local cache subscriber disconnected')
+                # invalidations may be missed while disconnected
+                self.local_cache.clear()
+                time.sleep(self.RECONNECT_INTERVAL)
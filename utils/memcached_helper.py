@@ -1,29 +1,411 @@
+from collections import namedtuple
 from django.conf import settings
 from django.core.cache import caches
+from twitter.cache import (
+    CACHE_REFRESH_LOCK_PATTERN,
+    CACHE_WRITE_LOCK_PATTERN,
+    LOCAL_CACHE_INVALIDATION_CHANNEL,
+    MODEL_OBJECT_PATTERN,
+)
+from utils.local_cache import LocalCache, LocalCacheSubscriber
+from utils.redis_client import RedisClient
+from utils.redis_helper import RELEASE_LOCK_SCRIPT, RedisHelper
+from utils.tasks import refresh_cached_object_task
+import math
+import pickle
+import random
+import time
+import uuid
+import zlib
 
 cache = caches['testing'] if settings.TESTING else caches['default']
+WRITE_LOCK_POLL_INTERVAL = 0.005
+# well below the 1mb item limit of memcached, keys and flags take some room
+LARGE_VALUE_CHUNK_SIZE = 512 * 1024
+# compute_time is how long loading the value took in seconds, expire_at is
+# when the value is due for refresh, memcached keeps it a while longer.
+# version goes up on every save, see MemcachedHelper.write_through
+CacheEntry = namedtuple(
+    'CacheEntry',
+    ['value', 'compute_time', 'expire_at', 'version'],
+    defaults=(0,),
+)
+# stored under the key of a large value, payloads fitting in one chunk are
+# inlined as data, otherwise chunks are stored under keys made of token
+LargeValueManifest = namedtuple(
+    'LargeValueManifest',
+    ['token', 'chunks_count', 'size', 'checksum', 'data'],
+)
+# in front of memcached for hot objects, e.g. authors of tweets on a page
+local_cache = LocalCache(settings.LOCAL_CACHE_MAX_SIZE, settings.LOCAL_CACHE_TIMEOUT)
+local_cache_subscriber = LocalCacheSubscriber(local_cache, LOCAL_CACHE_INVALIDATION_CHANNEL)
+
+
+class Tombstone:
+    """
+    cached in place of an object confirmed missing in db, so that reads of
+    dead ids don't query db every time. Saving the object replaces it.
+    """
+
 
 class MemcachedHelper:
 
     @classmethod
     def get_key(cls, model_class, object_id):
-        return '{}:{}'.format(model_class.__name__, object_id)
+        return MODEL_OBJECT_PATTERN.format(
+            model=model_class.__name__,
+            object_id=object_id,
+        )
+
+    @classmethod
+    def _get_local(cls, key):
+        if not settings.LOCAL_CACHE_ENABLE:
+            return None
+        local_cache_subscriber.ensure_started()
+        return local_cache.get(key)
+
+    @classmethod
+    def _set_local(cls, key, obj):
+        if settings.LOCAL_CACHE_ENABLE:
+            local_cache.set(key, obj)
+
+    @classmethod
+    def get_local_cache_stats(cls):
+        return local_cache.get_stats()
+
+    @classmethod
+    def _make_entry(cls, value, compute_time, version=0):
+        if isinstance(value, Tombstone):
+            timeout = settings.CACHE_TOMBSTONE_TIMEOUT
+        else:
+            timeout = settings.CACHE_TIMEOUT * (
+                1 - settings.CACHE_TIMEOUT_JITTER * random.random()
+            )
+        return CacheEntry(value, compute_time, time.time() + timeout, version)
+
+    @classmethod
+    def _get_entry_timeout(cls, entry):
+        if isinstance(entry.value, Tombstone):
+            return settings.CACHE_TOMBSTONE_TIMEOUT
+        # memcached keeps entries past expire_at to serve them stale
+        return settings.CACHE_TIMEOUT + settings.CACHE_STALE_TIMEOUT
+
+    @classmethod
+    def add_entry(cls, key, value, compute_time):
+        """
+        for values read from db on a miss, an entry written meanwhile, e.g. on
+        save, is newer and is kept
+        """
+        entry = cls._make_entry(value, compute_time)
+        cache.add(key, entry, timeout=cls._get_entry_timeout(entry))
+
+    @classmethod
+    def _set_entry_if_newer(cls, key, entry):
+        """
+        entries are compared and set one writer at a time, so an entry of an
+        older version never replaces a newer one
+        """
+        conn = RedisClient.get_connection(key)
+        lock_key = CACHE_WRITE_LOCK_PATTERN.format(key=key)
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + settings.CACHE_WRITE_LOCK_TIMEOUT
+        while not conn.set(
+            lock_key,
+            token,
+            nx=True,
+            px=int(settings.CACHE_WRITE_LOCK_TIMEOUT * 1000),
+        ):
+            if time.monotonic() > deadline:
+                # hardly ever happens, a missing entry is never stale at least
+                cache.delete(key)
+                return False
+            time.sleep(WRITE_LOCK_POLL_INTERVAL)
+
+        try:
+            current_entry = cache.get(key)
+            if isinstance(current_entry, CacheEntry) and current_entry.version > entry.version:
+                return False
+            cache.set(key, entry, timeout=cls._get_entry_timeout(entry))
+            return True
+        finally:
+            conn.register_script(RELEASE_LOCK_SCRIPT)(keys=[lock_key], args=[token])
+
+    @classmethod
+    def get_entry_value(cls, key, entry, refresh):
+        """
+        returns the cached value even if it is stale. Entries close to expiry
+        are refreshed early with a growing probability (XFetch), the reader
+        taking the refresh lock calls refresh, e.g. to enqueue a task
+        """
+        if not isinstance(entry, CacheEntry):
+            # None on miss, or cached before entries were introduced
+            return entry
+
+        # values slow to load are refreshed earlier
+        early = -entry.compute_time * settings.CACHE_EARLY_REFRESH_BETA * math.log(
+            1 - random.random()
+        )
+        if time.time() + early >= entry.expire_at:
+            lock_key = CACHE_REFRESH_LOCK_PATTERN.format(key=key)
+            if cache.add(lock_key, 1, timeout=settings.CACHE_REFRESH_LOCK_TIMEOUT):
+                refresh()
+        return entry.value
+
+    @classmethod
+    def refresh_entry(cls, key, load, version=None):
+        """
+        load the value again and write it unless a newer one is cached, values
+        missing in db are cached as tombstones
+        """
+        if version is None:
+            # read before the value, a save committed after bumps the version.
+            # The version key may expire before the entry, whose version is
+            # then the latest one, refreshes would be rejected forever below it
+            current_entry = cache.get(key)
+            version = max(
+                RedisHelper.get_cache_version(key),
+                current_entry.version if isinstance(current_entry, CacheEntry) else 0,
+            )
+        started_at = time.time()
+        value = load()
+        compute_time = time.time() - started_at
+        entry = cls._make_entry(
+            Tombstone() if value is None else value,
+            compute_time,
+            version,
+        )
+        cls._set_entry_if_newer(key, entry)
+        cache.delete(CACHE_REFRESH_LOCK_PATTERN.format(key=key))
+        return value
+
+    @classmethod
+    def write_through(cls, key, load):
+        """
+        called once a change is committed instead of deleting the entry,
+        readers keep hitting the cache rather than all going to db at once
+        """
+        value = cls.refresh_entry(key, load, RedisHelper.next_cache_version(key))
+        if settings.LOCAL_CACHE_ENABLE:
+            local_cache.delete(key)
+            local_cache_subscriber.publish(key)
+        return value
+
+    @classmethod
+    def write_through_object(cls, model_class, object_id):
+        return cls.write_through(
+            cls.get_key(model_class, object_id),
+            lambda: model_class.objects.filter(id=object_id).first(),
+        )
+
+    @classmethod
+    def refresh_object(cls, model_class, object_id):
+        return cls.refresh_entry(
+            cls.get_key(model_class, object_id),
+            lambda: model_class.objects.filter(id=object_id).first(),
+        )
+
+    @classmethod
+    def _refresh_later(cls, model_class, object_id):
+        refresh_cached_object_task.delay(model_class._meta.label, object_id)
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        # cache hit
-        obj = cache.get(key)
+        obj = cls._get_local(key)
         if obj:
             return obj
 
+        # cache hit, stale ones are served while refreshed in background
+        obj = cls.get_entry_value(
+            key,
+            cache.get(key),
+            lambda: cls._refresh_later(model_class, object_id),
+        )
+        if isinstance(obj, Tombstone):
+            raise model_class.DoesNotExist(
+                '{} {} does not exist'.format(model_class.__name__, object_id),
+            )
+        if obj:
+            cls._set_local(key, obj)
+            return obj
+
         # cache miss
-        obj = model_class.objects.get(id=object_id)
-        # using default expire time
-        cache.set(key, obj)
+        started_at = time.time()
+        try:
+            obj = model_class.objects.get(id=object_id)
+        except model_class.DoesNotExist:
+            cls.add_entry(key, Tombstone(), time.time() - started_at)
+            raise
+        cls.add_entry(key, obj, time.time() - started_at)
+        cls._set_local(key, obj)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        one get_many for all objects missing in local cache, one query and
+        one set_many for the misses, objects are returned in the order of
+        object_ids, missing ones skipped and cached as tombstones
+        """
+        keys = [cls.get_key(model_class, object_id) for object_id in object_ids]
+        cached_objects = {}
+        for key in keys:
+            obj = cls._get_local(key)
+            if obj:
+                cached_objects[key] = obj
+
+        remote_keys = [
+            (object_id, key)
+            for object_id, key in zip(object_ids, keys)
+            if key not in cached_objects
+        ]
+        tombstone_keys = set()
+        if remote_keys:
+            entries = cache.get_many([key for _, key in remote_keys])
+            for object_id, key in remote_keys:
+                obj = cls.get_entry_value(
+                    key,
+                    entries.get(key),
+                    lambda: cls._refresh_later(model_class, object_id),
+                )
+                if isinstance(obj, Tombstone):
+                    tombstone_keys.add(key)
+                elif obj:
+                    cls._set_local(key, obj)
+                    cached_objects[key] = obj
+
+        missing_keys = {
+            object_id: key
+            for object_id, key in zip(object_ids, keys)
+            if not cached_objects.get(key) and key not in tombstone_keys
+        }
+        missing_ids = list(missing_keys)
+        if missing_ids:
+            # read before the objects, a save committed after bumps them
+            missing_key_list = list(missing_keys.values())
+            versions = RedisHelper.get_cache_versions(missing_key_list)
+            started_at = time.time()
+            missing_objects = list(model_class.objects.filter(id__in=missing_ids))
+            compute_time = (time.time() - started_at) / max(len(missing_objects), 1)
+            for obj in missing_objects:
+                key = cls.get_key(model_class, obj.id)
+                cached_objects[key] = obj
+                cls._set_local(key, obj)
+            # memcached has no batched add, the misses are set at once and
+            # entries of a save committed meanwhile, which the set may have
+            # replaced, are dropped once their version is seen bumped below
+            entries_by_timeout = {}
+            for key, version in zip(missing_key_list, versions):
+                entry = cls._make_entry(
+                    cached_objects.get(key) or Tombstone(),
+                    compute_time,
+                    version,
+                )
+                entries_by_timeout.setdefault(
+                    cls._get_entry_timeout(entry),
+                    {},
+                )[key] = entry
+            for timeout, entries in entries_by_timeout.items():
+                cache.set_many(entries, timeout=timeout)
+            changed_keys = [
+                key
+                for key, version, current_version in zip(
+                    missing_key_list,
+                    versions,
+                    RedisHelper.get_cache_versions(missing_key_list),
+                )
+                if current_version != version
+            ]
+            if changed_keys:
+                cache.delete_many(changed_keys)
+
+        return [cached_objects[key] for key in keys if cached_objects.get(key)]
+
+    @classmethod
+    def prefetch_objects(cls, objects, model_class, id_attname, cached_attname):
+        """
+        fetch the model_class objects referenced by id_attname of objects in
+        one get_objects_through_cache, e.g. authors of a page of tweets, and
+        keep each on its object as cached_attname
+        """
+        objects = list(objects)
+        object_ids = list(dict.fromkeys(
+            getattr(obj, id_attname)
+            for obj in objects
+            if getattr(obj, id_attname) is not None
+        ))
+        fetched_objects = {
+            fetched_object.id: fetched_object
+            for fetched_object in cls.get_objects_through_cache(model_class, object_ids)
+        }
+        for obj in objects:
+            # instance level cache
+            setattr(obj, cached_attname, fetched_objects.get(getattr(obj, id_attname)))
+        return objects
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+        if settings.LOCAL_CACHE_ENABLE:
+            # every process drops its own copy
+            local_cache.delete(key)
+            local_cache_subscriber.publish(key)
+
+    @classmethod
+    def _get_chunk_key(cls, key, token, index):
+        return '{}:chunk:{}:{}'.format(key, token, index)
+
+    @classmethod
+    def set_large_value(cls, key, value, timeout=None):
+        """
+        values of any size are pickled, compressed and split into chunks
+        written before their manifest. Each write has its own chunk keys, so
+        readers never mix chunks of two writes.
+        No cache path needs it since id sets of users moved to redis, it is
+        kept for values that can go past the item limit of memcached.
+        """
+        if timeout is None:
+            timeout = settings.CACHE_TIMEOUT
+        payload = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        checksum = zlib.crc32(payload)
+        if len(payload) <= LARGE_VALUE_CHUNK_SIZE:
+            manifest = LargeValueManifest(None, 0, len(payload), checksum, payload)
+            return cache.set(key, manifest, timeout=timeout)
+
+        token = uuid.uuid4().hex[:12]
+        chunks = {
+            cls._get_chunk_key(key, token, index): payload[start: start + LARGE_VALUE_CHUNK_SIZE]
+            for index, start in enumerate(range(0, len(payload), LARGE_VALUE_CHUNK_SIZE))
+        }
+        # chunks outlive their manifest, the ones of older writes just expire
+        failed_keys = cache.set_many(chunks, timeout=timeout + 60)
+        if failed_keys:
+            return False
+        manifest = LargeValueManifest(token, len(chunks), len(payload), checksum, None)
+        return cache.set(key, manifest, timeout=timeout)
+
+    @classmethod
+    def get_large_value(cls, key):
+        """
+        None on miss, also when a chunk is evicted or doesn't match the
+        manifest, the value is loaded and written again then
+        """
+        manifest = cache.get(key)
+        if not isinstance(manifest, LargeValueManifest):
+            return None
+
+        if manifest.chunks_count == 0:
+            payload = manifest.data
+        else:
+            chunk_keys = [
+                cls._get_chunk_key(key, manifest.token, index)
+                for index in range(manifest.chunks_count)
+            ]
+            chunks = cache.get_many(chunk_keys)
+            if len(chunks) != manifest.chunks_count:
+                return None
+            payload = b''.join(chunks[chunk_key] for chunk_key in chunk_keys)
+        if len(payload) != manifest.size or zlib.crc32(payload) != manifest.checksum:
+            return None
+        return pickle.loads(zlib.decompress(payload))
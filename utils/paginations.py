@@ -1,19 +1,87 @@
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
 from dateutil import parser
 from django.conf import settings
+from django.db.models import Q
+import base64
+import binascii
+import json
 
 
 class FriendshipPagination(PageNumberPagination):
+    """
+    Pages by number by default. Clients opt in to paging by an opaque
+    cursor with paginate=cursor or a cursor param, the cursor is made of
+    (created_at, id) of the last friendship on the page, which seeks on the
+    index rather than scanning an offset. The total comes from
+    view.get_total_results() on the first page and is carried along in the
+    cursor, there is no count query per page.
+    """
     # default page size
     page_size = 20
 
     page_size_query_param = 'size'
     # max page size allowed for client request
     max_page_size = 20
+    cursor_query_param = 'cursor'
+    mode_query_param = 'paginate'
+
+    def _is_cursor_mode(self, request):
+        if self.cursor_query_param in request.query_params:
+            return True
+        return request.query_params.get(self.mode_query_param) == 'cursor'
+
+    def _encode_cursor(self, friendship, total_results):
+        data = [friendship.created_at.isoformat(), friendship.id, total_results]
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+    def _decode_cursor(self, cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            created_at, friendship_id, total_results = data
+            created_at, friendship_id = parser.isoparse(created_at), int(friendship_id)
+        except (binascii.Error, TypeError, ValueError):
+            raise NotFound('Invalid cursor')
+        # total_results goes back to the client as is, bool is an int too
+        if type(total_results) is not int or total_results < 0:
+            raise NotFound('Invalid cursor')
+        return created_at, friendship_id, total_results
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self._is_cursor_mode(request):
+            return super().paginate_queryset(queryset, request, view)
+
+        self.page = None
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            created_at, friendship_id, self.total_results = self._decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=friendship_id)
+            )
+        else:
+            self.total_results = view.get_total_results()
+
+        page_size = self.get_page_size(request)
+        # one more friendship tells if there is a next page
+        friendships = list(queryset.order_by('-created_at', '-id')[:page_size + 1])
+        self.has_next_page = len(friendships) > page_size
+        friendships = friendships[:page_size]
+        self.next_cursor = None
+        if self.has_next_page:
+            self.next_cursor = self._encode_cursor(friendships[-1], self.total_results)
+        return friendships
 
     def get_paginated_response(self, data):
+        if self.page is None:
+            return Response({
+                'total_results': self.total_results,
+                'has_next_page': self.has_next_page,
+                'next_cursor': self.next_cursor,
+                'results': data,
+            })
         return Response({
             'total_results': self.page.paginator.count,
             'total_pages': self.page.paginator.num_pages,
@@ -71,18 +139,49 @@ class EndlessPagination(BasePagination):
         self.has_next_page = len(queryset) > self.page_size
         return queryset[:self.page_size]
 
-    def paginate_cached_list(self, cached_list, request):
+    def paginate_cached_list(self, cached_list, request, cached_list_length=None):
+        # cached_list may have objects merged from other sources, in which case
+        # the length of the list in cache is given by cached_list_length
+        if cached_list_length is None:
+            cached_list_length = len(cached_list)
+
         paginated_list = self.paginate_ordered_list(cached_list, request)
         if 'created_at__gt' in request.query_params:
             return paginated_list
         if self.has_next_page:
             return paginated_list
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
+        if cached_list_length < settings.REDIS_LIST_LENGTH_LIMIT:
             return paginated_list
 
         # if we may have data more than limited size, retrieve from DB
         return None
 
+    def paginate_cached_sorted_set(self, load_range, request):
+        """
+        load_range(max_created_at, min_created_at, count) reads objects with
+        created_at in between from a cached sorted set, newest first, and
+        returns them with the size of the sorted set
+        """
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+            objects, _ = load_range(None, created_at__gt, None)
+            self.has_next_page = False
+            return objects
+
+        created_at__lt = None
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+        # one more object tells if there is a next page
+        objects, cached_count = load_range(created_at__lt, None, self.page_size + 1)
+        self.has_next_page = len(objects) > self.page_size
+        if self.has_next_page:
+            return objects[:self.page_size]
+        if cached_count < settings.REDIS_LIST_LENGTH_LIMIT:
+            return objects
+
+        # if we may have data more than limited size, retrieve from DB
+        return None
+
 
     def get_paginated_response(self, data):
         return Response({
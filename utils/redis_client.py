@@ -1,25 +1,102 @@
 from django.conf import settings
+import bisect
+import hashlib
+import os
 import redis
 
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes. Each node has many points on the
+    ring, so keys spread evenly and adding a node only moves about 1/n of
+    the keys.
+    """
+    POINTS_PER_NODE = 160
+
+    def __init__(self, nodes):
+        points = sorted(
+            (self.hash('{}#{}'.format(node, i)), index)
+            for index, node in enumerate(nodes)
+            for i in range(self.POINTS_PER_NODE)
+        )
+        self.hashes = [point_hash for point_hash, _ in points]
+        self.node_indexes = [index for _, index in points]
+
+    @classmethod
+    def hash(cls, value):
+        return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+    def get_node_index(self, key):
+        position = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.node_indexes[position]
+
+
 class RedisClient:
-    conn = None
+    # connections of the current process, one per shard. Celery prefork
+    # children must not share sockets with their parent, they get their own
+    # pools on first use after fork.
+    pid = None
+    connections = None
+    ring = None
 
     @classmethod
-    def get_connection(cls):
-        # singleton pattern
-        if cls.conn:
-            return cls.conn
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-        )
-        return cls.conn
+    def _get_connections(cls):
+        if cls.pid == os.getpid():
+            return cls.connections
+
+        cls.connections = [
+            redis.Redis(connection_pool=redis.ConnectionPool(
+                host=shard['host'],
+                port=shard['port'],
+                db=shard['db'],
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                retry_on_timeout=settings.REDIS_RETRY_ON_TIMEOUT,
+                health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+            ))
+            for shard in settings.REDIS_SHARDS
+        ]
+        cls.ring = HashRing([
+            '{host}:{port}/{db}'.format(**shard)
+            for shard in settings.REDIS_SHARDS
+        ])
+        cls.pid = os.getpid()
+        return cls.connections
+
+    @classmethod
+    def get_connection(cls, key=None):
+        """
+        connection of the shard a key hashes to. Every key passed in is
+        sharded, e.g. cached feeds and timelines, id sets, and the versions
+        and write locks of memcached entries. Keys stored next to another
+        key, e.g. rebuild locks, use the connection of that key. Callers
+        passing no key, e.g. for counts, generations or first pages, get
+        the first shard.
+        """
+        connections = cls._get_connections()
+        if key is None or len(connections) == 1:
+            return connections[0]
+        return connections[cls.ring.get_node_index(key)]
+
+    @classmethod
+    def group_keys_by_connection(cls, keys):
+        """
+        :return: [(connection, indexes of keys held by it)], for one
+        pipeline per shard
+        """
+        groups = {}
+        for index, key in enumerate(keys):
+            groups.setdefault(cls.get_connection(key), []).append(index)
+        return list(groups.items())
 
     @classmethod
     def clear(cls):
         # only use for unit test
         if not settings.TESTING:
             raise Exception("You can not flush redis in production environment")
-        conn =cls.get_connection()
-        conn.flushdb()
\ No newline at end of file
+        for conn in cls._get_connections():
+            conn.flushdb()
+        # generations kept in process are flushed along, see twitter.cache
+        from twitter.cache import clear_local_generations
+        clear_local_generations()
@@ -1,52 +1,817 @@
 from django.conf import settings
+from django.db import models, transaction
+from redis.exceptions import ResponseError, WatchError
+from twitter.cache import (
+    CACHE_REBUILD_LOCK_PATTERN,
+    CACHE_REBUILD_STATS_KEY,
+    CACHE_VERSION_PATTERN,
+    DIRTY_COUNTS_PATTERN,
+    FLUSHING_COUNTS_PATTERN,
+    ID_SET_CHANGES_PATTERN,
+)
 from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer
+from utils.time_helpers import to_epoch_microseconds
+import time
+import uuid
+
+
+# push to the head of a cached list and trim it atomically, lists not in cache
+# are skipped as they will be loaded from db on next read
+PUSH_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+return 1
+"""
+
+# same as above for sorted sets, only the newest entries are kept
+ADD_TO_SORTED_SET_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+return 1
+"""
+
+# only the owner of a lock releases it, a lock expired and taken by another
+# caller is left alone
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# add to a cached count and mark it dirty, counts not in cache are skipped as
+# they need to be loaded from db first. Dirty counts don't expire until they
+# are flushed.
+INCR_COUNT_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('PERSIST', KEYS[1])
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+
+# flushed counts expire again, unless they are marked dirty meanwhile
+EXPIRE_FLUSHED_COUNT_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    return 0
+end
+return redis.call('EXPIRE', KEYS[1], ARGV[2])
+"""
+
+# versions of a cached value only go up, also once the version expired, as
+# they continue from the current time in milliseconds then
+NEXT_VERSION_SCRIPT = """
+local version = tonumber(redis.call('GET', KEYS[1]) or 0) + 1
+if tonumber(ARGV[1]) > version then
+    version = tonumber(ARGV[1])
+end
+redis.call('SET', KEYS[1], version, 'EX', ARGV[2])
+return version
+"""
+
+# a cached id set unchanged since the caller read its changes counter gets
+# the id added or removed if it is in cache, one changed meanwhile is dropped
+# as changes committed together may be applied out of order
+UPDATE_ID_SET_SCRIPT = """
+local is_unchanged = tonumber(redis.call('GET', KEYS[2]) or 0) == tonumber(ARGV[1])
+if not is_unchanged then
+    redis.call('DEL', KEYS[1])
+elseif redis.call('EXISTS', KEYS[1]) == 1 then
+    if ARGV[2] == '1' then
+        redis.call('SADD', KEYS[1], ARGV[3])
+    else
+        redis.call('SREM', KEYS[1], ARGV[3])
+    end
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return is_unchanged and 1 or 0
+"""
+
+REBUILD_POLL_INTERVAL = 0.01
+COUNTS_FLUSH_BATCH_SIZE = 500
+# ids are never 0, it keeps a cached id set from being empty so that an empty
+# set in db is told apart from a set not in cache
+ID_SET_PLACEHOLDER = 0
+ID_SET_LOAD_BATCH_SIZE = 10000
+
+
+class LazyCachedList:
+    """
+    A cached list read from redis and deserialized in chunks on access.
+    Reading a page near the head of the list costs one LRANGE of about a
+    page. Chunks double in size so that deeper pages are reached in a few
+    round trips.
+
+    Each chunk is read from the last object read on, objects pushed or
+    removed between chunks shift the list, chunks are realigned on that
+    object so that none is read twice or skipped.
+
+    A chunk with objects serialized with another schema, e.g. cached before
+    a deploy, is a cache miss, the list is dropped to be rebuilt and the
+    rest of it is read from queryset.
+    """
+
+    def __init__(self, key, serializer, length, chunk_size, queryset):
+        self.key = key
+        self.serializer = serializer
+        self.chunk_size = chunk_size
+        self.queryset = queryset
+        self._length = length
+        self._serialized_list = []
+        self._objects = []
+
+    def _read_chunk(self, conn):
+        """
+        :return: (objects after the last object read, if the list ends)
+        """
+        start = len(self._serialized_list)
+        if not start:
+            serialized_list = conn.lrange(self.key, 0, self.chunk_size - 1)
+            return serialized_list, len(serialized_list) < self.chunk_size
+
+        last_read = self._serialized_list[-1]
+        serialized_list = conn.lrange(self.key, start - 1, start + self.chunk_size - 1)
+        if last_read in serialized_list:
+            # objects pushed meanwhile are before it, they are left out
+            position = serialized_list.index(last_read)
+            return serialized_list[position + 1:], len(serialized_list) < self.chunk_size + 1
+
+        # shifted by more than a chunk or the last object read is removed,
+        # which hardly happens, the list is read through to find the newest
+        # object read still in it
+        serialized_list = conn.lrange(self.key, 0, -1)
+        positions = {
+            serialized_data: position
+            for position, serialized_data in enumerate(serialized_list)
+        }
+        for serialized_data in reversed(self._serialized_list):
+            if serialized_data in positions:
+                start = positions[serialized_data] + 1
+                end = start + self.chunk_size
+                return serialized_list[start: end], end >= len(serialized_list)
+        # rebuilt or expired meanwhile
+        return [], True
+
+    def _fetch_until(self, index):
+        conn = RedisClient.get_connection(self.key)
+        while len(self._objects) <= index < self._length:
+            serialized_list, is_end = self._read_chunk(conn)
+            objects = RedisHelper.deserialize_objects(
+                conn,
+                self.key,
+                self.serializer,
+                serialized_list,
+            )
+            if objects is None:
+                self._read_rest_from_db()
+                return
+            self._serialized_list.extend(serialized_list)
+            self._objects.extend(objects)
+            if is_end:
+                # the list is trimmed or expired meanwhile
+                self._length = min(self._length, len(self._objects))
+            self.chunk_size *= 2
+
+    def _read_rest_from_db(self):
+        # objects read so far are kept, db has the same order as the list
+        objects = list(self.queryset[len(self._objects): settings.REDIS_LIST_LENGTH_LIMIT])
+        self._objects.extend(objects)
+        self._length = len(self._objects)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indexes = range(*index.indices(self._length))
+            if indexes:
+                self._fetch_until(max(indexes))
+            return [self._objects[i] for i in indexes if i < len(self._objects)]
+
+        if index < 0:
+            index += self._length
+        self._fetch_until(index)
+        if not 0 <= index < len(self._objects):
+            raise IndexError('cached list index out of range')
+        return self._objects[index]
+
+    def to_list(self):
+        # all objects are needed, the rest of the list is read at once
+        self.chunk_size = max(self.chunk_size, self._length)
+        return self[:]
+
+    def __iter__(self):
+        index = 0
+        while True:
+            self._fetch_until(index)
+            if index >= len(self._objects):
+                return
+            yield self._objects[index]
+            index += 1
 
 
 class RedisHelper:
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
+    def _incr_rebuild_stat(cls, key, stat):
+        # counted per kind of key, e.g. user_tweets:collisions
+        conn = RedisClient.get_connection()
+        field = '{}:{}'.format(key.split(':')[0], stat)
+        conn.hincrby(CACHE_REBUILD_STATS_KEY, field, 1)
+
+    @classmethod
+    def get_rebuild_stats(cls):
+        """
+        :return: {kind of key: {stat: count}}, stats are
+        - rebuilds: keys rebuilt from db
+        - collisions: callers missing a key being rebuilt by another one
+        - waits: colliding callers which waited for the rebuild to finish
+        - db_reads: colliding callers which gave up waiting and read db
+        """
         conn = RedisClient.get_connection()
+        stats = {}
+        for field, count in conn.hgetall(CACHE_REBUILD_STATS_KEY).items():
+            kind, stat = field.decode().rsplit(':', 1)
+            stats.setdefault(kind, {})[stat] = int(count)
+        return stats
+
+    @classmethod
+    def _rebuild_once(cls, key, rebuild):
+        """
+        call rebuild() to write a key missing in cache, one caller at a time.
+        Others wait for a while instead of rebuilding the key once more.
+        :return: True if this caller rebuilt the key. Otherwise the key may be
+        still missing, callers read db then without writing to cache.
+        """
+        conn = RedisClient.get_connection(key)
+        lock_key = CACHE_REBUILD_LOCK_PATTERN.format(key=key)
+        token = uuid.uuid4().hex
+        if conn.set(lock_key, token, nx=True, ex=settings.REDIS_REBUILD_LOCK_TIMEOUT):
+            try:
+                # rebuilt by the previous lock owner right before
+                if not conn.exists(key):
+                    rebuild()
+                    cls._incr_rebuild_stat(key, 'rebuilds')
+            finally:
+                conn.register_script(RELEASE_LOCK_SCRIPT)(keys=[lock_key], args=[token])
+            return True
+
+        cls._incr_rebuild_stat(key, 'collisions')
+        deadline = time.monotonic() + settings.REDIS_REBUILD_WAIT_TIME
+        while time.monotonic() < deadline:
+            time.sleep(REBUILD_POLL_INTERVAL)
+            if not conn.exists(lock_key):
+                cls._incr_rebuild_stat(key, 'waits')
+                return False
+        cls._incr_rebuild_stat(key, 'db_reads')
+        return False
+
+    @classmethod
+    def deserialize_objects(cls, conn, key, serializer, serialized_list):
+        """
+        :return: deserialized objects of a cached list or sorted set, None if
+        some are serialized with another schema, e.g. cached before a deploy.
+        The key is dropped then, as a miss it is rebuilt from db.
+        """
+        objects = [
+            serializer.deserialize(serialized_data)
+            for serialized_data in serialized_list
+        ]
+        if any(obj is None for obj in objects):
+            conn.delete(key)
+            return None
+        return objects
+
+    @classmethod
+    def _load_objects_to_cache(cls, key, objects, serializer=DjangoModelSerializer):
+        conn = RedisClient.get_connection(key)
 
         serialized_list = []
         for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
+            serialized_data = serializer.serialize(obj)
             serialized_list.append(serialized_data)
 
         if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            # replace rather than append, a list is never loaded twice
+            pipe = conn.pipeline()
+            pipe.delete(key)
+            pipe.rpush(key, *serialized_list)
+            pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipe.execute()
 
     @classmethod
-    def load_objects(cls, key, queryset):
-        conn = RedisClient.get_connection()
+    def load_objects(cls, key, queryset, serializer=DjangoModelSerializer):
+        conn = RedisClient.get_connection(key)
+
+        if not conn.exists(key):
+            rebuilt = cls._rebuild_once(
+                key,
+                lambda: cls._load_objects_to_cache(key, queryset, serializer),
+            )
+            if rebuilt or not conn.exists(key):
+                return list(queryset)
 
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            return objects
+        serialized_list = conn.lrange(key, 0, -1)
+        objects = cls.deserialize_objects(conn, key, serializer, serialized_list)
+        if objects is None:
+            cls._rebuild_once(
+                key,
+                lambda: cls._load_objects_to_cache(key, queryset, serializer),
+            )
+            return list(queryset)
+        return objects
 
-        cls._load_objects_to_cache(key, queryset)
-        return list(queryset)
+    @classmethod
+    def load_objects_of_keys(cls, keys, querysets, serializer):
+        """
+        same as load_objects for many lists, lists in cache are read in one
+        round trip per shard, the ones missing are loaded one by one
+        :return: [objects of each key]
+        """
+        results = [None] * len(keys)
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            pipe = conn.pipeline(transaction=False)
+            for index in indexes:
+                pipe.lrange(keys[index], 0, -1)
+            for index, serialized_list in zip(indexes, pipe.execute()):
+                # lists in cache are never empty, the ones of another schema
+                # are dropped and loaded as missing ones
+                if serialized_list:
+                    results[index] = cls.deserialize_objects(
+                        conn,
+                        keys[index],
+                        serializer,
+                        serialized_list,
+                    )
+        return [
+            objects if objects is not None else cls.load_objects(key, queryset, serializer)
+            for key, queryset, objects in zip(keys, querysets, results)
+        ]
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
-        conn = RedisClient.get_connection()
+    def load_objects_lazily(cls, key, queryset, serializer, chunk_size):
+        """
+        same as load_objects, but the cached list is read in chunks and
+        deserialized as it is accessed, see LazyCachedList
+        """
+        conn = RedisClient.get_connection(key)
+        # lists in cache are never empty
+        length = conn.llen(key)
+        if not length:
+            cls._rebuild_once(
+                key,
+                lambda: cls._load_objects_to_cache(key, queryset, serializer),
+            )
+            length = conn.llen(key)
+        if not length:
+            return list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+        return LazyCachedList(key, serializer, length, chunk_size, queryset)
+
+    @classmethod
+    def push_object(cls, key, obj, queryset, serializer=DjangoModelSerializer):
+        conn = RedisClient.get_connection(key)
         if not conn.exists(key):
-            cls._load_objects_to_cache(key, queryset)
+            # the object is in db already, the rebuilt list has it
+            cls._rebuild_once(
+                key,
+                lambda: cls._load_objects_to_cache(key, queryset, serializer),
+            )
             return
 
-        serialized_data = DjangoModelSerializer.serialize(obj)
+        serialized_data = serializer.serialize(obj)
         conn.lpush(key, serialized_data)
         conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
 
+    @classmethod
+    def push_objects(cls, keys, objects, serializer=DjangoModelSerializer):
+        """
+        push objects[i] to cached list keys[i] in one round trip
+        :return: number of lists pushed to
+        """
+        if not keys:
+            return 0
+
+        pushed = 0
+        # one pipeline per shard
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            script = conn.register_script(PUSH_IF_EXISTS_SCRIPT)
+            pipe = conn.pipeline(transaction=False)
+            for index in indexes:
+                serialized_data = serializer.serialize(objects[index])
+                script(
+                    keys=[keys[index]],
+                    args=[serialized_data, settings.REDIS_LIST_LENGTH_LIMIT],
+                    client=pipe,
+                )
+            pushed += sum(pipe.execute())
+        return pushed
+
+    @classmethod
+    def rewrite_objects(cls, key, serializer, rewrite):
+        """
+        rewrite(objects) gets the deserialized objects of a cached list and
+        returns the objects to keep in it. Lists not in cache are skipped.
+        """
+        conn = RedisClient.get_connection(key)
+        with conn.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if not pipe.exists(key):
+                    return
+                objects = cls.deserialize_objects(
+                    conn,
+                    key,
+                    serializer,
+                    pipe.lrange(key, 0, -1),
+                )
+                if objects is None:
+                    return
+                objects = rewrite(objects)[:settings.REDIS_LIST_LENGTH_LIMIT]
+
+                pipe.multi()
+                pipe.delete(key)
+                if objects:
+                    pipe.rpush(key, *[serializer.serialize(obj) for obj in objects])
+                    pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                pipe.execute()
+            except WatchError:
+                # the list is changed meanwhile, let it be loaded from db
+                conn.delete(key)
+
+    @classmethod
+    def remove_objects(cls, key, serializer, should_remove):
+        cls.rewrite_objects(key, serializer, lambda cached_objects: [
+            obj
+            for obj in cached_objects
+            if not should_remove(obj)
+        ])
+
+    @classmethod
+    def delete_objects(cls, keys):
+        # delete cached lists or sorted sets, one round trip per shard
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            conn.delete(*[keys[index] for index in indexes])
+
+    @classmethod
+    def get_score(cls, obj):
+        # epoch microseconds are exact in a double until year 2255
+        return to_epoch_microseconds(obj.created_at)
+
+    @classmethod
+    def _load_objects_to_sorted_set(cls, key, objects, serializer):
+        conn = RedisClient.get_connection(key)
+
+        mapping = {}
+        for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
+            mapping[serializer.serialize(obj)] = cls.get_score(obj)
+
+        if mapping:
+            pipe = conn.pipeline()
+            pipe.zadd(key, mapping)
+            pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipe.execute()
+
+    @classmethod
+    def _get_score_range(cls, max_created_at, min_created_at):
+        # both ends are exclusive
+        max_score = '+inf'
+        if max_created_at is not None:
+            max_score = '({}'.format(to_epoch_microseconds(max_created_at))
+        min_score = '-inf'
+        if min_created_at is not None:
+            min_score = '({}'.format(to_epoch_microseconds(min_created_at))
+        return max_score, min_score
+
+    @classmethod
+    def load_sorted_objects(
+        cls,
+        key,
+        queryset,
+        serializer,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+    ):
+        """
+        objects with created_at in (min_created_at, max_created_at), newest
+        first, at most count of them.
+        :return: (objects, number of objects in the cached sorted set)
+        """
+        conn = RedisClient.get_connection(key)
+        if not conn.exists(key):
+            rebuilt = cls._rebuild_once(
+                key,
+                lambda: cls._load_objects_to_sorted_set(key, queryset, serializer),
+            )
+            if not rebuilt and not conn.exists(key):
+                return cls._load_sorted_objects_from_db(
+                    queryset,
+                    max_created_at,
+                    min_created_at,
+                    count,
+                )
+
+        max_score, min_score = cls._get_score_range(max_created_at, min_created_at)
+        pipe = conn.pipeline(transaction=False)
+        if count is None:
+            pipe.zrevrangebyscore(key, max_score, min_score)
+        else:
+            pipe.zrevrangebyscore(key, max_score, min_score, start=0, num=count)
+        pipe.zcard(key)
+        serialized_list, cached_count = pipe.execute()
+
+        objects = cls.deserialize_objects(conn, key, serializer, serialized_list)
+        if objects is None:
+            cls._rebuild_once(
+                key,
+                lambda: cls._load_objects_to_sorted_set(key, queryset, serializer),
+            )
+            return cls._load_sorted_objects_from_db(
+                queryset,
+                max_created_at,
+                min_created_at,
+                count,
+            )
+        return objects, cached_count
+
+    @classmethod
+    def _load_sorted_objects_from_db(cls, queryset, max_created_at, min_created_at, count):
+        if max_created_at is not None:
+            queryset = queryset.filter(created_at__lt=max_created_at)
+        if min_created_at is not None:
+            queryset = queryset.filter(created_at__gt=min_created_at)
+        if count is not None:
+            queryset = queryset[:count]
+        objects = list(queryset)
+        return objects, len(objects)
+
+    @classmethod
+    def load_sorted_objects_of_keys(
+        cls,
+        keys,
+        querysets,
+        serializer,
+        max_created_at=None,
+        min_created_at=None,
+        count=None,
+    ):
+        """
+        same as load_sorted_objects for many sorted sets, sorted sets in cache
+        are read in one round trip per shard, the ones missing are loaded one
+        by one
+        :return: [objects of each key]
+        """
+        max_score, min_score = cls._get_score_range(max_created_at, min_created_at)
+        results = [None] * len(keys)
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            pipe = conn.pipeline(transaction=False)
+            for index in indexes:
+                # an empty range of a cached sorted set is not a miss
+                pipe.exists(keys[index])
+                if count is None:
+                    pipe.zrevrangebyscore(keys[index], max_score, min_score)
+                else:
+                    pipe.zrevrangebyscore(keys[index], max_score, min_score, start=0, num=count)
+            values = pipe.execute()
+            for position, index in enumerate(indexes):
+                exists, serialized_list = values[position * 2: position * 2 + 2]
+                if exists:
+                    results[index] = cls.deserialize_objects(
+                        conn,
+                        keys[index],
+                        serializer,
+                        serialized_list,
+                    )
+
+        return [
+            objects if objects is not None else cls.load_sorted_objects(
+                key,
+                queryset,
+                serializer,
+                max_created_at,
+                min_created_at,
+                count,
+            )[0]
+            for key, queryset, objects in zip(keys, querysets, results)
+        ]
+
+    @classmethod
+    def push_sorted_object(cls, key, obj, queryset, serializer):
+        conn = RedisClient.get_connection(key)
+        if not conn.exists(key):
+            cls._rebuild_once(
+                key,
+                lambda: cls._load_objects_to_sorted_set(key, queryset, serializer),
+            )
+            return
+
+        conn.zadd(key, {serializer.serialize(obj): cls.get_score(obj)})
+        conn.zremrangebyrank(key, 0, -settings.REDIS_LIST_LENGTH_LIMIT - 1)
+
+    @classmethod
+    def push_sorted_objects(cls, keys, objects, serializer):
+        """
+        add objects[i] to cached sorted set keys[i] in one round trip
+        :return: number of sorted sets added to
+        """
+        if not keys:
+            return 0
+
+        added = 0
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            script = conn.register_script(ADD_TO_SORTED_SET_IF_EXISTS_SCRIPT)
+            pipe = conn.pipeline(transaction=False)
+            for index in indexes:
+                script(
+                    keys=[keys[index]],
+                    args=[
+                        serializer.serialize(objects[index]),
+                        cls.get_score(objects[index]),
+                        settings.REDIS_LIST_LENGTH_LIMIT,
+                    ],
+                    client=pipe,
+                )
+            added += sum(pipe.execute())
+        return added
+
+    @classmethod
+    def merge_sorted_objects(cls, key, objects, serializer):
+        cls.push_sorted_objects([key] * len(objects), objects, serializer)
+
+    @classmethod
+    def remove_sorted_objects(cls, key, serializer, should_remove):
+        conn = RedisClient.get_connection(key)
+        serialized_list = conn.zrange(key, 0, -1)
+        objects = cls.deserialize_objects(conn, key, serializer, serialized_list)
+        if objects is None:
+            return
+        serialized_list = [
+            serialized_data
+            for serialized_data, obj in zip(serialized_list, objects)
+            if should_remove(obj)
+        ]
+        if serialized_list:
+            conn.zrem(key, *serialized_list)
+
+    @classmethod
+    def _load_id_set(cls, key, queryset):
+        """
+        read the ids from db and cache them, unless the set changes meanwhile
+        :return: the set of ids
+        """
+        conn = RedisClient.get_connection(key)
+        changes_key = ID_SET_CHANGES_PATTERN.format(key=key)
+        with conn.pipeline() as pipe:
+            try:
+                # watched before db is read, a change committed after the
+                # read drops this load rather than being missed by it
+                pipe.watch(changes_key)
+                ids = set(queryset)
+
+                pipe.multi()
+                pipe.delete(key)
+                pipe.sadd(key, ID_SET_PLACEHOLDER)
+                id_list = list(ids)
+                for start in range(0, len(id_list), ID_SET_LOAD_BATCH_SIZE):
+                    pipe.sadd(key, *id_list[start: start + ID_SET_LOAD_BATCH_SIZE])
+                pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                pipe.execute()
+            except WatchError:
+                # the set is loaded from db again on next read
+                pass
+        return ids
+
+    @classmethod
+    def _load_id_set_once(cls, key, queryset):
+        """
+        :param queryset: flat values_list of the ids
+        :return: the set of ids
+        """
+        loaded = []
+        cls._rebuild_once(key, lambda: loaded.append(cls._load_id_set(key, queryset)))
+        if loaded:
+            return loaded[0]
+
+        # loaded by another caller, or still being loaded
+        conn = RedisClient.get_connection(key)
+        members = conn.smembers(key)
+        if not members:
+            return set(queryset)
+        return set(int(member) for member in members) - {ID_SET_PLACEHOLDER}
+
+    @classmethod
+    def get_id_set(cls, key, queryset):
+        conn = RedisClient.get_connection(key)
+        members = conn.smembers(key)
+        if not members:
+            return cls._load_id_set_once(key, queryset)
+        return set(int(member) for member in members) - {ID_SET_PLACEHOLDER}
+
+    @classmethod
+    def get_id_set_size(cls, key):
+        """
+        :return: None if the set is not in cache
+        """
+        conn = RedisClient.get_connection(key)
+        size = conn.scard(key)
+        return size - 1 if size else None
+
+    @classmethod
+    def get_id_set_members(cls, key, ids, queryset):
+        """
+        the ones of ids in the cached set, checked in one round trip
+        """
+        ids = list(ids)
+        conn = RedisClient.get_connection(key)
+        # SMISMEMBER needs redis 6.2, pipelined SISMEMBER does the same
+        pipe = conn.pipeline(transaction=False)
+        pipe.exists(key)
+        for object_id in ids:
+            pipe.sismember(key, object_id)
+        exists, *is_members = pipe.execute()
+        if not exists:
+            return cls._load_id_set_once(key, queryset) & set(ids)
+        return set(
+            object_id
+            for object_id, is_member in zip(ids, is_members)
+            if is_member
+        )
+
+    @classmethod
+    def invalidate_id_sets(cls, keys):
+        """
+        drop cached id sets whose ids changed in db, and the loads of them
+        going on, they are loaded from db on next read
+        """
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            pipe = conn.pipeline()
+            for index in indexes:
+                changes_key = ID_SET_CHANGES_PATTERN.format(key=keys[index])
+                pipe.incr(changes_key)
+                # kept as long as the set, updates compare it, see update_id_sets
+                pipe.expire(changes_key, settings.REDIS_KEY_EXPIRE_TIME)
+                pipe.delete(keys[index])
+            pipe.execute()
+
+    @classmethod
+    def get_id_set_changes(cls, keys):
+        """
+        read before the ids change in db, e.g. in a save signal
+        :return: [changes counter of each id set], for update_id_sets
+        """
+        changes = [0] * len(keys)
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            values = conn.mget([
+                ID_SET_CHANGES_PATTERN.format(key=keys[index])
+                for index in indexes
+            ])
+            for index, value in zip(indexes, values):
+                changes[index] = int(value or 0)
+        return changes
+
+    @classmethod
+    def update_id_sets(cls, keys, ids, changes, is_added):
+        """
+        add ids[i] to, or remove it from, cached id set keys[i] once the change
+        is committed, in one round trip per shard. A set changed since
+        changes[i] was read is dropped instead and loaded from db on next
+        read, loads going on are dropped either way
+        :return: number of sets dropped
+        """
+        dropped = 0
+        for conn, indexes in RedisClient.group_keys_by_connection(keys):
+            script = conn.register_script(UPDATE_ID_SET_SCRIPT)
+            pipe = conn.pipeline(transaction=False)
+            for index in indexes:
+                script(
+                    keys=[keys[index], ID_SET_CHANGES_PATTERN.format(key=keys[index])],
+                    args=[
+                        changes[index],
+                        1 if is_added else 0,
+                        ids[index],
+                        settings.REDIS_KEY_EXPIRE_TIME,
+                    ],
+                    client=pipe,
+                )
+            dropped += len(indexes) - sum(pipe.execute())
+        return dropped
+
     @classmethod
     def get_count_key(cls, obj, attr):
-        return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
+        return cls._get_count_key(obj.__class__, obj.id, attr)
+
+    @classmethod
+    def _get_count_key(cls, model_class, object_id, attr):
+        return '{}.{}:{}'.format(model_class.__name__, attr, object_id)
 
     @classmethod
     def incr_count(cls, obj, attr):
@@ -68,6 +833,173 @@ class RedisHelper:
             return getattr(obj, attr)
         return conn.decr(key)
 
+    @classmethod
+    def add_count_behind(cls, model_class, object_id, attr, amount):
+        """
+        add amount to the cached count without writing db, the object is
+        marked dirty and its counts are written to db by flush_counts
+        :return: the count after adding
+        """
+        conn = RedisClient.get_connection()
+        key = cls._get_count_key(model_class, object_id, attr)
+        dirty_key = DIRTY_COUNTS_PATTERN.format(model=model_class.__name__)
+        script = conn.register_script(INCR_COUNT_IF_EXISTS_SCRIPT)
+        count = script(keys=[key, dirty_key], args=[amount, object_id])
+        if count is not None:
+            return count
+
+        # db is up to date with counts not in cache, counts of dirty objects
+        # don't expire before they are flushed
+        count = model_class.objects.filter(id=object_id).values_list(attr, flat=True).first()
+        pipe = conn.pipeline()
+        pipe.set(key, count or 0, nx=True)
+        pipe.incrby(key, amount)
+        pipe.sadd(dirty_key, object_id)
+        pipe.persist(key)
+        _, count, _, _ = pipe.execute()
+        return count
+
+    @classmethod
+    def flush_counts(cls, model_class, attrs):
+        """
+        write cached counts of dirty objects to db in batched updates. Counts
+        are written as they are rather than as deltas, so a flush interrupted
+        half way is simply done again.
+        :return: number of objects flushed
+        """
+        conn = RedisClient.get_connection()
+        dirty_key = DIRTY_COUNTS_PATTERN.format(model=model_class.__name__)
+        flushing_key = FLUSHING_COUNTS_PATTERN.format(model=model_class.__name__)
+        # objects marked dirty from now on go to the next flush. An interrupted
+        # flush leaves its objects behind, which are flushed first.
+        try:
+            conn.renamenx(dirty_key, flushing_key)
+        except ResponseError:
+            # nothing is dirty
+            pass
+
+        object_ids = sorted(int(object_id) for object_id in conn.smembers(flushing_key))
+        expire_script = conn.register_script(EXPIRE_FLUSHED_COUNT_SCRIPT)
+        for start in range(0, len(object_ids), COUNTS_FLUSH_BATCH_SIZE):
+            batch_ids = object_ids[start: start + COUNTS_FLUSH_BATCH_SIZE]
+            count_keys = [
+                cls._get_count_key(model_class, object_id, attr)
+                for object_id in batch_ids
+                for attr in attrs
+            ]
+            counts = conn.mget(count_keys)
+            with transaction.atomic():
+                for index, attr in enumerate(attrs):
+                    # dirty counts don't expire, only an eviction of redis
+                    # loses them, db keeps the last flushed ones then
+                    counts_by_id = {
+                        object_id: int(count)
+                        for object_id, count in zip(batch_ids, counts[index::len(attrs)])
+                        if count is not None
+                    }
+                    if not counts_by_id:
+                        continue
+                    model_class.objects.filter(id__in=counts_by_id).update(**{
+                        attr: models.Case(
+                            *[
+                                models.When(id=object_id, then=models.Value(count))
+                                for object_id, count in counts_by_id.items()
+                            ],
+                            output_field=models.IntegerField(),
+                        ),
+                    })
+
+            pipe = conn.pipeline(transaction=False)
+            for position, count_key in enumerate(count_keys):
+                expire_script(
+                    keys=[count_key, dirty_key],
+                    args=[batch_ids[position // len(attrs)], settings.REDIS_KEY_EXPIRE_TIME],
+                    client=pipe,
+                )
+            pipe.execute()
+        conn.delete(flushing_key)
+        return len(object_ids)
+
+    @classmethod
+    def get_counts(cls, objects, attrs):
+        """
+        counts of objects of a model in one MGET, counts missing in cache are
+        read from db in one query and cached in one round trip
+        :return: {object id: {attr: count}}
+        """
+        if not objects:
+            return {}
+
+        conn = RedisClient.get_connection()
+        model_class = objects[0].__class__
+        object_attrs = [(obj.id, attr) for obj in objects for attr in attrs]
+        values = conn.mget([
+            cls._get_count_key(model_class, object_id, attr)
+            for object_id, attr in object_attrs
+        ])
+
+        counts = {obj.id: {} for obj in objects}
+        missing_ids = set()
+        for (object_id, attr), value in zip(object_attrs, values):
+            if value is None:
+                missing_ids.add(object_id)
+            else:
+                counts[object_id][attr] = int(value)
+        if not missing_ids:
+            return counts
+
+        pipe = conn.pipeline(transaction=False)
+        for row in model_class.objects.filter(id__in=missing_ids).values('id', *attrs):
+            for attr in attrs:
+                if attr in counts[row['id']]:
+                    continue
+                counts[row['id']][attr] = row[attr] or 0
+                # counts added behind meanwhile are not overwritten
+                key = cls._get_count_key(model_class, row['id'], attr)
+                pipe.set(key, row[attr] or 0, nx=True)
+        pipe.execute()
+
+        # objects deleted from db meanwhile count nothing, they are not cached
+        for object_id in missing_ids:
+            for attr in attrs:
+                counts[object_id].setdefault(attr, 0)
+        return counts
+
+    @classmethod
+    def get_cache_version(cls, key):
+        version_key = CACHE_VERSION_PATTERN.format(key=key)
+        conn = RedisClient.get_connection(version_key)
+        return int(conn.get(version_key) or 0)
+
+    @classmethod
+    def get_cache_versions(cls, keys):
+        """
+        same as get_cache_version for many keys, one round trip per shard
+        """
+        version_keys = [CACHE_VERSION_PATTERN.format(key=key) for key in keys]
+        versions = [0] * len(keys)
+        for conn, indexes in RedisClient.group_keys_by_connection(version_keys):
+            values = conn.mget([version_keys[index] for index in indexes])
+            for index, value in zip(indexes, values):
+                versions[index] = int(value or 0)
+        return versions
+
+    @classmethod
+    def next_cache_version(cls, key):
+        """
+        version of the value cached in memcached under key, bumped on every
+        change of the value
+        """
+        version_key = CACHE_VERSION_PATTERN.format(key=key)
+        conn = RedisClient.get_connection(version_key)
+        return conn.register_script(NEXT_VERSION_SCRIPT)(
+            keys=[version_key],
+            args=[
+                int(time.time() * 1000),
+                settings.CACHE_TIMEOUT + settings.CACHE_STALE_TIMEOUT,
+            ],
+        )
+
     @classmethod
     def get_count(cls, obj, attr):
         conn = RedisClient.get_connection()
@@ -78,5 +1010,6 @@ class RedisHelper:
 
         obj.refresh_from_db()
         count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
\ No newline at end of file
+        # counts added behind meanwhile are not overwritten
+        conn.set(key, count, nx=True)
+        return count
@@ -1,5 +1,11 @@
 from django.core import serializers
+from django.db import models
+from django.db.models.base import ModelState
 from utils.json_encoder import JSONEncoder
+from utils.time_helpers import to_epoch_microseconds, from_epoch_microseconds
+import struct
+import zlib
+
 
 class DjangoModelSerializer:
 
@@ -9,4 +15,111 @@ class DjangoModelSerializer:
 
     @classmethod
     def deserialize(cls, serialized_data):
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+class CompactModelSerializer:
+    """
+    Packs a few integer and datetime fields of a model into fixed width
+    binary, 8 bytes per field, after a 2 bytes schema version. Fields not
+    packed are deferred on deserialized objects, accessing them loads them
+    from db.
+
+    The schema version is a checksum of the model and the packed fields, it
+    changes along with field_names. Data packed with other fields, e.g.
+    cached before a deploy, deserializes to None and callers take it as a
+    cache miss.
+    """
+    model_class = None
+    # attnames of integer or datetime fields, e.g. 'user_id'
+    field_names = ()
+
+    # stands for null, ids and timestamps are never negative
+    NULL = -1
+
+    @classmethod
+    def _get_field_names(cls):
+        # Model.from_db expects values in the order of model fields
+        if '_ordered_field_names' not in cls.__dict__:
+            cls._ordered_field_names = tuple(
+                field.attname
+                for field in cls.model_class._meta.concrete_fields
+                if field.attname in cls.field_names
+            )
+        return cls._ordered_field_names
+
+    @classmethod
+    def get_schema_version(cls):
+        if '_schema_version' not in cls.__dict__:
+            schema = '{}:{}'.format(
+                cls.model_class._meta.label,
+                ','.join(cls._get_field_names()),
+            )
+            cls._schema_version = zlib.crc32(schema.encode()) & 0xffff
+        return cls._schema_version
+
+    @classmethod
+    def _get_struct(cls):
+        if '_struct' not in cls.__dict__:
+            cls._struct = struct.Struct('>H' + 'q' * len(cls._get_field_names()))
+        return cls._struct
+
+    @classmethod
+    def _get_datetime_field_names(cls):
+        if '_datetime_field_names' not in cls.__dict__:
+            cls._datetime_field_names = set(
+                field_name
+                for field_name in cls._get_field_names()
+                if isinstance(
+                    cls.model_class._meta.get_field(field_name),
+                    models.DateTimeField,
+                )
+            )
+        return cls._datetime_field_names
+
+    @classmethod
+    def serialize(cls, instance):
+        datetime_field_names = cls._get_datetime_field_names()
+        values = []
+        for field_name in cls._get_field_names():
+            value = getattr(instance, field_name)
+            if value is None:
+                value = cls.NULL
+            elif field_name in datetime_field_names:
+                value = to_epoch_microseconds(value)
+            values.append(value)
+        return cls._get_struct().pack(cls.get_schema_version(), *values)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        """
+        :return: the object, None if serialized_data is packed with another
+        schema
+        """
+        packer = cls._get_struct()
+        if len(serialized_data) != packer.size:
+            # lists cached before compact format was introduced hold json
+            if serialized_data[:1] == b'[':
+                return DjangoModelSerializer.deserialize(serialized_data)
+            return None
+        schema_version, *packed_values = packer.unpack(serialized_data)
+        if schema_version != cls.get_schema_version():
+            return None
+
+        datetime_field_names = cls._get_datetime_field_names()
+        values = []
+        field_names = cls._get_field_names()
+        for field_name, value in zip(field_names, packed_values):
+            if value == cls.NULL:
+                value = None
+            elif field_name in datetime_field_names:
+                value = from_epoch_microseconds(value)
+            values.append(value)
+
+        # same as Model.from_db but skips Model.__init__, which costs more
+        # than unpacking. Fields missing from __dict__ are deferred.
+        instance = cls.model_class.__new__(cls.model_class)
+        instance.__dict__.update(zip(field_names, values))
+        instance._state = ModelState()
+        instance._state.adding = False
+        return instance
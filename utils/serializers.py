@@ -0,0 +1,17 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    Lets the child serializer load what it needs for all objects of a list
+    at once through its prefetch(objects) classmethod, e.g. users through
+    MemcachedHelper.prefetch_objects, before objects are serialized one by one.
+    Set as list_serializer_class in Meta of the child serializer.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        objects = list(iterable)
+        self.child.prefetch(objects)
+        return super().to_representation(objects)
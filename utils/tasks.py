@@ -0,0 +1,13 @@
+from celery import shared_task
+from django.apps import apps
+
+
+@shared_task(routing_key='default', time_limit=60)
+def refresh_cached_object_task(model_label, object_id):
+    from utils.memcached_helper import MemcachedHelper
+
+    # enqueued by the reader taking the refresh lock of a stale entry
+    obj = MemcachedHelper.refresh_object(apps.get_model(model_label), object_id)
+    if obj is None:
+        return '{} {} is gone'.format(model_label, object_id)
+    return '{} {} refreshed'.format(model_label, object_id)
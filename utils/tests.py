@@ -1,5 +1,32 @@
-from testing.testcases import TestCase
-from utils.redis_client import RedisClient
+from django.conf import settings
+from django.contrib.auth.models import User
+from testing.testcases import TestCase, TransactionTestCase
+from tweets.models import Tweet
+from tweets.services import TweetRefSerializer
+from twitter.cache import (
+    bump_generation,
+    CACHE_GENERATIONS_KEY,
+    CACHE_REBUILD_LOCK_PATTERN,
+    CACHE_REBUILD_STATS_KEY,
+    CACHE_VERSION_PATTERN,
+    clear_local_generations,
+    get_generation,
+    USER_TWEETS_PATTERN,
+    USER_TWEETS_SORTED_SET_PATTERN,
+)
+from utils.redis_client import HashRing, RedisClient
+from utils.local_cache import LocalCache, LocalCacheSubscriber
+from utils.memcached_helper import (
+    CacheEntry,
+    LARGE_VALUE_CHUNK_SIZE,
+    MemcachedHelper,
+    Tombstone,
+    cache,
+    local_cache,
+)
+from utils.redis_helper import LazyCachedList, RedisHelper
+import os
+import time
 
 
 class UtilsTests(TestCase):
@@ -17,4 +44,430 @@ class UtilsTests(TestCase):
 
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
-        self.assertEqual(cached_list, [])
\ No newline at end of file
+        self.assertEqual(cached_list, [])
+
+    def test_rebuild_once(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('linghu')
+        for i in range(3):
+            self.create_tweet(user)
+        key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        # cached when tweets are pushed, start from a cold cache
+        conn.delete(key, CACHE_REBUILD_STATS_KEY)
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+
+        # another caller is rebuilding, read db without writing to cache
+        conn.set(CACHE_REBUILD_LOCK_PATTERN.format(key=key), 'another')
+        with self.settings(REDIS_REBUILD_WAIT_TIME=0):
+            tweets = RedisHelper.load_objects(key, queryset)
+        self.assertEqual(len(tweets), 3)
+        self.assertEqual(conn.exists(key), 0)
+        stats = RedisHelper.get_rebuild_stats()
+        self.assertEqual(stats['user_tweets'], {'collisions': 1, 'db_reads': 1})
+
+        # rebuilt once the lock is released
+        conn.delete(CACHE_REBUILD_LOCK_PATTERN.format(key=key))
+        tweets = RedisHelper.load_objects(key, queryset)
+        self.assertEqual(len(tweets), 3)
+        self.assertEqual(conn.llen(key), 3)
+        self.assertEqual(RedisHelper.get_rebuild_stats()['user_tweets']['rebuilds'], 1)
+        self.assertEqual(conn.exists(CACHE_REBUILD_LOCK_PATTERN.format(key=key)), 0)
+
+        # loading a list twice never duplicates it
+        RedisHelper._load_objects_to_cache(key, queryset)
+        self.assertEqual(conn.llen(key), 3)
+
+    def test_load_objects_lazily(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('linghu')
+        tweets = [self.create_tweet(user) for i in range(5)][::-1]
+        key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        conn.delete(key)
+
+        # cold cache is loaded, then read in chunks
+        cached_tweets = RedisHelper.load_objects_lazily(key, queryset, TweetRefSerializer, 2)
+        self.assertEqual(isinstance(cached_tweets, LazyCachedList), True)
+        self.assertEqual(len(cached_tweets), 5)
+        self.assertEqual(cached_tweets[0].id, tweets[0].id)
+        self.assertEqual(len(cached_tweets._serialized_list), 2)
+        self.assertEqual(len(cached_tweets._objects), 2)
+        self.assertEqual([t.id for t in cached_tweets[1:3]], [tweets[1].id, tweets[2].id])
+        self.assertEqual(len(cached_tweets._serialized_list), 5)
+        self.assertEqual(cached_tweets[-1].id, tweets[-1].id)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets])
+
+        # list trimmed after its length is read
+        cached_tweets = RedisHelper.load_objects_lazily(key, queryset, TweetRefSerializer, 2)
+        conn.ltrim(key, 0, 2)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[:3]])
+        self.assertEqual(len(cached_tweets), 3)
+
+        # tweets pushed or removed between chunks shift the list, the objects
+        # read are the ones in the list when it is first read
+        conn.delete(key)
+        cached_tweets = RedisHelper.load_objects_lazily(key, queryset, TweetRefSerializer, 2)
+        self.assertEqual(cached_tweets[1].id, tweets[1].id)
+        new_tweet = self.create_tweet(user)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets])
+
+        cached_tweets = RedisHelper.load_objects_lazily(key, queryset, TweetRefSerializer, 2)
+        self.assertEqual(cached_tweets[1].id, tweets[0].id)
+        self.create_tweet(user)
+        conn.lrem(key, 1, TweetRefSerializer.serialize(tweets[0]))
+        self.assertEqual([t.id for t in cached_tweets], [new_tweet.id] + [t.id for t in tweets])
+
+        # read at once when all objects are needed
+        conn.delete(key)
+        cached_tweets = RedisHelper.load_objects_lazily(key, queryset, TweetRefSerializer, 2)
+        cached_tweets[0]
+        self.assertEqual([t.id for t in cached_tweets.to_list()], [t.id for t in queryset])
+        self.assertEqual(len(cached_tweets._serialized_list), len(cached_tweets))
+
+    def test_load_objects_of_another_schema(self):
+        user = self.create_user('linghu')
+        tweets = [self.create_tweet(user) for i in range(3)][::-1]
+        tweet_ids = [t.id for t in tweets]
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        # packed before the schema version was added
+        stale_data = TweetRefSerializer.serialize(tweets[0])[2:]
+
+        # lists holding stale entries are a miss, and are rebuilt
+        key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        conn = RedisClient.get_connection(key)
+        RedisHelper.load_objects(key, queryset, TweetRefSerializer)
+        conn.rpush(key, stale_data)
+        cached_tweets = RedisHelper.load_objects(key, queryset, TweetRefSerializer)
+        self.assertEqual([t.id for t in cached_tweets], tweet_ids)
+        self.assertEqual(conn.llen(key), 3)
+        cached_tweets = RedisHelper.load_objects(key, queryset, TweetRefSerializer)
+        self.assertEqual([t.id for t in cached_tweets], tweet_ids)
+
+        # lazily read lists are read from db past the stale entries
+        conn.rpush(key, stale_data)
+        cached_tweets = RedisHelper.load_objects_lazily(key, queryset, TweetRefSerializer, 2)
+        self.assertEqual([t.id for t in cached_tweets], tweet_ids)
+        self.assertEqual(conn.exists(key), False)
+
+        # same for sorted sets
+        key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user.id)
+        conn = RedisClient.get_connection(key)
+        RedisHelper.load_sorted_objects(key, queryset, TweetRefSerializer)
+        conn.zadd(key, {stale_data: 0})
+        cached_tweets, _ = RedisHelper.load_sorted_objects(key, queryset, TweetRefSerializer)
+        self.assertEqual([t.id for t in cached_tweets], tweet_ids)
+        self.assertEqual(conn.zcard(key), 3)
+
+    def test_hash_ring(self):
+        keys = ['user_newsfeeds:{}'.format(i) for i in range(3000)]
+        ring = HashRing(['a', 'b', 'c'])
+        indexes = [ring.get_node_index(key) for key in keys]
+        for index in range(3):
+            self.assertEqual(800 < indexes.count(index) < 1200, True)
+
+        # adding a node only moves keys to the new node
+        new_ring = HashRing(['a', 'b', 'c', 'd'])
+        new_indexes = [new_ring.get_node_index(key) for key in keys]
+        moved = [
+            new_index
+            for index, new_index in zip(indexes, new_indexes)
+            if index != new_index
+        ]
+        self.assertEqual(set(moved), {3})
+        self.assertEqual(500 < len(moved) < 1000, True)
+
+    def test_sharded_connections(self):
+        shards = [
+            {'host': settings.REDIS_HOST, 'port': settings.REDIS_PORT, 'db': db}
+            for db in [settings.REDIS_DB, 5]
+        ]
+        try:
+            with self.settings(REDIS_SHARDS=shards):
+                # pools are rebuilt in a new process
+                RedisClient.pid = None
+                keys = ['user_newsfeeds:{}'.format(i) for i in range(20)]
+                conns = [RedisClient.get_connection(key) for key in keys]
+                self.assertEqual(len(set(conns)), 2)
+                self.assertEqual(RedisClient.get_connection(), RedisClient.connections[0])
+                self.assertEqual(conns[0], RedisClient.get_connection(keys[0]))
+
+                groups = RedisClient.group_keys_by_connection(keys)
+                self.assertEqual(sorted(i for _, indexes in groups for i in indexes), list(range(20)))
+                for conn, indexes in groups:
+                    for index in indexes:
+                        conn.rpush(keys[index], 1)
+                RedisHelper.delete_objects(keys)
+                self.assertEqual(sum(conn.exists(*keys) for conn in RedisClient.connections), 0)
+        finally:
+            RedisClient.pid = None
+
+    def test_cache_generations(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('linghu')
+        tweet = self.create_tweet(user)
+        key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        generation = int(key.split(':')[1][1:])
+        self.assertEqual(conn.llen(key), 1)
+        zset_key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user.id)
+
+        # all keys of the namespace move at once, old ones are left to expire
+        self.assertEqual(bump_generation('user_tweets'), generation + 1)
+        new_key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        self.assertEqual(new_key, 'user_tweets:v{}:{}'.format(generation + 1, user.id))
+        self.assertEqual(conn.exists(new_key), 0)
+        self.assertEqual(conn.llen(key), 1)
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        RedisHelper.load_objects(new_key, queryset)
+        self.assertEqual(conn.llen(new_key), 1)
+
+        # other namespaces are kept
+        self.assertEqual(USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user.id), zset_key)
+        MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        bump_generation('Tweet')
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+
+        # generations lost by redis start over past the former ones
+        conn.delete(CACHE_GENERATIONS_KEY)
+        clear_local_generations()
+        self.assertEqual(get_generation('user_tweets') > generation + 1, True)
+
+    def test_local_cache(self):
+        local = LocalCache(max_size=2, timeout=60)
+        local.set('a', {'value': 1})
+        local.set('b', {'value': 2})
+        # instances are never shared
+        local.get('a')['value'] = 3
+        self.assertEqual(local.get('a'), {'value': 1})
+        # b is the least recently used
+        local.set('c', {'value': 3})
+        self.assertEqual(local.get('b'), None)
+        self.assertEqual(local.get('c'), {'value': 3})
+        self.assertEqual(local.get_stats(), {
+            'size': 2,
+            'hits': 3,
+            'misses': 1,
+            'evictions': 1,
+        })
+
+        # expired
+        local = LocalCache(max_size=2, timeout=-1)
+        local.set('a', 1)
+        self.assertEqual(local.get('a'), None)
+
+        # invalidated by another process
+        subscriber = LocalCacheSubscriber(local, 'channel')
+        local.timeout = 60
+        local.set('a', 1)
+        subscriber.handle_message({'type': 'message', 'data': b'a'})
+        self.assertEqual(local.get('a'), None)
+
+    def test_local_cache_through_memcached(self):
+        user = self.create_user('linghu')
+        with self.settings(LOCAL_CACHE_ENABLE=True):
+            local_cache.clear()
+            MemcachedHelper.get_object_through_cache(User, user.id)
+            key = MemcachedHelper.get_key(User, user.id)
+            self.assertEqual(local_cache.get(key).id, user.id)
+
+            # dropped locally and broadcast on change
+            user.username = 'linghu2'
+            user.save()
+            self.assertEqual(local_cache.get(key), None)
+            users = MemcachedHelper.get_objects_through_cache(User, [user.id])
+            self.assertEqual(users[0].username, 'linghu2')
+            self.assertEqual(local_cache.get(key).username, 'linghu2')
+        local_cache.clear()
+
+    def test_early_refresh(self):
+        user = self.create_user('linghu')
+        key = MemcachedHelper.get_key(User, user.id)
+        cache.delete(key)
+        MemcachedHelper.get_object_through_cache(User, user.id)
+        entry = cache.get(key)
+        self.assertEqual(isinstance(entry, CacheEntry), True)
+        # expiry is jittered within the last CACHE_TIMEOUT_JITTER of timeout
+        timeout = entry.expire_at - time.time()
+        self.assertEqual(timeout <= settings.CACHE_TIMEOUT, True)
+        self.assertEqual(
+            timeout > settings.CACHE_TIMEOUT * (1 - settings.CACHE_TIMEOUT_JITTER) - 5,
+            True,
+        )
+
+        # an expired entry is served stale and refreshed in background
+        User.objects.filter(id=user.id).update(username='linghu2')
+        cache.set(key, entry._replace(expire_at=time.time() - 1))
+        obj = MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(obj.username, 'linghu')
+        entry = cache.get(key)
+        self.assertEqual(entry.value.username, 'linghu2')
+        self.assertEqual(entry.expire_at > time.time(), True)
+
+        # the same goes for batch reads
+        User.objects.filter(id=user.id).update(username='linghu3')
+        cache.set(key, entry._replace(expire_at=time.time() - 1))
+        users = MemcachedHelper.get_objects_through_cache(User, [user.id])
+        self.assertEqual(users[0].username, 'linghu2')
+        users = MemcachedHelper.get_objects_through_cache(User, [user.id])
+        self.assertEqual(users[0].username, 'linghu3')
+
+        # entries cached before are read as they are
+        cache.set(key, user)
+        obj = MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(obj.id, user.id)
+
+    def test_prefetch_objects(self):
+        linghu = self.create_user('linghu')
+        dongxie = self.create_user('dongxie')
+        tweets = [
+            self.create_tweet(linghu),
+            self.create_tweet(dongxie),
+            self.create_tweet(linghu),
+        ]
+        tweets = MemcachedHelper.prefetch_objects(tweets, User, 'user_id', '_cached_user')
+        self.assertEqual(
+            [tweet.cached_user.username for tweet in tweets],
+            ['linghu', 'dongxie', 'linghu'],
+        )
+
+        # objects come back in the order of ids, missing ones skipped
+        users = MemcachedHelper.get_objects_through_cache(
+            User,
+            [dongxie.id, 0, linghu.id],
+        )
+        self.assertEqual([user.id for user in users], [dongxie.id, linghu.id])
+
+    def test_tombstones(self):
+        user = self.create_user('linghu')
+        missing_id = user.id + 1
+        key = MemcachedHelper.get_key(User, missing_id)
+        cache.delete(key)
+        with self.assertRaises(User.DoesNotExist):
+            MemcachedHelper.get_object_through_cache(User, missing_id)
+        self.assertEqual(isinstance(cache.get(key).value, Tombstone), True)
+
+        # confirmed missing without querying db
+        with self.assertNumQueries(0):
+            with self.assertRaises(User.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(User, missing_id)
+            users = MemcachedHelper.get_objects_through_cache(User, [missing_id])
+            self.assertEqual(users, [])
+
+        # saving the object drops the tombstone
+        self.create_user('dongxie')
+        self.assertEqual(cache.get(key), None)
+        users = MemcachedHelper.get_objects_through_cache(User, [user.id, missing_id])
+        self.assertEqual([u.username for u in users], ['linghu', 'dongxie'])
+
+        # batch reads leave tombstones as well
+        cache.delete(MemcachedHelper.get_key(User, missing_id + 1))
+        MemcachedHelper.get_objects_through_cache(User, [missing_id + 1])
+        self.assertEqual(
+            isinstance(cache.get(MemcachedHelper.get_key(User, missing_id + 1)).value, Tombstone),
+            True,
+        )
+
+    def test_batch_entries_versioned(self):
+        linghu = self.create_user('linghu')
+        dongxie = self.create_user('dongxie')
+        linghu_key = MemcachedHelper.get_key(User, linghu.id)
+        dongxie_key = MemcachedHelper.get_key(User, dongxie.id)
+        missing_key = MemcachedHelper.get_key(User, dongxie.id + 1)
+        cache.delete_many([linghu_key, dongxie_key, missing_key])
+        version = RedisHelper.next_cache_version(linghu_key)
+
+        # misses are written at once with the version read before the query
+        MemcachedHelper.get_objects_through_cache(
+            User,
+            [linghu.id, dongxie.id, dongxie.id + 1],
+        )
+        self.assertEqual(cache.get(linghu_key).version, version)
+        self.assertEqual(cache.get(dongxie_key).value.id, dongxie.id)
+        self.assertEqual(isinstance(cache.get(missing_key).value, Tombstone), True)
+
+        # so a refresh of an older version does not replace them
+        MemcachedHelper.refresh_entry(linghu_key, lambda: None, version - 1)
+        self.assertEqual(cache.get(linghu_key).value.id, linghu.id)
+
+    def test_write_through(self):
+        user = self.create_user('linghu')
+        key = MemcachedHelper.get_key(User, user.id)
+        cache.delete(key)
+        MemcachedHelper.get_object_through_cache(User, user.id)
+
+        User.objects.filter(id=user.id).update(username='linghu2')
+        MemcachedHelper.write_through_object(User, user.id)
+        entry = cache.get(key)
+        self.assertEqual(entry.value.username, 'linghu2')
+        self.assertEqual(entry.version > 0, True)
+
+        # entries of older versions don't replace newer ones
+        User.objects.filter(id=user.id).update(username='linghu3')
+        MemcachedHelper.refresh_entry(key, lambda: User.objects.get(id=user.id), entry.version - 1)
+        self.assertEqual(cache.get(key).value.username, 'linghu2')
+        # neither do values read from db on a miss
+        MemcachedHelper.add_entry(key, User.objects.get(id=user.id), 0)
+        self.assertEqual(cache.get(key).value.username, 'linghu2')
+        MemcachedHelper.refresh_object(User, user.id)
+        self.assertEqual(cache.get(key).value.username, 'linghu3')
+
+        # refreshes still go through once the version expired in redis
+        version_key = CACHE_VERSION_PATTERN.format(key=key)
+        RedisClient.get_connection(version_key).delete(version_key)
+        User.objects.filter(id=user.id).update(username='linghu4')
+        MemcachedHelper.refresh_object(User, user.id)
+        self.assertEqual(cache.get(key).value.username, 'linghu4')
+        self.assertEqual(cache.get(key).version, entry.version)
+
+        # a deleted object leaves a tombstone
+        User.objects.filter(id=user.id).delete()
+        MemcachedHelper.write_through_object(User, user.id)
+        with self.assertRaises(User.DoesNotExist):
+            MemcachedHelper.get_object_through_cache(User, user.id)
+
+    def test_large_value(self):
+        key = 'large_value'
+        MemcachedHelper.set_large_value(key, {1, 2, 3})
+        self.assertEqual(MemcachedHelper.get_large_value(key), {1, 2, 3})
+
+        # incompressible payload split into chunks
+        value = os.urandom(LARGE_VALUE_CHUNK_SIZE * 2 + 1)
+        MemcachedHelper.set_large_value(key, value)
+        manifest = cache.get(key)
+        self.assertEqual(manifest.chunks_count, 3)
+        self.assertEqual(MemcachedHelper.get_large_value(key), value)
+
+        # a missing or corrupted chunk is a miss
+        chunk_key = MemcachedHelper._get_chunk_key(key, manifest.token, 1)
+        chunk = cache.get(chunk_key)
+        cache.set(chunk_key, chunk[::-1])
+        self.assertEqual(MemcachedHelper.get_large_value(key), None)
+        cache.delete(chunk_key)
+        self.assertEqual(MemcachedHelper.get_large_value(key), None)
+        cache.delete(key)
+        self.assertEqual(MemcachedHelper.get_large_value(key), None)
+
+
+class WriteThroughListenerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def test_write_through_on_commit(self):
+        with self.settings(CACHE_WRITE_THROUGH=True):
+            user = self.create_user('linghu')
+            key = MemcachedHelper.get_key(User, user.id)
+            MemcachedHelper.get_object_through_cache(User, user.id)
+
+            # replaced rather than deleted once the save is committed
+            user.username = 'linghu2'
+            user.save()
+            entry = cache.get(key)
+            self.assertEqual(entry.value.username, 'linghu2')
+            self.assertEqual(entry.version > 0, True)
+
+            # a deleted object leaves a tombstone
+            User.objects.filter(id=user.id).delete()
+            self.assertEqual(isinstance(cache.get(key).value, Tombstone), True)
+            with self.assertRaises(User.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(User, user.id)
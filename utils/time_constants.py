@@ -1 +1,2 @@
-ONE_HOUR = 60 * 60
\ No newline at end of file
+ONE_HOUR = 60 * 60
+ONE_DAY = 24 * ONE_HOUR
\ No newline at end of file
@@ -1,5 +1,15 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
 def utc_now():
-    return datetime.now().replace(tzinfo=pytz.utc)
\ No newline at end of file
+    return datetime.now().replace(tzinfo=pytz.utc)
+
+def to_epoch_microseconds(dt):
+    # exact, unlike float timestamp()
+    return (dt - EPOCH) // ONE_MICROSECOND
+
+def from_epoch_microseconds(value):
+    return EPOCH + value * ONE_MICROSECOND
\ No newline at end of file